@@ -0,0 +1,105 @@
+import logging
+import argparse
+import pathlib
+import tempfile
+
+import torch
+
+from src.helpers.utils import add_mask_params, build_optim, save_json
+from src.helpers.data_loading import create_data_loader
+from src.helpers.distributed import NullWriter
+from src.helpers.random_data import create_random_data
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.policy_model_utils import create_data_range_dict
+from src.policy_model.actor_learner import start_actors, stop_actors, train_epoch_actor_learner
+from src.train_policy import train_epoch, create_arg_parser as create_policy_arg_parser
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def create_policy_args(args, data_dir, checkpoint):
+    policy_args = create_policy_arg_parser().parse_args([
+        '--data_path', str(data_dir), '--recon_model_checkpoint', str(checkpoint), '--device', args.device,
+        '--resolution', str(args.resolution), '--batch_size', str(args.batch_size), '--sample_rate', '1',
+        '--acquisition_steps', str(args.acquisition_steps), '--num_workers', str(args.num_workers),
+        '--num_epochs', '2', '--report_interval', '100000', '--data_parallel', 'False',
+        '--max_policy_lag', str(args.max_policy_lag)])
+    policy_args.seed = args.seed
+    return add_mask_params(policy_args)
+
+
+def benchmark_sync(args, recon_model):
+    # Time of the second epoch of the synchronous training loop (train_policy.train_epoch)
+    model = build_policy_model(args)
+    optimiser = build_optim(args, model.parameters())
+    loader = create_data_loader(args, 'train', shuffle=True)
+    data_range_dict = create_data_range_dict(args, loader)
+    for epoch in range(args.num_epochs):
+        _, train_time = train_epoch(args, epoch, recon_model, model, loader, optimiser, NullWriter(),
+                                    data_range_dict)
+    return len(loader.dataset) / train_time
+
+
+def benchmark_actor_learner(args):
+    # Time of the second epoch of actor-learner training, such that actor start-up is not included
+    model = build_policy_model(args)
+    optimiser = build_optim(args, model.parameters())
+    publisher, queue, actors = start_actors(args, model, start_epoch=0)
+    num_updates = 0
+    for epoch in range(args.num_epochs):
+        _, train_time, num_updates, num_slices = train_epoch_actor_learner(args, epoch, model, optimiser,
+                                                                           NullWriter(), publisher, queue,
+                                                                           num_updates)
+    stop_actors(actors)
+    return num_slices / train_time
+
+
+def main(args):
+    logger.info(args)
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = pathlib.Path(tmp_dir)
+        checkpoint = create_random_data(args, data_dir)
+        policy_args = create_policy_args(args, data_dir, checkpoint)
+        _, recon_model = load_recon_model(policy_args)
+
+        sync_throughput = benchmark_sync(policy_args, recon_model)
+        logger.info(f'Synchronous: {sync_throughput:.2f} slices/s')
+        report = {'sync': sync_throughput}
+        for num_actors in args.num_actors:
+            policy_args.num_actors = num_actors
+            report[f'actors{num_actors}'] = benchmark_actor_learner(policy_args)
+            logger.info(f'Actor-learner with {num_actors} actors: {report[f"actors{num_actors}"]:.2f} slices/s, '
+                        f'speedup = {report[f"actors{num_actors}"] / sync_throughput:.2f}x')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Compares the training throughput of greedy policy training with '
+                                                 'actor-learner rollouts to the synchronous loop, on random volumes '
+                                                 'with a randomly initialised reconstruction model.')
+    parser.add_argument('--num_actors', nargs='+', default=[1, 2, 4], type=int,
+                        help='Numbers of actor processes to benchmark.')
+    parser.add_argument('--max_policy_lag', type=int, default=4,
+                        help='Transitions generated by a policy that is more than this number of learner updates old '
+                             'are dropped.')
+    parser.add_argument('--num_volumes', default=8, type=int, help='Number of random volumes.')
+    parser.add_argument('--num_slices', default=16, type=int,
+                        help='Number of slices per random volume (only the center half is used).')
+    parser.add_argument('--resolution', default=128, type=int, help='Resolution of images')
+    parser.add_argument('--batch_size', default=16, type=int, help='Mini batch size for training')
+    parser.add_argument('--acquisition_steps', default=8, type=int, help='Acquisition steps per image.')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='Number of workers to use for data loading in the synchronous loop.')
+    parser.add_argument('--seed', default=1, type=int, help='Seed for random number generators.')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='Which device to benchmark on. Set to "cuda" to use the GPU')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
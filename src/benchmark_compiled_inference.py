@@ -0,0 +1,99 @@
+import logging
+import argparse
+
+import torch
+
+from src.helpers.utils import save_json, time_function
+from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.compiled_inference import (ZeroFilledReconstruction, compile_module, max_abs_difference,
+                                                 COMPILE_MODES)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def time_module(args, module, inputs):
+    # Average wall time per call in seconds, after warmup calls (which also trigger JIT optimisation)
+    with torch.no_grad():
+        return time_function(lambda: module(*inputs), args.repeats, warmup=args.warmup)[1]
+
+
+def benchmark_module(args, name, module, create_inputs, modes):
+    # Latency of every compilation mode for every batch size, and the largest deviation from eager execution
+    results = {}
+    example = create_inputs(2)
+    for mode in modes:
+        # ZeroFilledReconstruction can only be traced (or compiled), see compile_recon_model
+        if name == 'zf_recon' and mode == 'script':
+            continue
+        try:
+            compiled = compile_module(module, mode, example)
+        except Exception as e:
+            logger.warning(f'{name}: could not compile with {mode} ({e}).')
+            continue
+        for batch_size in args.batch_sizes:
+            inputs = create_inputs(batch_size)
+            error = max_abs_difference(module, compiled, inputs)
+            latency = time_module(args, compiled, inputs)
+            results[f'{mode}_batch{batch_size}'] = {'latency_ms': latency * 1000, 'max_abs_error': error}
+            eager = results[f'eager_batch{batch_size}']['latency_ms'] if mode != 'eager' else latency * 1000
+            logger.info(f'{name} {mode:>7} batch {batch_size:>3}: {latency * 1000:8.2f}ms '
+                        f'(speedup {eager / (latency * 1000):.2f}x), max abs error {error:.2e}')
+            assert error < args.tolerance, f'{name} compiled with {mode} deviates from eager execution by {error:.2e}.'
+    return results
+
+
+def main(args):
+    logger.info(args)
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    res = args.resolution
+    recon_model = build_reconstruction_model(args).eval()
+    policy_model = build_policy_model(args).eval()
+    for param in list(recon_model.parameters()) + list(policy_model.parameters()):
+        param.requires_grad = False
+
+    # Eager first: speedups are relative to it
+    modes = ['eager'] + [mode for mode in args.modes if mode != 'eager']
+    report = {
+        'recon': benchmark_module(args, 'recon', recon_model, lambda b: (torch.randn(b, 1, res, res),), modes),
+        'zf_recon': benchmark_module(args, 'zf_recon', ZeroFilledReconstruction(recon_model),
+                                     lambda b: (torch.randn(b, 1, res, res, 2),), modes),
+        'policy': benchmark_module(args, 'policy', policy_model, lambda b: (torch.randn(b, 1, res, res),), modes),
+    }
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Checks and benchmarks compiled (TorchScript / torch.compile) '
+                                                 'inference of randomly initialised reconstruction and policy models '
+                                                 'on CPU, per acquisition step.')
+    parser.add_argument('--modes', nargs='+', default=COMPILE_MODES[1:], choices=COMPILE_MODES,
+                        help='Compilation modes to benchmark against eager execution.')
+    parser.add_argument('--batch_sizes', nargs='+', default=[1, 16, 128], type=int,
+                        help='Numbers of images per call (slices x trajectories in a rollout step).')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(), help='Number of CPU threads.')
+    parser.add_argument('--repeats', default=10, type=int, help='Number of timed calls per mode and batch size.')
+    parser.add_argument('--warmup', default=3, type=int, help='Number of untimed calls before timing.')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='Maximum allowed absolute difference between compiled and eager outputs.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for random number generators.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+
+    # Model settings, as in train_reconstruction.py and train_policy.py
+    parser.add_argument('--resolution', default=128, type=int, help='Resolution of images')
+    parser.add_argument('--num_pools', type=int, default=4, help='Number of U-Net pooling layers')
+    parser.add_argument('--num_chans', type=int, default=16, help='Number of channels in the first layer of both '
+                        'models.')
+    parser.add_argument('--num_layers', type=int, default=4, help='Number of policy ConvNet layers.')
+    parser.add_argument('--fc_size', default=256, type=int, help='Size (width) of policy fully connected layer(s).')
+    parser.add_argument('--drop_prob', type=float, default=0, help='Dropout probability')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    args.device = 'cpu'
+    main(args)
@@ -0,0 +1,95 @@
+import logging
+import argparse
+import pathlib
+import tempfile
+
+import torch
+import torch.multiprocessing as mp
+
+from src.helpers.utils import add_mask_params, build_optim, save_json
+from src.helpers.data_loading import create_data_loader
+from src.helpers.distributed import NullWriter
+from src.helpers.cpu_profile import apply_cpu_profile, to_channels_last, get_numa_nodes
+from src.helpers.random_data import create_random_data
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.policy_model_utils import create_data_range_dict
+from src.train_policy import train_epoch, create_arg_parser as create_policy_arg_parser
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def run_config(name, flags, args, data_dir, checkpoint, results):
+    # Runs in a process of its own, since thread counts and affinity can only be set for a whole process
+    logging.basicConfig(level=logging.INFO)
+    policy_args = create_policy_arg_parser().parse_args([
+        '--data_path', str(data_dir), '--recon_model_checkpoint', str(checkpoint), '--device', 'cpu',
+        '--resolution', str(args.resolution), '--batch_size', str(args.batch_size), '--sample_rate', '1',
+        '--acquisition_steps', str(args.acquisition_steps), '--num_workers', str(args.num_workers),
+        '--report_interval', '100000'] + flags)
+    apply_cpu_profile(policy_args)
+    policy_args = add_mask_params(policy_args)
+    torch.manual_seed(args.seed)
+
+    _, recon_model = load_recon_model(policy_args)
+    recon_model = to_channels_last(policy_args, recon_model)
+    model = to_channels_last(policy_args, build_policy_model(policy_args))
+    optimiser = build_optim(policy_args, model.parameters())
+    loader = create_data_loader(policy_args, 'train', shuffle=True)
+    data_range_dict = create_data_range_dict(policy_args, loader)
+    # The first epoch includes worker start-up and one-off allocations
+    for epoch in range(2):
+        _, train_time = train_epoch(policy_args, epoch, recon_model, model, loader, optimiser, NullWriter(),
+                                    data_range_dict)
+    results[name] = len(loader.dataset) / train_time
+
+
+def main(args):
+    logger.info(args)
+    configs = {
+        'default': [],
+        'cpu_profile': ['--cpu_profile', 'True'],
+        'cpu_profile_pinned': ['--cpu_profile', 'True', '--pin_cores', 'True'],
+    }
+    if len(get_numa_nodes()) > 1:
+        # Single socket, such that memory accesses stay local
+        configs['cpu_profile_numa0'] = ['--cpu_profile', 'True', '--pin_cores', 'True', '--numa_node', '0']
+
+    ctx = mp.get_context('spawn')
+    results = ctx.Manager().dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = pathlib.Path(tmp_dir)
+        checkpoint = create_random_data(args, data_dir)
+        for name, flags in configs.items():
+            process = ctx.Process(target=run_config, args=(name, flags, args, data_dir, checkpoint, results))
+            process.start()
+            process.join()
+            logger.info(f'{name}: {results[name]:.2f} slices/s, '
+                        f'speedup = {results[name] / results["default"]:.2f}x')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()},
+                                      results=dict(results)))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Compares the greedy policy training throughput on CPU with the CPU '
+                                                 'profile (see src/helpers/cpu_profile.py) to the default settings, '
+                                                 'on random volumes with a randomly initialised reconstruction '
+                                                 'model. Run on a multi-socket machine to include NUMA pinning.')
+    parser.add_argument('--num_volumes', default=8, type=int, help='Number of random volumes.')
+    parser.add_argument('--num_slices', default=16, type=int,
+                        help='Number of slices per random volume (only the center half is used).')
+    parser.add_argument('--resolution', default=128, type=int, help='Resolution of images')
+    parser.add_argument('--batch_size', default=16, type=int, help='Mini batch size for training')
+    parser.add_argument('--acquisition_steps', default=8, type=int, help='Acquisition steps per image.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers to use for data loading')
+    parser.add_argument('--seed', default=1, type=int, help='Seed for random number generators.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    args.device = 'cpu'
+    main(args)
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from src.helpers import transforms
+from src.helpers.utils import save_json, str2bool
+from src.helpers.distributed import init_distributed, wrap_model, all_reduce
+from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.policy_model_utils import (build_optim, get_new_zf, compute_initial_reconstruction,
+                                                 compute_backprop_trajectory)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def create_batch(args):
+    # Random fully sampled k-space with only the center columns acquired, in the shapes used by train_policy.py
+    res = args.resolution
+    gt = torch.rand(args.batch_size, 1, res, res, device=args.device)
+    kspace = transforms.rfft2(gt)
+    mask = torch.zeros(args.batch_size, 1, 1, res, 1, device=args.device)
+    mask[..., res // 2 - res // 16:res // 2 + res // 16, :] = 1
+    masked_kspace = kspace * mask
+    zf, _, _ = get_new_zf(masked_kspace)
+    gt_mean = gt.mean(dim=(-1, -2), keepdim=True)
+    gt_std = gt.std(dim=(-1, -2), keepdim=True)
+    data_range = gt.flatten(1).max(dim=1)[0].view(-1, 1, 1, 1)
+    return kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, data_range
+
+
+def train_steps(args, recon_model, model, optimiser, batch, num_iters):
+    # Greedy policy training iterations as in train_policy.train_epoch, on a fixed batch
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, data_range = batch
+    for _ in range(num_iters):
+        optimiser.zero_grad()
+        recons = compute_initial_reconstruction(recon_model, zf, mask)
+        step_mask, step_masked_kspace = mask, masked_kspace
+        action_list, logprob_list, reward_list, score_list = [], [], [], []
+        for step in range(args.acquisition_steps):
+            _, step_mask, step_masked_kspace, recons = compute_backprop_trajectory(
+                args, kspace, step_masked_kspace, step_mask, gt, recons, gt_mean, gt_std, data_range, model,
+                recon_model, step, action_list, logprob_list, reward_list, score_list=score_list)
+        optimiser.step()
+
+
+def worker(rank, world_size, args, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(args.master_port + world_size),
+                      WORLD_SIZE=str(world_size), RANK=str(rank), LOCAL_RANK=str(rank))
+    init_distributed(args)
+    if args.device == 'cpu':
+        # Fixed total number of cores, divided over the processes
+        torch.set_num_threads(max(1, args.num_threads // world_size))
+    torch.manual_seed(args.seed + rank)
+
+    recon_model = build_reconstruction_model(args)
+    for param in recon_model.parameters():
+        param.requires_grad = False
+    model = wrap_model(args, build_policy_model(args))
+    optimiser = build_optim(args, model.parameters())
+    batch = create_batch(args)
+
+    train_steps(args, recon_model, model, optimiser, batch, args.warmup_iters)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    train_steps(args, recon_model, model, optimiser, batch, args.iters)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    # Throughput is limited by the slowest process
+    elapsed = torch.tensor([time.perf_counter() - start], dtype=torch.float64, device=args.device)
+    elapsed = all_reduce(elapsed, op='max').item()
+    if rank == 0:
+        results[world_size] = world_size * args.batch_size * args.iters / elapsed
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def main(args):
+    logger.info(args)
+    if args.device == 'cuda':
+        num_gpus = torch.cuda.device_count()
+        assert max(args.num_processes) <= num_gpus, f'NCCL needs a GPU per process, but only {num_gpus} found.'
+    results = mp.Manager().dict()
+    for world_size in args.num_processes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+        logger.info(f'{world_size} processes: {results[world_size]:.2f} slices/s')
+
+    # Efficiency of the per-process throughput, relative to the smallest number of processes
+    base = min(args.num_processes)
+    report = {}
+    for world_size in args.num_processes:
+        efficiency = results[world_size] * base / (results[base] * world_size)
+        report[world_size] = {'throughput': results[world_size], 'speedup': results[world_size] / results[base],
+                              'efficiency': efficiency}
+        logger.info(f'{world_size} processes: speedup = {results[world_size] / results[base]:.2f}x, '
+                    f'scaling efficiency = {efficiency:.1%}')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Measures the scaling efficiency of distributed (torchrun) policy '
+                                                 'training for a range of process counts, on random data with '
+                                                 'randomly initialised models.')
+    parser.add_argument('--num_processes', nargs='+', default=[1, 2, 4, 8], type=int,
+                        help='Numbers of processes to benchmark.')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help="Device of every process: 'cpu' uses the gloo backend, 'cuda' uses NCCL with a GPU per "
+                             "process.")
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(),
+                        help="Total number of CPU threads, divided over the processes (used with device 'cpu').")
+    parser.add_argument('--master_port', type=int, default=29500,
+                        help='Base port for the process group. Every number of processes uses a different port.')
+    parser.add_argument('--batch_size', default=16, type=int, help='Number of slices per process per iteration.')
+    parser.add_argument('--iters', default=10, type=int, help='Number of timed training iterations.')
+    parser.add_argument('--warmup_iters', default=2, type=int, help='Number of untimed training iterations.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for random number generators.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+
+    # Model and training settings, as in train_policy.py
+    parser.add_argument('--resolution', default=128, type=int, help='Resolution of images')
+    parser.add_argument('--acquisition_steps', default=4, type=int, help='Acquisition steps per iteration.')
+    parser.add_argument('--num_trajectories', type=int, default=8, help='Number of actions to sample every '
+                        'acquisition step.')
+    parser.add_argument('--num_chans', type=int, default=16, help='Number of ConvNet channels in first layer.')
+    parser.add_argument('--num_layers', type=int, default=4, help='Number of ConvNet layers.')
+    parser.add_argument('--num_pools', type=int, default=4, help='Number of U-Net pooling layers.')
+    parser.add_argument('--fc_size', default=256, type=int, help='Size (width) of fully connected layer(s).')
+    parser.add_argument('--drop_prob', type=float, default=0, help='Dropout probability')
+    parser.add_argument('--lr', type=float, default=5e-5, help='Learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0, help='Strength of weight decay regularization.')
+    parser.add_argument('--no_baseline', type=str2bool, default=False,
+                        help='Whether to not use a reward baseline at all.')
+    parser.add_argument('--chunk_memory_mb', type=float, default=0,
+                        help='Memory budget (in MB) for reconstructing sampled trajectories in micro-batches.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    # Fields of the training arguments that this benchmark keeps fixed
+    args.model_type = 'greedy'
+    args.batches_step = 1
+    args.gamma = 1.
+    args.dedup_actions = False
+    args.transition_replay = False
+    args.reward = 'ssim'
+    args.data_parallel = False
+    args.dist_backend = None
+    main(args)
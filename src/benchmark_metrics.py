@@ -0,0 +1,114 @@
+import logging
+import argparse
+
+import numpy as np
+import torch
+
+from src.helpers.torch_metrics import compute_ssim, compute_psnr, compute_volume_ssim
+from src.helpers.utils import time_function
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def create_images(args, resolution):
+    # Random ground truths and noisy 'reconstructions' of shape batch x trajectories x res x res
+    shape = (args.batch_size, args.num_trajectories, resolution, resolution)
+    gt = torch.rand(shape, device=args.device)
+    recons = (gt + 0.1 * torch.randn(shape, device=args.device)).clamp(min=0.)
+    data_range = gt.flatten(1).max(dim=1)[0].view(-1, 1, 1, 1)
+    return recons, gt, data_range
+
+
+def time_call(args, fn):
+    # Average wall time per call in seconds, after a warmup call
+    return time_function(fn, args.repeats, warmup=1, device=args.device)[1]
+
+
+def benchmark_ssim(args, resolution):
+    recons, gt, data_range = create_images(args, resolution)
+    with torch.no_grad():
+        reference = compute_ssim(recons, gt, size_average=False, data_range=data_range, fused=False)
+        fused = compute_ssim(recons, gt, size_average=False, data_range=data_range, fused=True)
+        max_map_error = (reference - fused).abs().max().item()
+        max_score_error = (reference.mean(dim=(-1, -2)) - fused.mean(dim=(-1, -2))).abs().max().item()
+
+        reference_time = time_call(args, lambda: compute_ssim(recons, gt, size_average=False,
+                                                              data_range=data_range, fused=False))
+        fused_time = time_call(args, lambda: compute_ssim(recons, gt, size_average=False,
+                                                          data_range=data_range, fused=True))
+    logger.info(f'SSIM res {resolution}: max abs error map = {max_map_error:.2e}, '
+                f'max abs error score = {max_score_error:.2e}, reference = {reference_time * 1000:.2f}ms, '
+                f'fused = {fused_time * 1000:.2f}ms, speedup = {reference_time / fused_time:.2f}x')
+    assert max_score_error < args.tolerance, (f'Fused SSIM deviates from reference implementation by '
+                                              f'{max_score_error:.2e} at resolution {resolution}.')
+
+
+def benchmark_psnr(args, resolution):
+    try:
+        import piq  # noqa: F401
+    except ImportError:
+        logger.warning('piq is not installed: skipping validation of PSNR against the reference implementation.')
+        return
+    recons, gt, data_range = create_images(args, resolution)
+    # compute_psnr uses args.resolution for the reference implementation
+    args.resolution = resolution
+    with torch.no_grad():
+        reference = compute_psnr(args, recons, gt, data_range, reference=True)
+        batched = compute_psnr(args, recons, gt, data_range)
+        max_error = (reference - batched.cpu()).abs().max().item()
+
+        reference_time = time_call(args, lambda: compute_psnr(args, recons, gt, data_range, reference=True))
+        batched_time = time_call(args, lambda: compute_psnr(args, recons, gt, data_range))
+    logger.info(f'PSNR res {resolution}: max abs error = {max_error:.2e}, reference = {reference_time * 1000:.2f}ms, '
+                f'batched = {batched_time * 1000:.2f}ms, speedup = {reference_time / batched_time:.2f}x')
+    assert max_error < args.tolerance * 100, (f'Batched PSNR deviates from reference implementation by '
+                                              f'{max_error:.2e} at resolution {resolution}.')
+
+
+def benchmark_volume_ssim(args, resolution):
+    # Volume SSIM used to evaluate reconstruction models, against skimage's implementation
+    from skimage.metrics import structural_similarity
+    recons, gt, _ = create_images(args, resolution)
+    gt, recons = gt[0].cpu().numpy().astype(np.float32), recons[0].cpu().numpy().astype(np.float32)
+
+    reference = structural_similarity(gt.transpose(1, 2, 0), recons.transpose(1, 2, 0), multichannel=True,
+                                      data_range=gt.max())
+    error = abs(reference - compute_volume_ssim(gt, recons))
+    reference_time = time_call(args, lambda: structural_similarity(
+        gt.transpose(1, 2, 0), recons.transpose(1, 2, 0), multichannel=True, data_range=gt.max()))
+    torch_time = time_call(args, lambda: compute_volume_ssim(gt, recons))
+    logger.info(f'Volume SSIM res {resolution}: abs error = {error:.2e}, skimage = {reference_time * 1000:.2f}ms, '
+                f'torch = {torch_time * 1000:.2f}ms, speedup = {reference_time / torch_time:.2f}x')
+    assert error < 1e-6, f'Torch volume SSIM deviates from skimage by {error:.2e} at resolution {resolution}.'
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    logger.info(args)
+    for resolution in args.resolutions:
+        benchmark_ssim(args, resolution)
+        benchmark_psnr(args, resolution)
+        benchmark_volume_ssim(args, resolution)
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Validates and benchmarks the metric implementations in '
+                                                 'src/helpers/torch_metrics.py against their reference versions.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for random number generators.')
+    parser.add_argument('--resolutions', nargs='+', default=[128, 256], type=int,
+                        help='Image resolutions to benchmark.')
+    parser.add_argument('--batch_size', default=16, type=int, help='Number of slices per call.')
+    parser.add_argument('--num_trajectories', default=8, type=int,
+                        help='Number of trajectories (channels) per slice per call.')
+    parser.add_argument('--repeats', default=20, type=int, help='Number of timed calls per implementation.')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='Maximum allowed absolute difference of SSIM scores with the reference implementation. '
+                             'PSNR (in dB) is allowed to differ by 100 times this value.')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='Which device to benchmark on. Set to "cuda" to use the GPU')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
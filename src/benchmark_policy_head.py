@@ -0,0 +1,144 @@
+import copy
+import logging
+import pathlib
+import argparse
+
+import torch
+
+from src.helpers.utils import add_mask_params, build_optim, save_json, seed_everything, time_function
+from src.helpers.data_loading import create_data_loader
+from src.helpers.distributed import NullWriter
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.policy_model.policy_model_def import build_policy_model, POLICY_HEADS
+from src.policy_model.policy_model_utils import create_data_range_dict
+from src.train_policy import train_epoch, evaluate, create_arg_parser as create_policy_arg_parser
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def num_params(model):
+    return sum(param.numel() for param in model.parameters())
+
+
+def state_bytes(model, optimiser):
+    # Memory of parameters, their gradients and the optimiser state (two moments for Adam)
+    tensors = [param for param in model.parameters()] + [param.grad for param in model.parameters()
+                                                         if param.grad is not None]
+    tensors += [value for state in optimiser.state.values() for value in state.values() if torch.is_tensor(value)]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def time_step(args, policy_args, model):
+    # Average wall time of a forward and backward pass of a batch of reconstructions, after a warmup pass
+    images = torch.randn(args.batch_size, 1, policy_args.resolution, policy_args.resolution,
+                         device=policy_args.device)
+    model.train()
+    _, latency = time_function(lambda: model(images).sum().backward(), args.repeats, warmup=1,
+                               device=policy_args.device)
+    model.zero_grad()
+    return latency
+
+
+def benchmark_head(args, policy_args, recon_model, head):
+    """
+    Trains a policy with the given head for args.epochs epochs from a fixed seed, and reports its number of
+    parameters, the memory of its training state, the latency of a training step of the policy and the SSIM curve on
+    the validation volumes after training.
+    """
+    policy_args = copy.deepcopy(policy_args)
+    policy_args.policy_head = head
+    seed_everything(args.seed)
+    model = build_policy_model(policy_args)
+    optimiser = build_optim(policy_args, model.parameters())
+    latency = time_step(args, policy_args, model)
+    if policy_args.device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    train_loader = create_data_loader(policy_args, 'train', shuffle=True)
+    train_data_range_dict = create_data_range_dict(policy_args, train_loader)
+    train_time = 0
+    for epoch in range(args.epochs):
+        _, epoch_time = train_epoch(policy_args, epoch, recon_model, model, train_loader, optimiser, NullWriter(),
+                                    train_data_range_dict)
+        train_time += epoch_time
+    dev_loader = create_data_loader(policy_args, 'val', shuffle=False)
+    dev_data_range_dict = create_data_range_dict(policy_args, dev_loader)
+    seed_everything(args.seed)
+    ssims, _, _ = evaluate(policy_args, args.epochs, recon_model, model, dev_loader, NullWriter(), 'Val',
+                           dev_data_range_dict)
+
+    result = {'params': num_params(model), 'state_mb': state_bytes(model, optimiser) / 2 ** 20,
+              'step_latency_ms': latency * 1000, 'ssim': ssims.tolist(),
+              'train_throughput': args.epochs * len(train_loader.dataset) / train_time}
+    if policy_args.device == 'cuda':
+        result['peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return result
+
+
+def main(args):
+    logger.info(args)
+    torch.set_num_threads(args.num_threads)
+    policy_args = create_policy_arg_parser().parse_args([
+        '--data_path', str(args.data_path), '--recon_model_checkpoint', str(args.recon_model_checkpoint),
+        '--device', args.device, '--batch_size', str(args.batch_size), '--sample_rate', str(args.sample_rate),
+        '--acquisition_steps', str(args.acquisition_steps), '--accelerations', *map(str, args.accelerations),
+        '--num_workers', str(args.num_workers), '--data_parallel', 'False', '--report_interval', '100000',
+        '--head_grid', str(args.head_grid)])
+    policy_args.val_batch_size = args.batch_size
+    policy_args = add_mask_params(policy_args)
+    recon_args, recon_model = load_recon_model(policy_args)
+    recon_model = recon_model.to(args.device)
+    policy_args.resolution = recon_args.resolution
+
+    # Parameter counts at other resolutions, to show which heads depend on it
+    report = {'params_per_resolution': {}}
+    for resolution in args.resolutions:
+        counts = {}
+        for head in args.heads:
+            count_args = copy.deepcopy(policy_args)
+            count_args.resolution, count_args.policy_head, count_args.device = resolution, head, 'cpu'
+            counts[head] = num_params(build_policy_model(count_args))
+        report['params_per_resolution'][resolution] = counts
+        logger.info(f'Resolution {resolution}: ' + ', '.join(f'{head} {count:,} parameters'
+                                                             for head, count in counts.items()))
+
+    for head in args.heads:
+        result = benchmark_head(args, policy_args, recon_model, head)
+        report[head] = result
+        memory_str = f', peak memory {result["peak_memory_mb"]:.1f}MB' if 'peak_memory_mb' in result else ''
+        logger.info(f'{head}: {result["params"]:,} parameters, training state {result["state_mb"]:.1f}MB{memory_str}, '
+                    f'step latency {result["step_latency_ms"]:.2f}ms, training {result["train_throughput"]:.2f} '
+                    f'slices/s, final SSIM {result["ssim"][-1]:.4f}')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Compares policy heads (see POLICY_HEADS in policy_model_def.py) in '
+                                                 'number of parameters, memory, policy step latency and SSIM after '
+                                                 'training for the same number of epochs.')
+    parser.add_argument('--data_path', type=pathlib.Path, required=True, help='Path to the dataset.')
+    parser.add_argument('--recon_model_checkpoint', type=pathlib.Path, required=True,
+                        help='Path to a pretrained reconstruction model.')
+    parser.add_argument('--heads', nargs='+', default=POLICY_HEADS, choices=POLICY_HEADS, help='Heads to compare.')
+    parser.add_argument('--head_grid', default=4, type=int, help="Grid size of head 'adaptive'.")
+    parser.add_argument('--resolutions', nargs='+', default=[128, 256, 320], type=int,
+                        help='Resolutions to report parameter counts for.')
+    parser.add_argument('--epochs', default=5, type=int, help='Number of training epochs per head.')
+    parser.add_argument('--device', type=str, default='cuda', help='Which device to run on.')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(), help='Number of CPU threads.')
+    parser.add_argument('--sample_rate', type=float, default=0.1, help='Fraction of total volumes to include')
+    parser.add_argument('--batch_size', default=16, type=int, help='Mini batch size')
+    parser.add_argument('--acquisition_steps', default=16, type=int, help='Acquisition steps per image.')
+    parser.add_argument('--accelerations', nargs='+', default=[8], type=int,
+                        help='Ratio of k-space columns to be sampled at the start of a trajectory.')
+    parser.add_argument('--repeats', default=10, type=int, help='Number of timed policy steps.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers to use for data loading')
+    parser.add_argument('--seed', default=42, type=int, help='Seed for random number generators.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
@@ -0,0 +1,110 @@
+import logging
+import pathlib
+import argparse
+
+import numpy as np
+import torch
+
+from src.helpers.utils import add_mask_params, build_optim, save_json, str2none, seed_everything
+from src.helpers.data_loading import create_data_loader
+from src.helpers.distributed import NullWriter, unwrap_model
+from src.helpers.precision import check_precision, apply_precision, build_grad_scaler, PRECISIONS
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.policy_model_utils import load_policy_model, create_data_range_dict
+from src.train_policy import train_epoch, evaluate, create_arg_parser as create_policy_arg_parser
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def benchmark_precision(args, policy_args, recon_model, precision):
+    """
+    Evaluates the policy with the given precision on the validation volumes, and times a training epoch from the same
+    initial weights. Returns the SSIM curve, and the evaluation and training throughput in slices per second.
+    """
+    policy_args.precision = precision
+    check_precision(policy_args)
+    recon_model = apply_precision(policy_args, recon_model)
+    if args.policy_model_checkpoint is not None:
+        # Loaded with gradients, since it is also trained
+        model = unwrap_model(load_policy_model(pathlib.Path(args.policy_model_checkpoint), optim=True)[0])
+    else:
+        seed_everything(args.seed)
+        model = build_policy_model(policy_args)
+
+    dev_loader = create_data_loader(policy_args, 'val', shuffle=False)
+    dev_data_range_dict = create_data_range_dict(policy_args, dev_loader)
+    seed_everything(args.seed)
+    ssims, _, eval_time = evaluate(policy_args, -1, recon_model, model, dev_loader, NullWriter(), 'Val',
+                                   dev_data_range_dict)
+
+    train_loader = create_data_loader(policy_args, 'train', shuffle=False)
+    optimiser = build_optim(policy_args, model.parameters())
+    train_data_range_dict = create_data_range_dict(policy_args, train_loader)
+    seed_everything(args.seed)
+    _, train_time = train_epoch(policy_args, 0, recon_model, model, train_loader, optimiser, NullWriter(),
+                                train_data_range_dict, scaler=build_grad_scaler(policy_args))
+    return ssims, len(dev_loader.dataset) / eval_time, len(train_loader.dataset) / train_time
+
+
+def main(args):
+    logger.info(args)
+    torch.set_num_threads(args.num_threads)
+    policy_args = create_policy_arg_parser().parse_args([
+        '--data_path', str(args.data_path), '--recon_model_checkpoint', str(args.recon_model_checkpoint),
+        '--device', args.device, '--batch_size', str(args.batch_size), '--sample_rate', str(args.sample_rate),
+        '--acquisition_steps', str(args.acquisition_steps), '--accelerations', *map(str, args.accelerations),
+        '--num_workers', str(args.num_workers), '--data_parallel', 'False', '--report_interval', '100000'])
+    policy_args.val_batch_size = args.batch_size
+    policy_args = add_mask_params(policy_args)
+    _, recon_model = load_recon_model(policy_args)
+    recon_model = recon_model.to(args.device)
+
+    # Full precision first: the others are compared to it
+    precisions = ['fp32'] + [precision for precision in args.precisions if precision != 'fp32']
+    report = {}
+    for precision in precisions:
+        ssims, eval_throughput, train_throughput = benchmark_precision(args, policy_args, recon_model, precision)
+        report[precision] = {'ssim': ssims.tolist(), 'eval_throughput': eval_throughput,
+                             'train_throughput': train_throughput}
+        logger.info(f'{precision}: evaluation {eval_throughput:.2f} slices/s, training {train_throughput:.2f} slices/s')
+
+    base = report['fp32']
+    for precision in precisions[1:]:
+        diff = np.array(report[precision]['ssim']) - np.array(base['ssim'])
+        diff_str = ", ".join(["{}: {:+.4f}".format(i, d) for i, d in enumerate(diff)])
+        logger.info(f'{precision} - fp32 SSIM = [{diff_str}]')
+        logger.info(f'{precision}: final SSIM difference {diff[-1]:+.5f}, max abs difference {np.abs(diff).max():.5f}, '
+                    f'evaluation speedup {report[precision]["eval_throughput"] / base["eval_throughput"]:.2f}x, '
+                    f'training speedup {report[precision]["train_throughput"] / base["train_throughput"]:.2f}x')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Compares the SSIM curves and the evaluation and training throughput '
+                                                 'of policy rollouts in reduced precision (autocast) with float32.')
+    parser.add_argument('--data_path', type=pathlib.Path, required=True, help='Path to the dataset.')
+    parser.add_argument('--recon_model_checkpoint', type=pathlib.Path, required=True,
+                        help='Path to a pretrained reconstruction model.')
+    parser.add_argument('--policy_model_checkpoint', type=str2none, default=None,
+                        help='Path to a trained policy model. If not given, a randomly initialised policy is used.')
+    parser.add_argument('--precisions', nargs='+', default=['bf16'], choices=PRECISIONS,
+                        help='Precisions to compare with fp32.')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help="Device to benchmark on. bf16 on 'cpu' uses oneDNN, where supported by the CPU.")
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(), help='Number of CPU threads.')
+    parser.add_argument('--sample_rate', type=float, default=0.1, help='Fraction of total volumes to include')
+    parser.add_argument('--batch_size', default=16, type=int, help='Mini batch size')
+    parser.add_argument('--acquisition_steps', default=16, type=int, help='Acquisition steps per image.')
+    parser.add_argument('--accelerations', nargs='+', default=[8], type=int,
+                        help='Ratio of k-space columns to be sampled at the start of a trajectory.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers to use for data loading')
+    parser.add_argument('--seed', default=42, type=int, help='Seed for random number generators.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
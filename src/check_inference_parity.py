@@ -0,0 +1,177 @@
+import copy
+import logging
+import pathlib
+import argparse
+import tempfile
+
+import torch
+
+from src.helpers.torch_metrics import compute_ssim
+from src.helpers.utils import save_json
+from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, prepare_quantization
+from src.reconstruction_model.onnx_inference import export_onnx
+from src.policy_model.policy_model_utils import get_new_zf
+from src.policy_model.compiled_inference import (ZeroFilledReconstruction, compile_recon_model, max_abs_difference,
+                                                 COMPILE_MODES)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Inference backends of the frozen reconstruction model that are checked against eager fp32 execution
+BACKENDS = ['compiled', 'quantized', 'onnx']
+
+
+def create_inputs(args):
+    # Masked k-space (batch x 1 x res x res x 2) and its zero-filled images for every batch size, from a fixed seed
+    generator = torch.Generator().manual_seed(args.seed)
+    inputs = []
+    for batch_size in args.batch_sizes:
+        masked_kspace = torch.randn(batch_size, 1, args.resolution, args.resolution, 2, generator=generator)
+        masked_kspace[:, :, :, torch.randperm(args.resolution, generator=generator)[:args.resolution // 2]] = 0
+        inputs.append((masked_kspace, get_new_zf(masked_kspace)[0]))
+    return inputs
+
+
+def check_compiled(args, model, inputs):
+    """
+    Compiles the reconstruction model as train_policy.py and run_baseline_models.py do (see compile_recon_model), and
+    checks that no mode falls back to eager execution and that both compiled graphs stay within args.compile_tolerance
+    of eager execution.
+    """
+    report = {}
+    for mode in args.compile_modes:
+        compile_args = argparse.Namespace(compiled_inference=mode, compile_tolerance=args.compile_tolerance,
+                                          resolution=args.resolution)
+        compiled = compile_recon_model(compile_args, model)
+        assert compiled.recon is not model and not isinstance(compiled.zf_recon, ZeroFilledReconstruction), \
+            f'Compilation with {mode} fell back to eager execution, see the warnings above.'
+        for batch_size, (masked_kspace, zf) in zip(args.batch_sizes, inputs):
+            error = max(max_abs_difference(model, compiled, (zf,)),
+                        max_abs_difference(ZeroFilledReconstruction(model), compiled.zf_recon, (masked_kspace,)))
+            report[f'{mode}_batch{batch_size}'] = error
+            logger.info(f'compiled {mode:>7} batch {batch_size:>3}: max abs error {error:.2e}')
+            assert error <= args.compile_tolerance, \
+                f'Compiled ({mode}) deviates from eager execution by {error:.2e} at batch size {batch_size}.'
+    return report
+
+
+def load_saved_model(args, model, tmp_dir, name, **kwargs):
+    # Stores model with checkpoint arguments args updated with kwargs, and loads it back with load_recon_model, as
+    # train_policy.py and run_baseline_models.py would
+    recon_args = copy.deepcopy(args)
+    recon_args.data_parallel = False
+    for key, value in kwargs.items():
+        setattr(recon_args, key, value)
+    checkpoint = pathlib.Path(tmp_dir) / f'{name}.pt'
+    torch.save({'epoch': 0, 'args': recon_args, 'model': model, 'exp_dir': tmp_dir}, f=checkpoint)
+    return load_recon_model(argparse.Namespace(recon_model_checkpoint=checkpoint, device='cpu'))[1]
+
+
+def check_quantized(args, model, inputs, tmp_dir):
+    """
+    Quantizes the reconstruction model to int8 as quantize_reconstruction.py does, calibrated on the checked inputs,
+    and checks that the SSIM of its reconstructions with respect to the fp32 reconstructions is within
+    args.quantized_tolerance of 1. Int8 reconstructions are not expected to match to float precision.
+    """
+    torch.backends.quantized.engine = args.quantization_backend
+    quantized_model = prepare_quantization(args, model, args.quantization_backend)
+    with torch.no_grad():
+        for _, zf in inputs:
+            quantized_model(zf)
+    torch.quantization.convert(quantized_model, inplace=True)
+    quantized_model = load_saved_model(args, quantized_model, tmp_dir, 'model_int8', quantized=True,
+                                       quantization_backend=args.quantization_backend)
+
+    report = {}
+    for batch_size, (_, zf) in zip(args.batch_sizes, inputs):
+        with torch.no_grad():
+            recons, int8_recons = model(zf), quantized_model(zf)
+        data_range = recons.flatten(1).max(dim=1)[0] - recons.flatten(1).min(dim=1)[0]
+        ssim = compute_ssim(int8_recons, recons, size_average=False, data_range=data_range.view(-1, 1, 1, 1))
+        error = 1 - ssim.mean(-1).mean(-1).min().item()
+        report[f'batch{batch_size}'] = {'ssim_error': error, 'max_abs_error': (recons - int8_recons).abs().max().item()}
+        logger.info(f'quantized batch {batch_size:>3}: 1 - SSIM {error:.2e}, '
+                    f'max abs error {report[f"batch{batch_size}"]["max_abs_error"]:.2e}')
+        assert error <= args.quantized_tolerance, \
+            f'Int8 reconstructions have an SSIM of {1 - error:.4f} with fp32 reconstructions at batch size ' \
+            f'{batch_size}.'
+    return report
+
+
+def check_onnx(args, model, inputs, tmp_dir):
+    """
+    Exports the reconstruction model to ONNX as export_reconstruction_onnx.py does, loads it with ONNX Runtime through
+    load_recon_model, and checks that its reconstructions are within args.onnx_tolerance of eager execution.
+    """
+    onnx_model = load_saved_model(args, export_onnx(model, args.resolution, args.opset_version), tmp_dir,
+                                  'model_onnx', onnx=True)
+    report = {}
+    for batch_size, (_, zf) in zip(args.batch_sizes, inputs):
+        error = max_abs_difference(model, onnx_model, (zf,))
+        report[f'batch{batch_size}'] = error
+        logger.info(f'onnx batch {batch_size:>3}: max abs error {error:.2e}')
+        assert error <= args.onnx_tolerance, \
+            f'ONNX Runtime deviates from eager execution by {error:.2e} at batch size {batch_size}.'
+    return report
+
+
+def main(args):
+    logger.info(args)
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    model = build_reconstruction_model(args).eval()
+    for param in model.parameters():
+        param.requires_grad = False
+    inputs = create_inputs(args)
+
+    report = {}
+    if 'compiled' in args.backends:
+        report['compiled'] = check_compiled(args, model, inputs)
+    with tempfile.TemporaryDirectory() as tmp_dir:  # Checkpoints of the backends that are stored as one
+        if 'quantized' in args.backends:
+            report['quantized'] = check_quantized(args, model, inputs, tmp_dir)
+        if 'onnx' in args.backends:
+            report['onnx'] = check_onnx(args, model, inputs, tmp_dir)
+    logger.info(f'All backends ({", ".join(args.backends)}) are within tolerance of eager fp32 execution.')
+    if args.out_path is not None:
+        save_json(args.out_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Checks that the inference backends of the reconstruction model give '
+                                                 'the same reconstructions as eager fp32 execution, on a randomly '
+                                                 'initialised U-Net and fixed random inputs. Fails (rather than '
+                                                 'falling back to eager execution) if a backend cannot be used or '
+                                                 'exceeds its tolerance.')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS, help='Backends to check.')
+    parser.add_argument('--compile_modes', nargs='+', default=COMPILE_MODES[1:], choices=COMPILE_MODES[1:],
+                        help="Compilation modes to check for backend 'compiled'.")
+    parser.add_argument('--compile_tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between compiled and eager outputs.')
+    parser.add_argument('--quantization_backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help="Quantized engine for backend 'quantized': 'fbgemm' for x86, 'qnnpack' for ARM.")
+    parser.add_argument('--quantized_tolerance', type=float, default=0.02,
+                        help='Maximum allowed 1 - SSIM of int8 reconstructions with respect to fp32 reconstructions.')
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX opset version for backend 'onnx'.")
+    parser.add_argument('--onnx_tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between ONNX Runtime and eager outputs.')
+    parser.add_argument('--batch_sizes', nargs='+', default=[1, 3, 16], type=int,
+                        help='Numbers of images per call. These differ from the batch size of 2 used for tracing and '
+                             'ONNX export, to catch shapes that were fixed by either.')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(), help='Number of CPU threads.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for the model weights and inputs.')
+    parser.add_argument('--out_path', type=str, default=None, help='Optional path of a json file for the report.')
+
+    # Model settings, as in train_reconstruction.py
+    parser.add_argument('--resolution', default=64, type=int, help='Resolution of images')
+    parser.add_argument('--num_pools', type=int, default=4, help='Number of U-Net pooling layers')
+    parser.add_argument('--num_chans', type=int, default=8, help='Number of U-Net channels.')
+    parser.add_argument('--drop_prob', type=float, default=0, help='Dropout probability')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    args.device = 'cpu'
+    main(args)
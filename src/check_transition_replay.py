@@ -0,0 +1,106 @@
+import logging
+import argparse
+import pathlib
+import tempfile
+
+import torch
+
+from src.helpers.utils import add_mask_params, seed_everything
+from src.helpers.data_loading import create_data_loader
+from src.helpers.random_data import create_random_data
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.policy_model.policy_model_def import build_policy_model
+from src.policy_model.policy_model_utils import (create_data_range_dict, compute_initial_reconstruction,
+                                                 compute_backprop_trajectory)
+from src.train_policy import create_arg_parser as create_policy_arg_parser
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def trajectory_gradients(args, recon_model, model, data, data_range_dict):
+    # Policy gradients of a single non-greedy trajectory of a batch, as computed in train_policy.train_epoch
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = data
+    kspace = kspace.unsqueeze(1).to(args.device)
+    masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
+    mask = mask.unsqueeze(1).to(args.device)
+    zf = zf.unsqueeze(1).to(args.device)
+    gt = gt.unsqueeze(1).to(args.device)
+    gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    unnorm_gt = gt * gt_std + gt_mean
+    data_range = torch.stack([data_range_dict[vol] for vol in fname])
+
+    seed_everything(args.seed)  # Same sampled actions in both paths
+    recons, features = compute_initial_reconstruction(recon_model, zf, mask, return_features=True)
+    model.zero_grad()
+    action_list, logprob_list, reward_list, score_list, state_list = [], [], [], [], []
+    for step in range(args.acquisition_steps):
+        loss, mask, masked_kspace, recons, features = compute_backprop_trajectory(
+            args, kspace, masked_kspace, mask, unnorm_gt, recons, gt_mean, gt_std, data_range, model, recon_model,
+            step, action_list, logprob_list, reward_list, score_list=score_list, state_list=state_list,
+            features=features)
+    return {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+
+
+def main(args):
+    logger.info(args)
+    seed_everything(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = pathlib.Path(tmp_dir)
+        checkpoint = create_random_data(args, data_dir)
+        policy_args = create_policy_arg_parser().parse_args([
+            '--data_path', str(data_dir), '--recon_model_checkpoint', str(checkpoint), '--device', args.device,
+            '--resolution', str(args.resolution), '--batch_size', str(args.batch_size), '--sample_rate', '1',
+            '--acquisition_steps', str(args.acquisition_steps), '--num_trajectories', str(args.num_trajectories),
+            '--model_type', 'nongreedy', '--gamma', str(args.gamma), '--drop_prob', '0', '--num_workers', '0',
+            '--data_parallel', 'False', '--replay_chunk_size', str(args.replay_chunk_size)])
+        policy_args.seed = args.seed
+        policy_args = add_mask_params(policy_args)
+        _, recon_model = load_recon_model(policy_args)
+        model = build_policy_model(policy_args)
+        model.train()
+
+        loader = create_data_loader(policy_args, 'train', shuffle=False)
+        data_range_dict = create_data_range_dict(policy_args, loader)
+        data = next(iter(loader))
+
+        policy_args.transition_replay = False
+        grads = trajectory_gradients(policy_args, recon_model, model, data, data_range_dict)
+        policy_args.transition_replay = True
+        replay_grads = trajectory_gradients(policy_args, recon_model, model, data, data_range_dict)
+
+    assert grads.keys() == replay_grads.keys(), 'Transition replay computes gradients of different parameters.'
+    scale = max(grad.abs().max().item() for grad in grads.values())
+    error = max((grads[name] - replay_grads[name]).abs().max().item() for name in grads)
+    logger.info(f'Max abs gradient {scale:.2e}, max abs difference with transition replay {error:.2e}')
+    assert all(torch.isfinite(grad).all() for grad in replay_grads.values()), 'Transition replay gives NaN gradients.'
+    assert error <= args.tolerance * max(scale, 1e-12), \
+        f'Transition replay gradients deviate by {error:.2e} (relative tolerance {args.tolerance:.0e}).'
+    logger.info('Transition replay gives the same gradients.')
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Checks that non-greedy training with transition replay gives the '
+                                                 'same policy gradients as keeping the computational graph over the '
+                                                 'trajectory, on a batch of random volumes with a randomly '
+                                                 'initialised reconstruction model.')
+    parser.add_argument('--num_volumes', default=2, type=int, help='Number of random volumes.')
+    parser.add_argument('--num_slices', default=4, type=int,
+                        help='Number of slices per random volume (only the center half is used).')
+    parser.add_argument('--resolution', default=64, type=int, help='Resolution of images')
+    parser.add_argument('--batch_size', default=4, type=int, help='Mini batch size')
+    parser.add_argument('--acquisition_steps', default=4, type=int, help='Acquisition steps per image.')
+    parser.add_argument('--num_trajectories', default=4, type=int, help='Number of trajectories per slice.')
+    parser.add_argument('--gamma', default=0.9, type=float, help='Discount factor.')
+    parser.add_argument('--replay_chunk_size', default=5, type=int,
+                        help='States per replayed policy forward pass, to also check chunking.')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='Maximum allowed difference between the gradients, relative to the largest gradient.')
+    parser.add_argument('--seed', default=1, type=int, help='Seed for random number generators.')
+    parser.add_argument('--device', type=str, default='cpu', help='Which device to run on.')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
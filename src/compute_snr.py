@@ -14,9 +14,12 @@ import torch
 
 from src.helpers.torch_metrics import compute_ssim
 from src.helpers.data_loading import create_data_loader
-from src.helpers.utils import load_json, save_json, str2bool
-from src.reconstruction_model.reconstruction_model_utils import load_recon_model
-from src.policy_model.policy_model_utils import build_optim, create_data_range_dict, compute_backprop_trajectory
+from src.helpers.utils import load_json, save_json, str2bool, str2none
+from src.helpers.distributed import (init_distributed, is_distributed, is_main_process, wrap_model, load_state_dict,
+                                     barrier)
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, build_recon_cache, with_features
+from src.policy_model.policy_model_utils import (build_optim, create_data_range_dict, compute_backprop_trajectory,
+                                                 compute_initial_reconstruction)
 from src.policy_model.policy_model_def import build_policy_model
 
 
@@ -40,9 +43,10 @@ def load_policy_model(checkpoint_file):
         else:
             param.requires_grad = False
 
-    if args.data_parallel:
+    # Loads checkpoints saved with or without a (Distributed)DataParallel wrapper
+    load_state_dict(model, checkpoint['model'])
+    if args.data_parallel and not is_distributed():
         model = torch.nn.DataParallel(model)
-    model.load_state_dict(checkpoint['model'])
 
     optimizer = build_optim(args, model.parameters())
     optimizer.load_state_dict(checkpoint['optimizer'])
@@ -94,12 +98,22 @@ def compute_snr(args, weight_path, bias_path):
 
 
 def add_base_args(args, policy_args):
-    # Batch size has to be set to match those in args.
-    policy_args.batch_size = args.batch_size
+    # Batch size has to be set to match those in args. With torchrun, every process computes an equal part of a batch,
+    # and DistributedDataParallel averages their gradients.
+    assert args.batch_size % args.world_size == 0, 'Batch size must be divisible by the number of processes.'
+    policy_args.batch_size = args.batch_size // args.world_size
     policy_args.batches_step = args.batches_step
     policy_args.num_trajectories = args.num_trajectories
-
-    # Fix paths to those on the running machine
+    policy_args.dedup_actions = args.dedup_actions
+    policy_args.chunk_memory_mb = args.chunk_memory_mb
+    policy_args.transition_replay = args.transition_replay
+    policy_args.replay_chunk_size = args.replay_chunk_size
+    policy_args.world_size = args.world_size
+    policy_args.rank = args.rank
+    policy_args.local_rank = args.local_rank
+
+    # Fix paths and device to those on the running machine
+    policy_args.device = args.device
     policy_args.policy_model_checkpoint = args.policy_model_checkpoint
     policy_args.recon_model_checkpoint = args.recon_model_checkpoint
     policy_args.data_path = args.data_path
@@ -141,11 +155,13 @@ def compute_gradients(args, epoch):
             weight_grads = full_weight_grads[:grads_per_run * args.data_runs]
             bias_grads = full_bias_grads[:grads_per_run * args.data_runs]
 
-            print(f" Saving only grads of run {args.data_runs} to: \n       {param_dir}")
-            with open(weight_path, 'wb') as f:
-                pickle.dump(weight_grads, f)
-            with open(bias_path, 'wb') as f:
-                pickle.dump(bias_grads, f)
+            if is_main_process():
+                print(f" Saving only grads of run {args.data_runs} to: \n       {param_dir}")
+                with open(weight_path, 'wb') as f:
+                    pickle.dump(weight_grads, f)
+                with open(bias_path, 'wb') as f:
+                    pickle.dump(bias_grads, f)
+            barrier()
             return weight_path, bias_path, param_dir
 
     start_run = 0
@@ -171,7 +187,15 @@ def compute_gradients(args, epoch):
 
     model, policy_args, start_epoch, optimiser = load_policy_model(args.policy_model_checkpoint)
     add_base_args(args, policy_args)
+    if is_distributed():
+        assert policy_args.model_type == 'greedy' or policy_args.transition_replay, \
+            'Distributed non-greedy gradients require transition_replay.'
+        model = wrap_model(policy_args, model)
     recon_args, recon_model = load_recon_model(policy_args)
+    cache = build_recon_cache(args)
+    if getattr(policy_args, 'policy_input', 'recon') == 'recon_features':
+        assert cache is None, 'Policies on reconstruction features do not support the reconstruction cache.'
+        recon_model = with_features(recon_model)
 
     loader = create_data_loader(policy_args, 'train', shuffle=True)
     data_range_dict = create_data_range_dict(policy_args, loader)
@@ -195,7 +219,9 @@ def compute_gradients(args, epoch):
             gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(policy_args.device)
             unnorm_gt = gt * gt_std + gt_mean
             data_range = torch.stack([data_range_dict[vol] for vol in fname])
-            recons = recon_model(zf)
+            slice_ids = list(zip(fname, sl_idx.tolist()))
+            recons, features = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids,
+                                                              return_features=True)
 
             if cbatch == 1:
                 optimiser.zero_grad()
@@ -203,12 +229,13 @@ def compute_gradients(args, epoch):
             action_list = []
             logprob_list = []
             reward_list = []
+            score_list = []
+            state_list = []
             for step in range(policy_args.acquisition_steps):  # Loop over acquisition steps
-                loss, mask, masked_kspace, recons = compute_backprop_trajectory(policy_args, kspace, masked_kspace,
-                                                                                mask, unnorm_gt, recons, gt_mean,
-                                                                                gt_std, data_range, model, recon_model,
-                                                                                step, action_list, logprob_list,
-                                                                                reward_list)
+                loss, mask, masked_kspace, recons, features = compute_backprop_trajectory(
+                    policy_args, kspace, masked_kspace, mask, unnorm_gt, recons, gt_mean, gt_std, data_range, model,
+                    recon_model, step, action_list, logprob_list, reward_list, cache=cache, slice_ids=slice_ids,
+                    score_list=score_list, state_list=state_list, features=features)
 
             if cbatch == policy_args.batches_step:
                 # Store gradients for SNR
@@ -220,11 +247,14 @@ def compute_gradients(args, epoch):
                         bias_grads.append(param.grad.cpu().numpy())
                 cbatch = 0
 
-        print(f"    - Adding grads of run {r + 1} to: \n       {param_dir}")
-        with open(weight_path, 'wb') as f:
-            pickle.dump(weight_grads, f)
-        with open(bias_path, 'wb') as f:
-            pickle.dump(bias_grads, f)
+        # Gradients are the same on all processes after the DistributedDataParallel average
+        if is_main_process():
+            print(f"    - Adding grads of run {r + 1} to: \n       {param_dir}")
+            with open(weight_path, 'wb') as f:
+                pickle.dump(weight_grads, f)
+            with open(bias_path, 'wb') as f:
+                pickle.dump(bias_grads, f)
+        barrier()
 
     return weight_path, bias_path, param_dir
 
@@ -265,6 +295,8 @@ def main(base_args):
             print(pr_str)
 
             weight_path, bias_path, param_dir = compute_gradients(args, epoch)
+            if not is_main_process():
+                continue
             snr, std = compute_snr(args, weight_path, bias_path)
 
             summary_dict = {'snr': str(snr),
@@ -281,6 +313,8 @@ def main(base_args):
                                                         'snr_std': str(std)}
             print(f'SNR: {snr}, STD: {std}')
 
+    if not is_main_process():
+        return
     savestr = f'{datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}.json'
     save_dir = pathlib.Path(os.getcwd()) / f'snr_results'
     save_dir.mkdir(parents=True, exist_ok=True)
@@ -314,6 +348,28 @@ def create_arg_parser():
     parser.add_argument('--num_trajectories', type=int, default=16,
                         help='Number of trajectories to sample SNR.')
 
+    parser.add_argument('--dedup_actions', type=str2bool, default=False,
+                        help='Whether to only reconstruct unique sampled actions. Does not change gradients.')
+
+    parser.add_argument('--chunk_memory_mb', type=float, default=0,
+                        help='Memory budget (in MB) for reconstructing and scoring sampled trajectories in '
+                             'micro-batches. Set to 0 to process everything at once.')
+    parser.add_argument('--recon_cache_mb', type=float, default=0,
+                        help='Memory (in MB) for an LRU cache of reconstructions, keyed by slice and acquired rows. '
+                             'Set to 0 to disable.')
+    parser.add_argument('--transition_replay', type=str2bool, default=False,
+                        help='Non-greedy models only. If set, log-probabilities are recomputed from stored transitions '
+                             'at the end of the trajectory (see train_policy.py).')
+    parser.add_argument('--replay_chunk_size', type=int, default=0,
+                        help="Maximum number of states per policy forward and backward pass with 'transition_replay'. "
+                             "Set to 0 to process all states of a trajectory at once.")
+
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='Which device to compute gradients on. Set to "cuda" to use the GPU')
+    parser.add_argument('--dist_backend', type=str2none, default=None,
+                        help="Backend of torchrun processes. Defaults to 'nccl' if device is 'cuda', else 'gloo'. "
+                             "'batch_size' is the total over all processes.")
+
     parser.add_argument('--epochs', nargs='+', type=int, default=[0, 9, 19, 29, 39, 49],
                         help='Epochs at which to calculate SNR.')
     parser.add_argument('--force_computation', type=str2bool, default=False,
@@ -332,12 +388,15 @@ if __name__ == "__main__":
     torch.multiprocessing.set_start_method('spawn')
 
     base_args = create_arg_parser().parse_args()
+    # Sets up one process per torchrun worker, if launched with torchrun
+    init_distributed(base_args)
 
     if base_args.seed != 0:
-        random.seed(base_args.seed)
-        np.random.seed(base_args.seed)
-        torch.manual_seed(base_args.seed)
+        # Different seed per process, such that processes sample different trajectories
+        random.seed(base_args.seed + base_args.rank)
+        np.random.seed(base_args.seed + base_args.rank)
+        torch.manual_seed(base_args.seed + base_args.rank)
         if base_args.device == 'cuda':
-            torch.cuda.manual_seed(base_args.seed)
+            torch.cuda.manual_seed(base_args.seed + base_args.rank)
 
     main(base_args)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import copy
+import logging
+import pathlib
+import argparse
+
+import torch
+
+from src.helpers.utils import save_json, str2none, time_function
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.reconstruction_model.onnx_inference import export_onnx, OnnxReconstructionModel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def time_model(args, model, zf):
+    # Average wall time per call in seconds, after a warmup call
+    with torch.no_grad():
+        return time_function(lambda: model(zf), args.repeats, warmup=1)[1]
+
+
+def compare(args, model, onnx_model, resolution):
+    """
+    Checks that ONNX Runtime gives the same reconstructions as the torch model for every batch size (other than the
+    batch size used for export, so that the batch dimension is known to be dynamic), and compares their latency and
+    throughput on CPU.
+    """
+    report = {}
+    for batch_size in args.batch_sizes:
+        zf = torch.randn(batch_size, 1, resolution, resolution)
+        with torch.no_grad():
+            error = (model(zf) - onnx_model(zf)).abs().max().item()
+        torch_latency, onnx_latency = time_model(args, model, zf), time_model(args, onnx_model, zf)
+        report[batch_size] = {'max_abs_error': error, 'torch_latency_ms': torch_latency * 1000,
+                              'onnx_latency_ms': onnx_latency * 1000, 'torch_throughput': batch_size / torch_latency,
+                              'onnx_throughput': batch_size / onnx_latency}
+        logger.info(f'Batch {batch_size:>3}: torch {torch_latency * 1000:8.2f}ms ({batch_size / torch_latency:.1f} '
+                    f'slices/s), ONNX Runtime {onnx_latency * 1000:8.2f}ms ({batch_size / onnx_latency:.1f} slices/s), '
+                    f'speedup {torch_latency / onnx_latency:.2f}x, max abs error {error:.2e}')
+        assert error < args.tolerance, f'ONNX Runtime deviates from torch by {error:.2e} at batch size {batch_size}.'
+    return report
+
+
+def main(args):
+    logger.info(args)
+    torch.set_num_threads(args.num_threads)
+    recon_args, model = load_recon_model(args)
+    model = model.module if isinstance(model, torch.nn.DataParallel) else model
+    model = model.cpu().eval()
+    onnx_bytes = export_onnx(model, recon_args.resolution, args.opset_version)
+
+    out_path = args.out_path or args.recon_model_checkpoint.parent / 'model.onnx'
+    with open(out_path, 'wb') as f:
+        f.write(onnx_bytes)
+    # Checkpoint for load_recon_model, so that train_policy.py and run_baseline_models.py can use the ONNX model
+    onnx_args = copy.deepcopy(recon_args)
+    onnx_args.onnx = True
+    onnx_args.data_parallel = False
+    checkpoint_path = out_path.parent / (out_path.stem + '_onnx.pt')
+    torch.save({'epoch': 0, 'args': onnx_args, 'model': onnx_bytes, 'exp_dir': out_path.parent}, f=checkpoint_path)
+    logger.info(f'Saved ONNX graph to {out_path}, and a reconstruction model checkpoint using it to {checkpoint_path}')
+
+    onnx_model = OnnxReconstructionModel(onnx_bytes, 'cpu', args.num_threads)
+    report = compare(args, model, onnx_model, recon_args.resolution)
+    if args.report_path is not None:
+        save_json(args.report_path, dict(args={key: str(value) for key, value in vars(args).items()},
+                                         results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Exports a trained reconstruction model to ONNX with a dynamic batch '
+                                                 'dimension, checks parity of ONNX Runtime with torch, and compares '
+                                                 'their CPU latency and throughput for several batch sizes.')
+    parser.add_argument('--recon_model_checkpoint', type=pathlib.Path, required=True,
+                        help='Path to a pretrained reconstruction model.')
+    parser.add_argument('--out_path', type=pathlib.Path, default=None,
+                        help='Path of the ONNX graph. Defaults to model.onnx next to the checkpoint. A checkpoint that '
+                             'loads the graph with ONNX Runtime (to pass as recon_model_checkpoint) is stored next to '
+                             'it, as <name>_onnx.pt.')
+    parser.add_argument('--opset_version', type=int, default=11, help='ONNX opset version to export to.')
+    parser.add_argument('--batch_sizes', nargs='+', default=[1, 16, 128], type=int,
+                        help='Batch sizes (slices x trajectories in a rollout step) to check and time.')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='Maximum allowed absolute difference between ONNX Runtime and torch outputs.')
+    parser.add_argument('--repeats', default=10, type=int, help='Number of timed calls per batch size.')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='Number of CPU threads of both torch and ONNX Runtime.')
+    parser.add_argument('--report_path', type=str2none, default=None,
+                        help='Optional path of a json file for the report.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    args.device = 'cpu'
+    main(args)
@@ -0,0 +1,82 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Measured memory footprint (in bytes) per sample, keyed by (name, sample shape, device)
+_footprints = {}
+
+
+def measure_footprint(fn, inputs):
+    """
+    Measures the peak memory used by fn(*inputs), per sample along the first dimension of inputs.
+
+    On CUDA this uses the allocator's peak memory statistics. On CPU this sums all allocations recorded by the
+    autograd profiler, which overestimates the peak and thus gives a conservative chunk size.
+    """
+    num_samples = inputs[0].size(0)
+    device = inputs[0].device
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn(*inputs)
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device) - base
+    else:
+        try:
+            with torch.autograd.profiler.profile(profile_memory=True) as prof:
+                fn(*inputs)
+            peak = sum(max(event.self_cpu_memory_usage, 0) for event in prof.function_events)
+        except (AttributeError, TypeError, RuntimeError) as e:
+            logger.warning(f'Could not measure CPU memory footprint ({e}): not chunking.')
+            peak = 0
+    return peak / num_samples
+
+
+def get_chunk_size(fn, inputs, memory_mb, name):
+    """
+    Returns the number of samples of fn(*inputs) that fit within memory_mb, measuring the per-sample footprint of fn
+    on a small probe batch the first time a (name, sample shape, device) combination is seen.
+    """
+    key = (name, tuple(inputs[0].shape[1:]), str(inputs[0].device))
+    if key not in _footprints:
+        probe = [x[:2] for x in inputs]
+        _footprints[key] = measure_footprint(fn, probe)
+        chunk_size = int(memory_mb * 1024 ** 2 // _footprints[key]) if _footprints[key] > 0 else None
+        logger.info(f'Chunked execution of {name}: {_footprints[key] / 1024 ** 2:.2f}MB per sample, '
+                    f'chunk size {chunk_size} for a budget of {memory_mb}MB.')
+    if _footprints[key] <= 0:
+        return inputs[0].size(0)
+    return max(1, int(memory_mb * 1024 ** 2 // _footprints[key]))
+
+
+def run_in_chunks(fn, inputs, memory_mb, name):
+    """
+    Applies fn to inputs in micro-batches along the first dimension, such that the memory used by a single call stays
+    within memory_mb, and concatenates the results.
+
+    Args:
+        fn (callable): Function of tensors that share their first (batch) dimension. Returns a tensor or a tuple of
+            tensors that share the same first dimension.
+        inputs (iterable[torch.Tensor]): Inputs to fn.
+        memory_mb (float): Memory budget in MB for a single call of fn. Set to 0 to run on all inputs at once.
+        name (str): Name of fn, used to store its measured memory footprint.
+
+    Returns:
+        (torch.Tensor or tuple): Same as fn(*inputs).
+    """
+    inputs = list(inputs)
+    num_samples = inputs[0].size(0)
+    if memory_mb <= 0 or num_samples <= 1:
+        return fn(*inputs)
+
+    chunk_size = get_chunk_size(fn, inputs, memory_mb, name)
+    if chunk_size >= num_samples:
+        return fn(*inputs)
+
+    outputs = [fn(*[x[i:i + chunk_size] for x in inputs]) for i in range(0, num_samples, chunk_size)]
+    if isinstance(outputs[0], tuple):
+        return tuple(torch.cat(out, dim=0) for out in zip(*outputs))
+    return torch.cat(outputs, dim=0)
@@ -0,0 +1,154 @@
+import os
+import glob
+import logging
+import functools
+
+import torch
+
+from src.helpers.utils import str2bool, str2none
+
+logger = logging.getLogger(__name__)
+
+
+def add_cpu_profile_args(parser):
+    parser.add_argument('--cpu_profile', type=str2bool, default=False,
+                        help='Run on CPU only with an explicit thread layout: sets device to cpu, disables '
+                             'DataParallel and pinned memory, divides the cores over compute threads and data loading '
+                             'workers, and optionally pins both (see the arguments below). The layout is reported at '
+                             'startup.')
+    parser.add_argument('--compute_threads', type=int, default=0,
+                        help="Number of intra-op compute threads with 'cpu_profile'. Set to 0 to use all cores that "
+                             "are not used by data loading workers.")
+    parser.add_argument('--interop_threads', type=int, default=1,
+                        help="Number of inter-op threads with 'cpu_profile'. Rollouts have no independent operators "
+                             "to run in parallel.")
+    parser.add_argument('--numa_node', type=int, default=None,
+                        help="Only use the cores of this NUMA node with 'cpu_profile' (Linux only).")
+    parser.add_argument('--pin_cores', type=str2bool, default=False,
+                        help="Pin compute threads and data loading workers to their cores with 'cpu_profile'.")
+    parser.add_argument('--compute_cores', type=str2none, default=None,
+                        help="Cores for compute threads with 'cpu_profile', e.g. '0-13'. Defaults to the first "
+                             "available cores.")
+    parser.add_argument('--worker_cores', type=str2none, default=None,
+                        help="Cores for data loading workers with 'cpu_profile', e.g. '14-15'. Defaults to the "
+                             "available cores that are not used for compute.")
+    parser.add_argument('--channels_last', type=str2bool, default=True,
+                        help="Use the channels_last memory format for the convolutional models with 'cpu_profile'.")
+    return parser
+
+
+def parse_cores(cores):
+    # Core list in the format used by /sys and taskset, e.g. '0-3,8,10-11'
+    result = []
+    for part in cores.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            result.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            result.append(int(part))
+    return result
+
+
+def format_cores(cores):
+    # Inverse of parse_cores
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(start) if start == end else f'{start}-{end}' for start, end in ranges)
+
+
+def get_numa_nodes():
+    # Cores of every NUMA node as {node: cores}, empty if the system does not expose them (Linux only)
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        with open(path) as f:
+            nodes[int(path.split('/')[-2][len('node'):])] = parse_cores(f.read().strip())
+    return nodes
+
+
+def get_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def init_cpu_worker(worker_cores, worker_id):
+    # worker_init_fn of data loading workers: single threaded, and pinned to worker_cores if given
+    torch.set_num_threads(1)
+    if worker_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cores)
+
+
+def get_worker_init_fn(args):
+    # Not all scripts (or stored model arguments) define the CPU profile arguments
+    if not getattr(args, 'cpu_profile', False):
+        return None
+    return functools.partial(init_cpu_worker, getattr(args, 'worker_core_list', None))
+
+
+def apply_cpu_profile(args):
+    """
+    Configures this process according to the CPU profile arguments (see add_cpu_profile_args), and sets
+    args.pin_memory and args.worker_core_list for create_data_loader. Does nothing else if args.cpu_profile is not
+    set. Should be called before any models are built or data is loaded, and before init_distributed: processes
+    launched with torchrun on the same machine get disjoint sets of cores.
+    """
+    args.pin_memory = not args.cpu_profile
+    args.worker_core_list = None
+    if not args.cpu_profile:
+        return args
+    args.device = 'cpu'
+    args.data_parallel = False
+
+    cores = get_available_cores()
+    nodes = get_numa_nodes()
+    if args.numa_node is not None:
+        assert args.numa_node in nodes, f'NUMA node {args.numa_node} not found, available: {sorted(nodes)}'
+        cores = [core for core in cores if core in nodes[args.numa_node]]
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size > 1:
+        per_process = max(1, len(cores) // local_world_size)
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        cores = cores[local_rank * per_process:(local_rank + 1) * per_process] or cores[-1:]
+
+    # Every data loading worker gets a core of its own, the remaining cores are for compute
+    if args.compute_cores is not None:
+        compute_cores = parse_cores(args.compute_cores)
+    else:
+        num_compute = args.compute_threads or max(1, len(cores) - args.num_workers)
+        compute_cores = cores[:num_compute]
+    if args.worker_cores is not None:
+        worker_cores = parse_cores(args.worker_cores)
+    else:
+        worker_cores = [core for core in cores if core not in compute_cores] or compute_cores
+    compute_threads = args.compute_threads or len(compute_cores)
+
+    torch.set_num_threads(compute_threads)
+    try:
+        torch.set_num_interop_threads(args.interop_threads)
+    except RuntimeError:  # Can only be set once per process, before any inter-op parallel work
+        logger.warning(f'Could not set the number of inter-op threads, using {torch.get_num_interop_threads()}.')
+    if args.pin_cores and hasattr(os, 'sched_setaffinity'):
+        # Threads created from here on inherit the affinity of this process
+        os.sched_setaffinity(0, compute_cores)
+        args.worker_core_list = worker_cores
+
+    node_str = f' of NUMA node {args.numa_node}' if args.numa_node is not None else ''
+    logger.info(f'CPU profile: {len(cores)} cores{node_str} for this process ({len(nodes) or 1} NUMA node(s) in total)')
+    logger.info(f'  compute: {torch.get_num_threads()} intra-op threads, {torch.get_num_interop_threads()} inter-op '
+                f'threads, {"pinned to" if args.pin_cores else "intended for"} cores {format_cores(compute_cores)}')
+    logger.info(f'  data loading: {args.num_workers} single threaded workers, '
+                f'{"pinned to" if args.pin_cores else "intended for"} cores {format_cores(worker_cores)}')
+    logger.info(f'  pin_memory = False, channels_last = {args.channels_last}, '
+                f'oneDNN available = {torch.backends.mkldnn.is_available()}')
+    return args
+
+
+def to_channels_last(args, model):
+    # channels_last memory format for the convolutions of model with the CPU profile, where oneDNN prefers it
+    if getattr(args, 'cpu_profile', False) and getattr(args, 'channels_last', False):
+        return model.to(memory_format=torch.channels_last)
+    return model
@@ -4,8 +4,11 @@ import random
 import h5py
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 
 from src.helpers import transforms
+from src.helpers.distributed import is_distributed, get_rank, get_world_size
+from src.helpers.cpu_profile import get_worker_init_fn
 
 
 class SliceData(Dataset):
@@ -13,7 +16,8 @@ class SliceData(Dataset):
     A PyTorch Dataset that provides access to MR image slices.
     """
 
-    def __init__(self, root, transform, dataset, sample_rate=1, acquisition=None, center_volume=False):
+    def __init__(self, root, transform, dataset, sample_rate=1, acquisition=None, center_volume=False, num_shards=1,
+                 shard_index=0):
         """
         Args:
             root (pathlib.Path): Path to the dataset.
@@ -21,6 +25,8 @@ class SliceData(Dataset):
                 appropriate form. The transform function should take 'kspace', 'target',
                 'attributes', 'filename', and 'slice' as inputs. 'target' may be null
                 for test data.
+            num_shards (int): Number of shards to split the (sampled) volumes into.
+            shard_index (int): Index of the shard of volumes to use, in [0, num_shards).
         """
         self.transform = transform
 
@@ -44,7 +50,10 @@ class SliceData(Dataset):
             # Sample data volumes
             num_files = round(len(files) * sample_rate)
             files = files[:num_files]
-        for fname in sorted(files):
+        # Every shard gets a disjoint subset of whole volumes
+        assert 0 <= shard_index < num_shards, f'Invalid shard {shard_index} of {num_shards}'
+        files = sorted(files)[shard_index::num_shards]
+        for fname in files:
             # If 'acquisition' is specified, only slices from volumes that have been gathered using the specified
             # acquisition technique ('CORPD_FBK' or 'CORPDFS_FBK').
             # Brain data uses all acquisition types.
@@ -245,13 +254,22 @@ def create_fastmri_dataset(args, partition):
 
     mask = MaskFunc(args.center_fractions, args.accelerations)
 
+    # Not all scripts (or stored model arguments) define sharding arguments
+    num_shards = getattr(args, 'num_shards', 1)
+    shard_index = getattr(args, 'shard_index', 0)
+    if partition != 'train':
+        # Every process evaluates a disjoint set of whole volumes (training data is split by a DistributedSampler)
+        num_shards, shard_index = num_shards * get_world_size(), shard_index * get_world_size() + get_rank()
+
     dataset = SliceData(
         root=path,
         transform=DataTransform(mask, args.resolution, use_seed=use_seed),
         dataset=args.dataset,
         sample_rate=args.sample_rate,
         acquisition=args.acquisition,
-        center_volume=args.center_volume
+        center_volume=args.center_volume,
+        num_shards=num_shards,
+        shard_index=shard_index
     )
 
     print(f'{partition.capitalize()} slices: {len(dataset)}')
@@ -272,12 +290,21 @@ def create_data_loader(args, partition, shuffle=False, display=False):
     else:
         raise ValueError(f"'partition' should be in ('train', 'val', 'test'), not {partition}")
 
+    sampler = None
+    if is_distributed() and partition.lower() == 'train':
+        # Every process gets an equally sized part of the training data: call sampler.set_epoch() every epoch
+        sampler = DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
+
     loader = DataLoader(
         dataset=dataset,
         batch_size=batch_size,
         shuffle=shuffle,
+        sampler=sampler,
         num_workers=args.num_workers,
-        pin_memory=True,
+        # Pinning only speeds up host to GPU copies (disabled by the CPU profile, see apply_cpu_profile)
+        pin_memory=getattr(args, 'pin_memory', True),
+        worker_init_fn=get_worker_init_fn(args),
     )
     return loader
 
@@ -0,0 +1,97 @@
+import os
+import logging
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(args):
+    """
+    Initialises the default process group from the environment set by torchrun (or by
+    'python -m torch.distributed.launch --use_env' on torch versions without torchrun), and stores rank, world_size and
+    local_rank on args. Uses NCCL when training on GPU and gloo on CPU, unless args.dist_backend is set. Without a
+    launcher (WORLD_SIZE unset or 1) this is a no-op that sets up a single process.
+    """
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if args.world_size == 1:
+        return args
+
+    use_cuda = args.device == 'cuda'
+    backend = getattr(args, 'dist_backend', None) or ('nccl' if use_cuda else 'gloo')
+    if use_cuda:
+        # args.device stays 'cuda': tensors moved there end up on this process' GPU
+        torch.cuda.set_device(args.local_rank)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    # DataParallel inside a DistributedDataParallel process only adds copies
+    args.data_parallel = False
+    logger.info(f'Process {args.rank}/{args.world_size} ({backend}) on {args.device}.')
+    return args
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce(tensor, op='sum'):
+    """ In-place all-reduce of tensor over all processes ('sum' or 'max'). Returns tensor. """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM if op == 'sum' else dist.ReduceOp.MAX)
+    return tensor
+
+
+def wrap_model(args, model):
+    """ Wraps model in DistributedDataParallel when running multi-process, or DataParallel if args.data_parallel. """
+    if is_distributed():
+        device_ids = [args.local_rank] if args.device == 'cuda' else None
+        return DistributedDataParallel(model, device_ids=device_ids)
+    if args.data_parallel:
+        return torch.nn.DataParallel(model)
+    return model
+
+
+def unwrap_model(model):
+    """ Returns the module inside a (Distributed)DataParallel wrapper. """
+    if isinstance(model, (torch.nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def load_state_dict(model, state_dict):
+    """
+    Loads state_dict into model regardless of whether either was saved or created inside a (Distributed)DataParallel
+    wrapper, by adding or stripping the 'module.' prefix of the stored parameter names.
+    """
+    module = unwrap_model(model)
+    state_dict = {(key[len('module.'):] if key.startswith('module.') else key): value
+                  for key, value in state_dict.items()}
+    return module.load_state_dict(state_dict)
+
+
+class NullWriter:
+    """ Stands in for a SummaryWriter on processes other than the main one, which do not log. """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
@@ -0,0 +1,86 @@
+import contextlib
+
+import torch
+from torch import nn
+
+# Precisions of model forwards (and SSIM convolutions) under autocast. FFTs and reward arithmetic stay in float32.
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_precision(args):
+    # Models and scripts from before reduced precision support always used float32
+    return getattr(args, 'precision', 'fp32')
+
+
+def check_precision(args):
+    """ Raises a ValueError if args.precision is not supported on args.device by this version of torch. """
+    precision = get_precision(args)
+    if precision == 'fp32':
+        return
+    if precision == 'fp16' and args.device != 'cuda':
+        raise ValueError("Precision 'fp16' is only supported on GPU: use 'bf16' on CPU.")
+    # torch.autocast (CPU and bf16 support) was added in torch 1.10, before that only CUDA fp16 autocast exists
+    if not hasattr(torch, 'autocast') and not (precision == 'fp16' and args.device == 'cuda'):
+        raise ValueError(f"Precision '{precision}' on {args.device} requires torch >= 1.10.")
+
+
+def autocast(precision, device_type):
+    """
+    Context manager in which eligible operations (convolutions, linear layers) on device_type ('cpu' or 'cuda') run in
+    precision. Does nothing for 'fp32'.
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, dtype=_DTYPES[precision])
+    return torch.cuda.amp.autocast()
+
+
+class AutocastModel(nn.Module):
+    """
+    Runs a frozen model (e.g. the reconstruction model) under autocast, and returns float32 outputs such that
+    everything computed from them (FFTs of the next acquisition step, rewards) stays in float32.
+    """
+
+    def __init__(self, model, precision):
+        super().__init__()
+        self.model = model
+        self.precision = precision
+
+    def forward(self, input):
+        with autocast(self.precision, input.device.type):
+            output = self.model(input)
+        if isinstance(output, tuple):  # Reconstructions and features, see ReconstructionWithFeatures
+            return tuple(out.float() for out in output)
+        return output.float()
+
+
+def apply_precision(args, model):
+    # Wraps a frozen model in AutocastModel if args.precision is reduced
+    precision = get_precision(args)
+    if precision == 'fp32':
+        return model
+    return AutocastModel(model, precision)
+
+
+def build_grad_scaler(args):
+    # Loss scaling against underflowing float16 gradients. bfloat16 has the exponent range of float32: no scaling.
+    if get_precision(args) == 'fp16':
+        return torch.cuda.amp.GradScaler()
+    return None
+
+
+def backward(loss, scaler=None):
+    if scaler is not None:
+        loss = scaler.scale(loss)
+    loss.backward()
+
+
+def optimiser_step(optimiser, scaler=None):
+    # Skips the step if scaled gradients overflowed, and adjusts the scale
+    if scaler is None:
+        optimiser.step()
+    else:
+        scaler.step(optimiser)
+        scaler.update()
@@ -0,0 +1,36 @@
+import h5py
+import numpy as np
+import torch
+
+from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
+
+
+def create_random_data(args, data_dir):
+    """
+    Random knee volumes in the layout expected by create_fastmri_dataset, and a randomly initialised U-Net checkpoint,
+    for benchmarks and checks that do not need real data. Uses args.seed, args.num_volumes, args.num_slices,
+    args.resolution and args.device.
+
+    Returns:
+        (pathlib.Path): Path of the reconstruction model checkpoint in data_dir.
+    """
+    # Imported here, since train_reconstruction.py itself imports from src.helpers
+    from src.train_reconstruction import create_arg_parser as create_recon_arg_parser
+
+    train_dir = data_dir / 'singlecoil_train_al'
+    train_dir.mkdir(parents=True)
+    rng = np.random.RandomState(args.seed)
+    for i in range(args.num_volumes):
+        with h5py.File(train_dir / f'volume{i}.h5', 'w') as f:
+            f.create_dataset('reconstruction_esc', data=rng.rand(args.num_slices, args.resolution,
+                                                                 args.resolution).astype(np.float32))
+            f.attrs['acquisition'] = 'CORPD_FBK'
+
+    recon_args = create_recon_arg_parser().parse_args(['--data_path', str(data_dir), '--device', args.device,
+                                                       '--resolution', str(args.resolution)])
+    recon_args.data_parallel = False
+    recon_model = build_reconstruction_model(recon_args)
+    checkpoint = data_dir / 'recon_model.pt'
+    torch.save({'epoch': 0, 'args': recon_args, 'model': recon_model.state_dict(), 'exp_dir': data_dir},
+               f=checkpoint)
+    return checkpoint
@@ -1,9 +1,15 @@
+import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
 from math import exp
 
-from piq import psnr
+from src.helpers.utils import save_json
+from src.helpers.distributed import is_distributed, all_reduce
+from src.helpers.precision import autocast
+
+# Separable Gaussian windows for SSIM, keyed by (window size, channels, dtype, device)
+_windows = {}
+
 
 def gaussian(window_size, sigma):
     gauss = torch.Tensor([exp(-(x - window_size // 2) ** 2 / float(2 * sigma ** 2)) for x in range(window_size)])
@@ -13,10 +19,21 @@ def gaussian(window_size, sigma):
 def create_window(window_size, channel):
     _1D_window = gaussian(window_size, 1.5).unsqueeze(1)
     _2D_window = _1D_window.mm(_1D_window.t()).float().unsqueeze(0).unsqueeze(0)
-    window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
+    window = _2D_window.expand(channel, 1, window_size, window_size).contiguous()
     return window
 
 
+def get_separable_window(window_size, channel, dtype, device):
+    # Horizontal (5 . channel x 1 x 1 x window_size) and vertical (5 . channel x 1 x window_size x 1) Gaussian windows
+    # for filtering the five SSIM statistics of every channel in a single grouped convolution per direction.
+    key = (window_size, channel, dtype, str(device))
+    if key not in _windows:
+        window = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+        h_window = window.view(1, 1, 1, window_size).expand(5 * channel, 1, 1, window_size).contiguous()
+        _windows[key] = (h_window, h_window.transpose(-1, -2).contiguous())
+    return _windows[key]
+
+
 def _ssim(img1, img2, window, window_size, channel, size_average=True, data_range=None):
     mu1 = F.conv2d(img1, window, padding=window_size // 2, groups=channel)
     mu2 = F.conv2d(img2, window, padding=window_size // 2, groups=channel)
@@ -40,8 +57,46 @@ def _ssim(img1, img2, window, window_size, channel, size_average=True, data_rang
         return ssim_map
 
 
-def compute_ssim(img1, img2, window_size=11, size_average=True, data_range=None):
+def _fused_ssim(img1, img2, window_size, channel, size_average=True, data_range=None, stride=1, precision='fp32'):
+    # Same as _ssim, but the 2D Gaussian filter is applied as two 1D filters (the window is separable), and the five
+    # statistics are filtered together as channels of a single grouped convolution. With stride > 1, the SSIM map is
+    # only computed on a coarse grid of every stride-th pixel. The convolutions run in precision, the SSIM arithmetic
+    # in float32.
+    h_window, v_window = get_separable_window(window_size, channel, img1.dtype, img1.device)
+    stats = torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], dim=1)
+    with autocast(precision, img1.device.type):
+        stats = F.conv2d(stats, h_window, stride=(1, stride), padding=(0, window_size // 2), groups=5 * channel)
+        stats = F.conv2d(stats, v_window, stride=(stride, 1), padding=(window_size // 2, 0), groups=5 * channel)
+    stats = stats.float()
+    mu1, mu2, img1_sq, img2_sq, img12 = torch.split(stats, channel, dim=1)
+
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1 * mu2
+
+    sigma1_sq = img1_sq - mu1_sq
+    sigma2_sq = img2_sq - mu2_sq
+    sigma12 = img12 - mu1_mu2
+
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+
+    if size_average:
+        return ssim_map.mean()
+    else:
+        return ssim_map
+
+
+def compute_ssim(img1, img2, window_size=11, size_average=True, data_range=None, fused=True, stride=1,
+                 precision='fp32'):
+    # If fused is False, the original implementation with five 2D convolutions is used (e.g. for validation).
     (_, channel, _, _) = img1.size()
+    if fused:
+        return _fused_ssim(img1, img2, window_size, channel, size_average, data_range, stride, precision)
+    assert stride == 1 and precision == 'fp32', 'Strided and reduced precision SSIM require fused=True.'
+
     window = create_window(window_size, channel)
 
     if img1.is_cuda:
@@ -51,7 +106,20 @@ def compute_ssim(img1, img2, window_size=11, size_average=True, data_range=None)
     return _ssim(img1, img2, window, window_size, channel, size_average, data_range)
 
 
-def compute_psnr(args, unnorm_recons, gt_exp, data_range):
+def compute_psnr(args, unnorm_recons, gt_exp, data_range, reference=False):
+    # PSNR for every trajectory (batch x trajectories), computed on the device of the reconstructions. Matches
+    # piq.psnr (with reconstructions clamped to [0, 10]), which is used if reference is set (e.g. for validation).
+    if reference:
+        return _piq_psnr(args, unnorm_recons, gt_exp, data_range)
+    recons = torch.clamp(unnorm_recons, 0., 10.) / data_range
+    gt = gt_exp / data_range
+    mse = ((recons - gt) ** 2).mean(dim=(-1, -2))
+    return -10 * torch.log10(mse + 1e-8)
+
+
+def _piq_psnr(args, unnorm_recons, gt_exp, data_range):
+    from piq import psnr
+
     # Have to reshape to batch . trajectories x res x res and then reshape back to batch x trajectories x res x res
     # because of psnr implementation
     psnr_recons = torch.clamp(unnorm_recons, 0., 10.).reshape(gt_exp.size(0) * gt_exp.size(1), 1, args.resolution,
@@ -62,4 +130,142 @@ def compute_psnr(args, unnorm_recons, gt_exp, data_range):
     psnr_data_range = psnr_data_range.reshape(gt_exp.size(0) * gt_exp.size(1), 1, 1, 1).to('cpu')
     psnr_scores = psnr(psnr_recons, psnr_gt, reduction='none', data_range=psnr_data_range)
     psnr_scores = psnr_scores.reshape(gt_exp.size(0), gt_exp.size(1))
-    return psnr_scores
\ No newline at end of file
+    return psnr_scores
+
+
+def rank_correlation(x, y):
+    # Spearman rank correlation between the rows of x and y (batch x num), averaged over rows. Ties are not corrected.
+    x_ranks = x.argsort(dim=1).argsort(dim=1).double()
+    y_ranks = y.argsort(dim=1).argsort(dim=1).double()
+    x_ranks = x_ranks - x_ranks.mean(dim=1, keepdim=True)
+    y_ranks = y_ranks - y_ranks.mean(dim=1, keepdim=True)
+    corr = (x_ranks * y_ranks).sum(dim=1) / (x_ranks.norm(dim=1) * y_ranks.norm(dim=1))
+    return corr.mean().item()
+
+
+def compute_volume_ssim(gt, pred, win_size=7):
+    """
+    SSIM of a volume (slices x height x width), equal to skimage's
+    structural_similarity(gt.transpose(1, 2, 0), pred.transpose(1, 2, 0), multichannel=True, data_range=gt.max())
+    with its default uniform window and sample covariance. Computed in double precision, the difference with skimage
+    is below 1e-6 (see benchmark_metrics.py).
+    """
+    gt = torch.as_tensor(gt, dtype=torch.float64).unsqueeze(1)
+    pred = torch.as_tensor(pred, dtype=torch.float64).unsqueeze(1)
+    data_range = gt.max()
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+
+    # skimage crops (win_size - 1) // 2 pixels at the borders, which leaves exactly the windows without padding
+    def filt(x):
+        return F.avg_pool2d(x, win_size, stride=1)
+
+    ux, uy = filt(gt), filt(pred)
+    vx = cov_norm * (filt(gt * gt) - ux * ux)
+    vy = cov_norm * (filt(pred * pred) - uy * uy)
+    vxy = cov_norm * (filt(gt * pred) - ux * uy)
+
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+
+    ssim_map = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+    # Mean over every slice, then over slices: slices all have the same size, so this is the mean of the map
+    return ssim_map.mean().item()
+
+
+class StepMetrics:
+    """
+    Maintains running sums (and optionally sums of squares) of metrics for every acquisition step as tensors on the
+    device, so that adding scores does not require a device sync. The statistics are copied to the CPU once, when
+    they are first requested.
+    """
+
+    def __init__(self, names, num_steps, device, squares=False):
+        self.names = list(names)
+        self.sums = torch.zeros((len(self.names), num_steps), dtype=torch.float64, device=device)
+        self.sq_sums = torch.zeros_like(self.sums) if squares else None
+        self.counts = np.zeros((len(self.names), num_steps))
+        self._synced = None
+
+    def push(self, name, scores, step=0):
+        # Adds scores of shape batch (for a single step) or batch x steps (for consecutive steps, starting at step)
+        scores = scores.detach().double().to(self.sums.device)
+        if scores.dim() == 1:
+            scores = scores.unsqueeze(1)
+        idx = self.names.index(name)
+        steps = slice(step, step + scores.size(1))
+        self.sums[idx, steps] += scores.sum(dim=0)
+        if self.sq_sums is not None:
+            self.sq_sums[idx, steps] += (scores ** 2).sum(dim=0)
+        self.counts[idx, steps] += scores.size(0)
+        self._synced = None
+
+    def all_reduce(self):
+        # Sums the statistics of all processes when evaluating a shard of the data per process
+        if not is_distributed():
+            return self
+        counts = torch.from_numpy(self.counts).to(self.sums.device)
+        for stats in (self.sums, self.sq_sums, counts):
+            if stats is not None:
+                all_reduce(stats)
+        self.counts = counts.cpu().numpy()
+        self._synced = None
+        return self
+
+    def _sync(self):
+        if self._synced is None:
+            stats = self.sums if self.sq_sums is None else torch.stack([self.sums, self.sq_sums])
+            self._synced = stats.cpu().numpy()
+        return self._synced if self.sq_sums is None else self._synced[0]
+
+    def state_dict(self):
+        # Sufficient statistics, e.g. to store the results of an evaluation shard
+        sums = self._sync()
+        state = {'names': self.names, 'sums': sums.tolist(), 'counts': self.counts.tolist()}
+        if self.sq_sums is not None:
+            state['sq_sums'] = self._synced[1].tolist()
+        return state
+
+    def save(self, path, **info):
+        # Stores the sufficient statistics along with info describing them (e.g. the evaluation shard)
+        save_json(path, dict(info, stats=self.state_dict()))
+
+    @classmethod
+    def from_state_dicts(cls, states):
+        """
+        Combines the statistics of state_dict() outputs, e.g. of evaluation shards. Sums of squares are only kept if
+        all states have them.
+        """
+        names = states[0]['names']
+        assert all(state['names'] == names for state in states), 'Cannot merge statistics of different metrics.'
+        squares = all('sq_sums' in state for state in states)
+        sums = np.array(states[0]['sums'])
+        metrics = cls(names, sums.shape[1], 'cpu', squares=squares)
+        metrics.sums = torch.from_numpy(np.sum([state['sums'] for state in states], axis=0))
+        if squares:
+            metrics.sq_sums = torch.from_numpy(np.sum([state['sq_sums'] for state in states], axis=0))
+        metrics.counts = np.sum([state['counts'] for state in states], axis=0)
+        return metrics
+
+    def totals(self):
+        sums = self._sync()
+        return {name: sums[i] for i, name in enumerate(self.names)}
+
+    def means(self):
+        sums = self._sync()
+        return {name: sums[i] / self.counts[i] for i, name in enumerate(self.names)}
+
+    def stddevs(self):
+        assert self.sq_sums is not None, 'Sums of squares are required for standard deviations.'
+        sums = self._sync()
+        sq_sums = self._synced[1]
+        stddevs = {}
+        for i, name in enumerate(self.names):
+            n = self.counts[i]
+            var = (sq_sums[i] - sums[i] ** 2 / n) / np.maximum(n - 1, 1)
+            stddevs[name] = np.sqrt(np.maximum(var, 0.))
+        return stddevs
+
+    def confidence_intervals(self, z=1.96):
+        # Half width of the (normal approximation) confidence interval of every mean, 95% by default
+        return {name: z * stddev / np.sqrt(self.counts[self.names.index(name)])
+                for name, stddev in self.stddevs().items()}
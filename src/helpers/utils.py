@@ -1,4 +1,8 @@
 import json
+import time
+import random
+
+import numpy as np
 import torch
 
 
@@ -72,4 +76,31 @@ def add_mask_params(args):
 
 def build_optim(args, params):
     optimiser = torch.optim.Adam(params, args.lr, weight_decay=args.weight_decay)
-    return optimiser
\ No newline at end of file
+    return optimiser
+
+
+def seed_everything(seed):
+    # Seeds the random number generators of Python, numpy and torch
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def time_function(fn, repeats=1, warmup=0, device='cpu'):
+    """
+    Calls fn warmup times, then times repeats calls of fn. CUDA work is synchronised before the timer is started and
+    stopped.
+
+    Returns:
+        (tuple): Output of the last call of fn, and the average wall time per timed call in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = fn()
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+    return output, (time.perf_counter() - start) / repeats
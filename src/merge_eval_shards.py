@@ -0,0 +1,64 @@
+import logging
+import argparse
+import pathlib
+
+from src.helpers.torch_metrics import StepMetrics
+from src.helpers.utils import load_json, save_json
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_shards(shard_files):
+    """
+    Loads shard statistics stored by train_policy.py (testing) or run_baseline_models.py, and checks that they belong
+    to the same evaluation and do not overlap. Shards are returned ordered by shard index, so that merging them always
+    sums in the same order.
+    """
+    shards = [load_json(path) for path in shard_files]
+    for key in ['name', 'partition', 'num_shards']:
+        values = set(shard[key] for shard in shards)
+        assert len(values) == 1, f"Shards have different values for '{key}': {values}"
+    indices = [shard['shard_index'] for shard in shards]
+    assert len(set(indices)) == len(indices), f'Duplicate shards: {sorted(indices)}'
+    missing = sorted(set(range(shards[0]['num_shards'])) - set(indices))
+    if missing:
+        logger.warning(f'Missing shards {missing} of {shards[0]["num_shards"]}: results only cover part of the data.')
+    return sorted(shards, key=lambda shard: shard['shard_index'])
+
+
+def main(args):
+    shards = load_shards(args.shard_files)
+    metrics = StepMetrics.from_state_dicts([shard['stats'] for shard in shards])
+
+    means = metrics.means()
+    logging.info(f"{shards[0]['name']} on {shards[0]['partition']}: {len(shards)} of {shards[0]['num_shards']} shards, "
+                 f"{int(metrics.counts[0, 0])} slices")
+    for name in metrics.names:
+        values_str = ", ".join(["{}: {:.4f}".format(i, l) for i, l in enumerate(means[name])])
+        logging.info(f'  {name.upper()} = [{values_str}]')
+    if metrics.sq_sums is not None:
+        cis = metrics.confidence_intervals()
+        for name in metrics.names:
+            values_str = ", ".join(["{}: {:.4f}".format(i, l) for i, l in enumerate(cis[name])])
+            logging.info(f'  {name.upper()} 95% CI half width = [{values_str}]')
+
+    if args.out_path is not None:
+        save_json(args.out_path, {'name': shards[0]['name'], 'partition': shards[0]['partition'],
+                                  'num_shards': shards[0]['num_shards'],
+                                  'shard_indices': [shard['shard_index'] for shard in shards],
+                                  'means': {name: values.tolist() for name, values in means.items()},
+                                  'stats': metrics.state_dict()})
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Combines the statistics of evaluation shards into final results.')
+    parser.add_argument('shard_files', nargs='+', type=pathlib.Path,
+                        help="Shard statistics files ('*_stats_shard<i>of<n>.json') of a single evaluation.")
+    parser.add_argument('--out_path', type=pathlib.Path, default=None,
+                        help='If set, store the merged statistics and means in this JSON file.')
+    return parser
+
+
+if __name__ == '__main__':
+    main(create_arg_parser().parse_args())
@@ -0,0 +1,263 @@
+import copy
+import time
+import random
+import logging
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from .policy_model_def import build_policy_model
+from .policy_model_utils import (create_data_range_dict, compute_initial_reconstruction, get_policy_probs,
+                                 compute_next_step_reconstruction, compute_reward_scores)
+from .compiled_inference import compile_recon_model
+from src.helpers.data_loading import create_data_loader
+from src.helpers.distributed import unwrap_model
+from src.helpers.precision import apply_precision, get_precision, backward, optimiser_step
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, build_recon_cache
+
+logger = logging.getLogger(__name__)
+
+
+class PolicyPublisher:
+    """
+    Shares the weights of the learner's policy model with the actor processes through shared memory. The learner
+    publishes its weights every policy_sync_interval updates, and every actor copies them before rolling out a batch
+    if they are newer than its own. Versions count learner updates.
+    """
+
+    def __init__(self, model, ctx):
+        self.model = copy.deepcopy(unwrap_model(model)).cpu()
+        for param in self.model.parameters():
+            param.requires_grad = False
+        self.model.share_memory()
+        self.version = ctx.Value('l', 0)
+        self.lock = ctx.Lock()
+
+    def publish(self, model, version):
+        with self.lock:
+            self.model.load_state_dict(unwrap_model(model).state_dict())
+            self.version.value = version
+
+    def sync(self, model, version):
+        # Copies the published weights into model if they are newer than version. Returns the version of model.
+        if self.version.value == version:
+            return version
+        with self.lock:
+            model.load_state_dict(self.model.state_dict())
+            return self.version.value
+
+
+def rollout_greedy_batch(args, recon_model, model, data, data_range_dict, cache=None):
+    """
+    Rolls out a greedy policy model on a batch without gradients, sampling and scoring actions as in
+    compute_backprop_trajectory.
+
+    Returns:
+        (dict): Transitions of all acquisition steps as CPU tensors, stacked over steps: states 'recons'
+            (steps x batch x 1 x res x res) and 'masks' (steps x batch x 1 x 1 x res x 1), and sampled 'actions' with
+            their 'logprobs' under the acting policy and their 'rewards' (all steps x batch x num_trajectories).
+    """
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = data
+    # shape after unsqueeze = batch x channel x columns x rows x complex
+    kspace = kspace.unsqueeze(1).to(args.device)
+    masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
+    mask = mask.unsqueeze(1).to(args.device)
+    # shape after unsqueeze = batch x channel x columns x rows
+    zf = zf.unsqueeze(1).to(args.device)
+    gt = gt.unsqueeze(1).to(args.device)
+    gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    unnorm_gt = gt * gt_std + gt_mean
+    data_range = torch.stack([data_range_dict[vol] for vol in fname])
+    slice_ids = list(zip(fname, sl_idx.tolist()))
+
+    transitions = {key: [] for key in ['recons', 'masks', 'actions', 'logprobs', 'rewards']}
+    with torch.no_grad():
+        recons = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids)
+        base_score = compute_reward_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range)
+        for step in range(args.acquisition_steps):
+            _, probs = get_policy_probs(model, recons, mask, get_precision(args))
+            # batch x num_traj
+            actions = torch.multinomial(probs.squeeze(1), args.num_trajectories, replacement=True)
+            action_logprobs = torch.log(torch.gather(probs.squeeze(1), -1, actions))
+            transitions['recons'].append(recons.cpu())
+            transitions['masks'].append(mask.cpu())
+
+            mask, masked_kspace, zf, recons, info = compute_next_step_reconstruction(
+                recon_model, kspace, masked_kspace, mask, actions, dedup=args.dedup_actions, cache=cache,
+                slice_ids=slice_ids, return_info=True, memory_mb=args.chunk_memory_mb)
+            step_scores = compute_reward_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, info=info)
+            transitions['actions'].append(actions.cpu())
+            transitions['logprobs'].append(action_logprobs.cpu())
+            transitions['rewards'].append((step_scores - base_score).cpu())
+
+            # Continue with one of the sampled rows for every slice
+            idx = random.randint(0, mask.shape[1] - 1)
+            mask = mask[:, idx:idx + 1, :, :, :]
+            masked_kspace = masked_kspace[:, idx:idx + 1, :, :, :]
+            recons = recons[:, idx:idx + 1, :, :]
+            base_score = step_scores[:, idx:idx + 1]
+    return {key: torch.stack(values) for key, values in transitions.items()}
+
+
+def run_actor(actor_id, args, publisher, queue, start_epoch):
+    """
+    Actor process: rolls out the latest published policy on its own shard of the training volumes, and puts the
+    transitions of every batch in queue, followed by None at the end of every epoch.
+    """
+    args.num_shards, args.shard_index = args.num_actors, actor_id
+    args.device = args.actor_device or args.device
+    # Actors are daemon processes, which cannot start data loading workers
+    args.num_workers = 0
+    if args.seed != 0:
+        random.seed(args.seed + actor_id + 1)
+        np.random.seed(args.seed + actor_id + 1)
+        torch.manual_seed(args.seed + actor_id + 1)
+
+    _, recon_model = load_recon_model(args)
+    recon_model = apply_precision(args, compile_recon_model(args, recon_model.to(args.device)))
+    cache = build_recon_cache(args)
+    # Train mode, so that actions are sampled as by the learner
+    model = build_policy_model(args)
+    version = publisher.sync(model, -1)
+    loader = create_data_loader(args, 'train', shuffle=True)
+    data_range_dict = create_data_range_dict(args, loader)
+
+    for _ in range(start_epoch, args.num_epochs):
+        for data in loader:
+            version = publisher.sync(model, version)
+            transitions = rollout_greedy_batch(args, recon_model, model, data, data_range_dict, cache)
+            transitions['version'] = version
+            queue.put(transitions)
+        queue.put(None)
+
+
+def start_actors(args, model, start_epoch):
+    # Starts args.num_actors actor processes, which roll out the policy model until args.num_epochs is reached
+    ctx = mp.get_context('spawn')
+    publisher = PolicyPublisher(model, ctx)
+    queue = ctx.Queue(maxsize=args.actor_queue_size)
+    actors = [ctx.Process(target=run_actor, args=(i, copy.deepcopy(args), publisher, queue, start_epoch), daemon=True)
+              for i in range(args.num_actors)]
+    for actor in actors:
+        actor.start()
+    return publisher, queue, actors
+
+
+def stop_actors(actors):
+    for actor in actors:
+        if actor.is_alive():
+            actor.terminate()
+        actor.join()
+
+
+def importance_weights(args, logprobs, behaviour_logprobs):
+    # Corrects for actions sampled by an older policy: ratio of learner and actor probabilities, optionally truncated
+    if args.importance_weighting == 'none':
+        return torch.ones_like(logprobs)
+    ratios = torch.exp(logprobs - behaviour_logprobs)
+    if args.importance_weighting == 'truncated':
+        ratios = ratios.clamp(max=args.importance_clip)
+    return ratios
+
+
+def learn_from_transitions(args, model, transitions, scaler=None):
+    """
+    Greedy policy gradient (see compute_backprop_trajectory) of the transitions of a batch, with log-probabilities
+    recomputed by the learner's policy. Gradients are accumulated step by step. Returns the loss of every step.
+    """
+    losses = []
+    for step in range(transitions['actions'].size(0)):
+        recons = transitions['recons'][step].to(args.device)
+        mask = transitions['masks'][step].to(args.device)
+        actions = transitions['actions'][step].to(args.device)
+        action_rewards = transitions['rewards'][step].to(args.device)
+        _, probs = get_policy_probs(model, recons, mask, get_precision(args))
+        action_logprobs = torch.log(torch.gather(probs.squeeze(1), -1, actions))
+        weights = importance_weights(args, action_logprobs.detach(), transitions['logprobs'][step].to(args.device))
+        if args.no_baseline:
+            loss = -1 * (weights * action_logprobs * action_rewards) / actions.size(-1)
+        else:
+            avg_reward = torch.mean(action_rewards, dim=-1, keepdim=True)
+            loss = -1 * (weights * action_logprobs * (action_rewards - avg_reward)) / (actions.size(-1) - 1)
+        loss = loss.sum(dim=1).mean() / args.batches_step
+        backward(loss, scaler)
+        losses.append(loss.item())
+    return losses
+
+
+def learner_update(args, optimiser, scaler, publisher, model, num_updates):
+    # Optimiser step on the accumulated gradients, publishing the policy to the actors every policy_sync_interval
+    # updates. Returns the new number of updates.
+    optimiser_step(optimiser, scaler)
+    num_updates += 1
+    if num_updates % args.policy_sync_interval == 0:
+        publisher.publish(model, num_updates)
+    return num_updates
+
+
+def train_epoch_actor_learner(args, epoch, model, optimiser, writer, publisher, queue, num_updates, scaler=None):
+    """
+    Learner side of a training epoch: takes gradient steps on the transitions generated by the actors until every
+    actor finished the epoch. Transitions generated by a policy that is more than max_policy_lag updates behind are
+    dropped.
+
+    Returns:
+        (tuple): mean loss, epoch time, total number of learner updates and number of slices learned from.
+    """
+    model.train()
+    epoch_loss = np.zeros(args.acquisition_steps)
+    report_loss = np.zeros(args.acquisition_steps)
+    num_batches = num_slices = num_stale = 0
+    lags = []
+    start_epoch = start_iter = time.perf_counter()
+    finished = 0
+    cbatch = 0
+    while finished < args.num_actors:
+        transitions = queue.get()
+        if transitions is None:  # Actor finished its shard of the epoch
+            finished += 1
+            continue
+        lag = num_updates - transitions['version']
+        if lag > args.max_policy_lag:
+            num_stale += 1
+            continue
+        lags.append(lag)
+
+        cbatch += 1
+        # Index of this batch over all epochs: num_updates only advances every batches_step batches
+        global_step = num_updates * args.batches_step + cbatch
+        if cbatch == 1:
+            optimiser.zero_grad()
+        losses = learn_from_transitions(args, model, transitions, scaler)
+        if cbatch == args.batches_step:
+            num_updates = learner_update(args, optimiser, scaler, publisher, model, num_updates)
+            cbatch = 0
+
+        for step, loss in enumerate(losses):
+            writer.add_scalar('TrainLoss_step{}'.format(step), loss, global_step)
+        epoch_loss += losses
+        report_loss += losses
+        num_batches += 1
+        num_slices += transitions['actions'].size(1)
+        if num_batches % args.report_interval == 0:
+            loss_str = ", ".join(["{}: {:.2f}".format(i + 1, l * 1e3 / args.report_interval)
+                                  for i, l in enumerate(report_loss)])
+            logger.info(
+                f'Epoch = [{epoch:3d}/{args.num_epochs:3d}], '
+                f'Batches = {num_batches:4d}, '
+                f'Time = {time.perf_counter() - start_iter:.2f}s, '
+                f'Avg Loss per step x1e3 = [{loss_str}] ',
+            )
+            report_loss = np.zeros(args.acquisition_steps)
+            start_iter = time.perf_counter()
+
+    if cbatch != 0:
+        # Step on the remaining accumulated gradients, rather than carrying them over to the next epoch
+        num_updates = learner_update(args, optimiser, scaler, publisher, model, num_updates)
+    epoch_loss /= max(num_batches, 1)
+    writer.add_scalar('TrainStaleBatches', num_stale, epoch)
+    logger.info(f'Learner: {num_batches} batches, {num_stale} dropped as stale, policy lag mean '
+                 f'{np.mean(lags) if lags else 0:.2f} max {max(lags) if lags else 0}')
+    return np.mean(epoch_loss), time.perf_counter() - start_epoch, num_updates, num_slices
@@ -0,0 +1,157 @@
+import logging
+
+import torch
+from torch import nn
+
+from src.reconstruction_model.onnx_inference import OnnxReconstructionModel
+from .policy_model_utils import get_new_zf
+
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ['eager', 'script', 'trace', 'compile']
+
+
+class ZeroFilledReconstruction(nn.Module):
+    """
+    Zero-filled image (see get_new_zf) and its reconstruction from masked k-space, as a single module such that both
+    are compiled into one graph.
+    """
+
+    def __init__(self, recon_model):
+        super().__init__()
+        self.recon_model = recon_model
+
+    def forward(self, masked_kspace):
+        zf, _, _ = get_new_zf(masked_kspace)
+        return zf, self.recon_model(zf)
+
+
+class CompiledReconstructionModel(nn.Module):
+    """
+    Frozen reconstruction model with compiled inference. Called on zero-filled images like the original model, while
+    zf_and_recon() computes zero-filled images and their reconstructions from masked k-space in a single compiled
+    graph (used by reconstruct_masked_kspace).
+    """
+
+    def __init__(self, recon_model, recon, zf_recon):
+        super().__init__()
+        self.recon_model = recon_model
+        self.recon = recon
+        self.zf_recon = zf_recon
+
+    def forward(self, zf):
+        return self.recon(zf)
+
+    def zf_and_recon(self, masked_kspace):
+        return self.zf_recon(masked_kspace)
+
+
+def compile_module(module, mode, example_inputs):
+    """
+    Compiles module for inference with TorchScript scripting ('script') or tracing on example_inputs ('trace'), or
+    with torch.compile ('compile', which falls back to scripting on torch versions without it). TorchScript modules are
+    frozen where supported, which inlines the parameters and allows more operator fusion. Returns module unchanged for
+    'eager'.
+    """
+    if mode == 'eager':
+        return module
+    module = module.eval()
+    if mode == 'compile':
+        if hasattr(torch, 'compile'):
+            return torch.compile(module)
+        logger.warning('torch.compile is not available in this version of torch: scripting instead.')
+        mode = 'script'
+    with torch.no_grad():
+        if mode == 'script':
+            compiled = torch.jit.script(module)
+        elif mode == 'trace':
+            compiled = torch.jit.trace(module, example_inputs)
+        else:
+            raise ValueError(f'mode should be in {COMPILE_MODES}, not {mode}')
+    if hasattr(torch.jit, 'freeze'):
+        compiled = torch.jit.freeze(compiled)
+    return compiled
+
+
+def max_abs_difference(reference, compiled, inputs):
+    # Largest absolute difference between the outputs (tensors or tuples of tensors) of two modules
+    with torch.no_grad():
+        ref_outputs, outputs = reference(*inputs), compiled(*inputs)
+    if not isinstance(ref_outputs, tuple):
+        ref_outputs, outputs = (ref_outputs,), (outputs,)
+    return max((ref - out).abs().max().item() for ref, out in zip(ref_outputs, outputs))
+
+
+def compile_with_parity_check(module, mode, example_inputs, check_inputs, tolerance, name):
+    """
+    Compiles module (see compile_module), and checks that it gives the same outputs as module on check_inputs, which
+    should have a different batch size than example_inputs to catch shapes that were fixed by tracing. Falls back to
+    module if the compiled module fails or deviates by more than tolerance.
+    """
+    if mode == 'eager':
+        return module
+    try:
+        compiled = compile_module(module, mode, example_inputs)
+        error = max_abs_difference(module, compiled, check_inputs)
+    except Exception as e:  # TorchScript does not support every construct: inference should still work without it
+        logger.warning(f'Could not compile {name} with {mode} ({e}): using eager execution.')
+        return module
+    if error > tolerance:
+        logger.warning(f'Compiled {name} ({mode}) deviates from eager execution by {error:.2e}: using eager execution.')
+        return module
+    logger.info(f'Compiled {name} with {mode}, max abs deviation from eager execution {error:.2e}.')
+    return compiled
+
+
+def unwrap_for_compilation(model, name):
+    # TorchScript cannot compile DataParallel, which only helps with multiple GPUs. Returns None if model should stay.
+    if isinstance(model, nn.DataParallel):
+        if torch.cuda.device_count() > 1:
+            logger.warning(f'Not compiling {name}: it uses DataParallel over multiple GPUs.')
+            return None
+        return model.module
+    if isinstance(model, OnnxReconstructionModel):
+        logger.warning(f'Not compiling {name}: it is run by ONNX Runtime, which optimises the graph itself.')
+        return None
+    return model
+
+
+def get_device(module):
+    # Quantized modules have no parameters, and run on CPU
+    params = list(module.parameters())
+    return params[0].device if params else torch.device('cpu')
+
+
+def compile_recon_model(args, recon_model):
+    """
+    Compiles the frozen reconstruction model for inference, together with the computation of zero-filled images as a
+    single graph, if args.compiled_inference is set. The zero-filled computation is always traced, since its FFT shifts
+    are not scriptable.
+    """
+    mode = getattr(args, 'compiled_inference', 'eager')
+    module = unwrap_for_compilation(recon_model, 'reconstruction model') if mode != 'eager' else None
+    if module is None:
+        return recon_model
+    device = get_device(module)
+    res = args.resolution
+    zf_example, zf_check = torch.randn(2, 1, res, res, device=device), torch.randn(3, 1, res, res, device=device)
+    mk_example, mk_check = torch.randn(2, 1, res, res, 2, device=device), torch.randn(3, 1, res, res, 2, device=device)
+
+    recon = compile_with_parity_check(module, mode, (zf_example,), (zf_check,), args.compile_tolerance,
+                                      'reconstruction model')
+    zf_mode = 'compile' if mode == 'compile' else 'trace'
+    zf_recon = compile_with_parity_check(ZeroFilledReconstruction(module), zf_mode, (mk_example,), (mk_check,),
+                                         args.compile_tolerance, 'zero-filled reconstruction')
+    return CompiledReconstructionModel(module, recon, zf_recon)
+
+
+def compile_policy_model(args, model):
+    # Compiles a policy model that is only used for evaluation, if args.compiled_inference is set
+    mode = getattr(args, 'compiled_inference', 'eager')
+    module = unwrap_for_compilation(model, 'policy model') if mode != 'eager' else None
+    if module is None:
+        return model
+    device = get_device(module)
+    res = args.resolution
+    example, check = torch.randn(2, 1, res, res, device=device), torch.randn(3, 1, res, res, device=device)
+    return compile_with_parity_check(module, mode, (example,), (check,), args.compile_tolerance, 'policy model')
@@ -1,6 +1,10 @@
 import torch
 from torch import nn
 
+# 'flatten': all features of the final block, 'adaptive': average pooled to a head_grid x head_grid grid,
+# 'global': global average pooling. Only for 'flatten' does the size of the first FC layer depend on the resolution.
+POLICY_HEADS = ['flatten', 'adaptive', 'global']
+
 
 class ConvBlock(nn.Module):
     """
@@ -47,8 +51,27 @@ class ConvBlock(nn.Module):
             f'drop_prob={self.drop_prob}, max_pool_size={self.pool_size})'
 
 
+def build_fc_out(in_features, fc_size, resolution):
+    # Fully connected layers from the (pooled) image encoding to a logit for every row
+    return nn.Sequential(
+        nn.Linear(in_features=in_features, out_features=fc_size),
+        nn.LeakyReLU(),
+        nn.Linear(in_features=fc_size, out_features=fc_size),
+        nn.LeakyReLU(),
+        nn.Linear(in_features=fc_size, out_features=resolution)
+    )
+
+
+def build_pool(head, head_grid):
+    # Pooling of the convolutional output for the given head (see POLICY_HEADS), and the resulting spatial size
+    if head == 'flatten':
+        return nn.Identity(), None
+    grid = head_grid if head == 'adaptive' else 1
+    return nn.AdaptiveAvgPool2d(grid), grid
+
+
 class PolicyModel(nn.Module):
-    def __init__(self, resolution, in_chans, chans, num_pool_layers, drop_prob, fc_size):
+    def __init__(self, resolution, in_chans, chans, num_pool_layers, drop_prob, fc_size, head='flatten', head_grid=4):
         """
         Args:
             in_chans (int): Number of channels in the input to the U-Net model.
@@ -56,6 +79,8 @@ class PolicyModel(nn.Module):
             chans (int): Number of output channels of the first convolution layer.
             num_pool_layers (int): Number of down-sampling layers.
             drop_prob (float): Dropout probability.
+            head (str): How the convolutional output is reduced before the FC layers, see POLICY_HEADS.
+            head_grid (int): Size of the spatial grid the output is pooled to for head 'adaptive'.
         """
         super().__init__()
         self.resolution = resolution
@@ -64,6 +89,9 @@ class PolicyModel(nn.Module):
         self.num_pool_layers = num_pool_layers
         self.drop_prob = drop_prob
         self.fc_size = fc_size
+        self.head = head
+        self.head_grid = head_grid
+        assert head in POLICY_HEADS, f'head should be in {POLICY_HEADS}, not {head}'
 
         # Size of image encoding after flattening of convolutional output
         # There are 1 + num_pool_layers blocks
@@ -85,13 +113,12 @@ class PolicyModel(nn.Module):
             self.flattened_size = self.flattened_size * 2 // self.pool_size ** 2
             ch *= 2
 
-        self.fc_out = nn.Sequential(
-            nn.Linear(in_features=self.flattened_size, out_features=self.fc_size),
-            nn.LeakyReLU(),
-            nn.Linear(in_features=self.fc_size, out_features=self.fc_size),
-            nn.LeakyReLU(),
-            nn.Linear(in_features=self.fc_size, out_features=resolution)
-        )
+        # Pooling heads reduce the output to a fixed number of features, independent of the resolution
+        self.pool, grid = build_pool(head, head_grid)
+        if grid is not None:
+            self.flattened_size = ch * grid ** 2
+
+        self.fc_out = build_fc_out(self.flattened_size, fc_size, resolution)
 
     def forward(self, image):
         """
@@ -109,12 +136,76 @@ class PolicyModel(nn.Module):
         # Apply down-sampling layers
         for layer in self.down_sample_layers:
             image_emb = layer(image_emb)
-        image_emb = self.fc_out(image_emb.flatten(start_dim=1))  # flatten all but batch dimension
+        image_emb = self.fc_out(self.pool(image_emb).flatten(start_dim=1))  # flatten all but batch dimension
         assert len(image_emb.shape) == 2
         return image_emb
 
 
+class FeaturePolicyModel(nn.Module):
+    """
+    Policy on the bottleneck features of the reconstruction model (see ReconstructionWithFeatures), instead of on the
+    reconstruction itself: a single convolutional block and the fully connected layers of PolicyModel. The features
+    come from the forward pass that computes the reconstruction, so the policy adds little compute of its own.
+    """
+
+    def __init__(self, resolution, feature_chans, feature_resolution, chans, drop_prob, fc_size, head='flatten',
+                 head_grid=4):
+        """
+        Args:
+            resolution (int): Number of neurons in the output FC layer (equal to image number of rows in kspace).
+            feature_chans (int): Number of channels of the reconstruction model features.
+            feature_resolution (int): Height and width of the reconstruction model features.
+            chans (int): Number of output channels of the convolution layer.
+            drop_prob (float): Dropout probability.
+            head (str): How the convolutional output is reduced before the FC layers, see POLICY_HEADS.
+            head_grid (int): Size of the spatial grid the output is pooled to for head 'adaptive'.
+        """
+        super().__init__()
+        self.resolution = resolution
+        self.feature_chans = feature_chans
+        self.feature_resolution = feature_resolution
+        self.chans = chans
+        self.drop_prob = drop_prob
+        self.fc_size = fc_size
+        self.head = head
+        self.head_grid = head_grid
+        assert head in POLICY_HEADS, f'head should be in {POLICY_HEADS}, not {head}'
+
+        self.channel_layer = ConvBlock(feature_chans, chans, drop_prob, pool_size=1)
+        self.pool, grid = build_pool(head, head_grid)
+        self.flattened_size = chans * (feature_resolution if grid is None else grid) ** 2
+        self.fc_out = build_fc_out(self.flattened_size, fc_size, resolution)
+
+    def forward(self, features):
+        """
+        Args:
+            features (torch.Tensor): Input tensor of shape [batch_size, self.feature_chans, self.feature_resolution,
+                self.feature_resolution]
+
+        Returns:
+            (torch.Tensor): Output tensor of shape [batch_size, self.resolution]
+        """
+        image_emb = self.pool(self.channel_layer(features))
+        return self.fc_out(image_emb.flatten(start_dim=1))
+
+
 def build_policy_model(args):
+    # Not set in checkpoints from before pooling heads and feature policies were added
+    head = getattr(args, 'policy_head', 'flatten')
+    head_grid = getattr(args, 'head_grid', 4)
+    if getattr(args, 'policy_input', 'recon') == 'recon_features':
+        # As wide as the last block of PolicyModel, which has the same spatial size for default arguments
+        model = FeaturePolicyModel(
+            resolution=args.resolution,
+            feature_chans=args.feature_chans,
+            feature_resolution=args.feature_resolution,
+            chans=args.num_chans * 2 ** args.num_layers,
+            drop_prob=args.drop_prob,
+            fc_size=args.fc_size,
+            head=head,
+            head_grid=head_grid,
+        ).to(args.device)
+        return model
     model = PolicyModel(
         resolution=args.resolution,
         in_chans=1,
@@ -122,5 +213,7 @@ def build_policy_model(args):
         num_pool_layers=args.num_layers,
         drop_prob=args.drop_prob,
         fc_size=args.fc_size,
+        head=head,
+        head_grid=head_grid,
     ).to(args.device)
     return model
@@ -1,10 +1,14 @@
 import torch
 import random
+from torch.utils.data.distributed import DistributedSampler
 
 from .policy_model_def import build_policy_model
 from src.helpers import transforms
 from src.helpers.utils import build_optim
 from src.helpers.torch_metrics import compute_ssim, compute_psnr
+from src.helpers.chunked_execution import run_in_chunks
+from src.helpers.distributed import load_state_dict, is_distributed, all_reduce
+from src.helpers.precision import autocast, get_precision, backward
 
 
 def save_policy_model(args, exp_dir, epoch, model, optimizer):
@@ -32,9 +36,16 @@ def save_policy_model(args, exp_dir, epoch, model, optimizer):
         )
 
 
+# Training settings that policies stored before reward engines were added do not have: they were trained with SSIM
+REWARD_ARG_DEFAULTS = {'reward': 'ssim', 'reward_stride': 2, 'reward_roi_threshold': 0.05}
+
+
 def load_policy_model(checkpoint_file, optim=False):
     checkpoint = torch.load(checkpoint_file)
     args = checkpoint['args']
+    for key, value in REWARD_ARG_DEFAULTS.items():
+        if not hasattr(args, key):
+            setattr(args, key, value)
     model = build_policy_model(args)
 
     if not optim:
@@ -42,9 +53,10 @@ def load_policy_model(checkpoint_file, optim=False):
         for param in model.parameters():
             param.requires_grad = False
 
-    if args.data_parallel:
+    # Loads checkpoints saved with or without a (Distributed)DataParallel wrapper
+    load_state_dict(model, checkpoint['model'])
+    if args.data_parallel and not is_distributed():
         model = torch.nn.DataParallel(model)
-    model.load_state_dict(checkpoint['model'])
 
     start_epoch = checkpoint['epoch']
 
@@ -77,47 +89,151 @@ def acquire_rows_in_batch_parallel(k, mk, mask, to_acquire):
         # model: every column in to_acquire corresponds to an existing trajectory that we have sampled the next
         # column for.
         m_exp = mask
-        mk_exp = mk
     else:
         # We have to initialise trajectories: every row in to_acquire corresponds to a trajectory.
         m_exp = mask.repeat(1, to_acquire.size(1), 1, 1, 1)
-        mk_exp = mk.repeat(1, to_acquire.size(1), 1, 1, 1)
-    # Loop over slices in batch
-    for sl, rows in enumerate(to_acquire):
-        # Loop over indices to acquire
-        for index, row in enumerate(rows):  # Will only be single index if first case (see comment above)
-            m_exp[sl, index, :, row.item(), :] = 1.
-            mk_exp[sl, index, :, row.item(), :] = k[sl, 0, :, row.item(), :]
+    # Set the acquired row of every (slice, trajectory) in a single scatter: to_acquire has shape batch x trajectories
+    index = to_acquire.to(m_exp.device).view(to_acquire.size(0), to_acquire.size(1), 1, 1, 1)
+    m_exp.scatter_(3, index, 1.)
+    # Masked k-space is always the full k-space multiplied by the mask
+    mk_exp = k * m_exp
     return m_exp, mk_exp
 
 
-def compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask, next_rows):
+def find_unique_trajectories(mask):
+    """
+    Finds the trajectories that have a unique set of acquired rows within their slice.
+
+    Args:
+        mask (torch.Tensor): Mask tensor of shape [batch_size, num_trajectories, 1, resolution, 1]
+
+    Returns:
+        (tuple): tuple containing:
+            unique_idx (torch.Tensor): Indices into the flattened (batch . num_trajectories) dimension of the first
+                trajectory of every unique (slice, mask) pair.
+            inverse (torch.Tensor): For every entry in the flattened (batch . num_trajectories) dimension, the index
+                into unique_idx of its unique representative.
+    """
+    batch_size, num_traj = mask.size(0), mask.size(1)
+    rows = mask.reshape(batch_size, num_traj, -1)
+    # batch x traj x traj: True if trajectories i and j of the same slice have acquired the same rows
+    same = (rows.unsqueeze(2) == rows.unsqueeze(1)).all(dim=-1)
+    # Representative of every trajectory is the first trajectory in its slice with the same mask
+    traj_idx = torch.arange(num_traj, device=mask.device)
+    rep = torch.where(same, traj_idx.expand_as(same), torch.full_like(same, num_traj, dtype=torch.long))
+    rep = rep.min(dim=-1)[0]
+    is_unique = (rep == traj_idx).view(-1)
+    unique_idx = is_unique.nonzero(as_tuple=False).squeeze(1)
+    # Position of every unique trajectory in unique_idx, looked up through the representative of every trajectory
+    position = torch.cumsum(is_unique.long(), dim=0) - 1
+    batch_offset = torch.arange(batch_size, device=mask.device).unsqueeze(1) * num_traj
+    inverse = position[(rep + batch_offset).view(-1)]
+    return unique_idx, inverse
+
+
+def compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask, next_rows, dedup=False, cache=None,
+                                     slice_ids=None, return_info=False, memory_mb=0, return_features=False):
     # This computation is done by reshaping the masked k-space tensor to (batch . num_trajectories x 1 x res x res)
     # and then reshaping back after performing a reconstruction.
+    # If dedup is set, only trajectories with a unique set of acquired rows per slice are reconstructed, and the
+    # reconstructions are scattered back to all trajectories. If a ReconstructionCache is given, reconstructions are
+    # looked up by slice (slice_ids) and acquired rows before running recon_model.
+    # With return_info, a dictionary describing which trajectories were reconstructed is additionally returned. Pass it
+    # to compute_scores to only score those trajectories as well.
+    # If memory_mb is set, the flattened (batch . num_trajectories) dimension is processed in micro-batches that fit
+    # within this memory budget, so that large numbers of candidate rows do not require smaller data batches.
+    # With return_features, the features returned by recon_model along with the reconstructions (see
+    # ReconstructionWithFeatures, None for other models) are additionally returned after the reconstructions, with
+    # shape B x C x features x h x w.
     mask, masked_kspace = acquire_rows_in_batch_parallel(kspace, masked_kspace, mask, next_rows)
     channel_size = masked_kspace.shape[1]
     res = masked_kspace.size(-2)
     # Combine batch and channel dimension for parallel computation if necessary
     masked_kspace = masked_kspace.view(mask.size(0) * channel_size, 1, res, res, 2)
-    zf, _, _ = get_new_zf(masked_kspace)
-    recon = recon_model(zf)
+    info = {}
+    if dedup:
+        unique_idx, inverse = find_unique_trajectories(mask)
+        info['unique_idx'], info['inverse'] = unique_idx, inverse
+        masked_kspace_input = masked_kspace[unique_idx]
+    else:
+        masked_kspace_input = masked_kspace
+
+    keys = None
+    if cache is not None:
+        keys = cache.make_keys(slice_ids, mask)
+        if dedup:
+            keys = [keys[i] for i in info['unique_idx'].tolist()]
+        info['cache'], info['keys'] = cache, keys
+    zf, recon, *features = reconstruct_masked_kspace(recon_model, masked_kspace_input, cache, keys, memory_mb)
+    features = features[0] if features else None
+
+    if dedup:
+        recon = recon[info['inverse']]
+        zf = zf[info['inverse']]
+        if features is not None:
+            features = features[info['inverse']]
 
     # Reshape back to B X C (=parallel acquisitions) x H x W
     recon = recon.view(mask.size(0), channel_size, res, res)
     zf = zf.view(mask.size(0), channel_size, res, res)
     masked_kspace = masked_kspace.view(mask.size(0), channel_size, res, res, 2)
-    return mask, masked_kspace, zf, recon
+    outputs = (mask, masked_kspace, zf, recon)
+    if return_features:
+        if features is not None:
+            features = features.view(mask.size(0), channel_size, *features.shape[1:])
+        outputs += (features,)
+    if return_info:
+        outputs += (info,)
+    return outputs
+
+
+def reconstruct_masked_kspace(recon_model, masked_kspace, cache=None, keys=None, memory_mb=0):
+    # Zero-filled images and reconstructions for flattened masked k-space of shape N x 1 x res x res x 2. Computed in
+    # micro-batches if memory_mb is set, looking up reconstructions by keys if a ReconstructionCache is given. Features
+    # are returned last if recon_model returns them along with its reconstructions (see ReconstructionWithFeatures).
+    if cache is not None:
+        zf = run_in_chunks(lambda mk: get_new_zf(mk)[0], [masked_kspace], memory_mb, 'zero_filled')
+        recon = cache.reconstruct(lambda z: run_in_chunks(recon_model, [z], memory_mb, 'reconstruction'), zf, keys)
+        return zf, recon
+
+    def zf_and_recon(mk):
+        if hasattr(recon_model, 'zf_and_recon'):  # Compiled as a single graph, see compiled_inference.py
+            return recon_model.zf_and_recon(mk)
+        zf, _, _ = get_new_zf(mk)
+        output = recon_model(zf)
+        return (zf,) + output if isinstance(output, tuple) else (zf, output)
+    return run_in_chunks(zf_and_recon, [masked_kspace], memory_mb, 'zero_filled_reconstruction')
+
+
+def compute_initial_reconstruction(recon_model, zf, mask, cache=None, slice_ids=None, return_features=False):
+    # Base reconstruction model forward pass, looked up in the reconstruction cache if given. With return_features,
+    # also returns the features of recon_model (see compute_next_step_reconstruction) of shape B x 1 x features x h x w.
+    if cache is None:
+        output = recon_model(zf)
+    else:
+        output = cache.reconstruct(recon_model, zf, cache.make_keys(slice_ids, mask))
+    recons, features = output if isinstance(output, tuple) else (output, None)
+    if return_features:
+        return recons, features.unsqueeze(1) if features is not None else None
+    return recons
+
+
+def get_policy_input(recons, features):
+    # Reconstruction features for policies on them (see FeaturePolicyModel), reconstructions otherwise
+    return recons if features is None else features
 
 
-def get_policy_probs(model, recons, mask):
+def get_policy_probs(model, recons, mask, precision='fp32'):
+    # recons are the policy input (see get_policy_input): B x C x H x W reconstructions, or B x C x features x h x w
     channel_size = mask.shape[1]
     res = mask.size(-2)
     # Reshape trajectory dimension into batch dimension for parallel forward pass
-    recons = recons.view(mask.size(0) * channel_size, 1, res, res)
-    # Obtain policy model logits
-    output = model(recons)
-    # Reshape trajectories back into their own dimension
-    output = output.view(mask.size(0), channel_size, res)
+    recons = recons.reshape(mask.size(0) * channel_size, -1, recons.size(-2), recons.size(-1))
+    # Obtain policy model logits, under autocast for reduced precision
+    with autocast(precision, recons.device.type):
+        output = model(recons)
+    # Reshape trajectories back into their own dimension. Softmax and log-probabilities are computed in float32.
+    output = output.float().view(mask.size(0), channel_size, res)
     # Mask already acquired rows by setting logits to very negative numbers
     loss_mask = (mask == 0).squeeze(-1).squeeze(-2).float()
     logits = torch.where(loss_mask.byte(), output, -1e7 * torch.ones_like(output))
@@ -128,15 +244,25 @@ def get_policy_probs(model, recons, mask):
     return policy, probs
 
 
-def compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=True):
+def compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=True, info=None, precision='fp32'):
     # For every slice in the batch, and every acquired action per slice, compute the resulting SSIM (and PSNR) scores
-    # in parallel.
+    # in parallel. SSIM convolutions run in precision (used for rewards: evaluation always uses float32).
+    if info or args.chunk_memory_mb > 0:
+        # Only score the trajectories that were reconstructed (see compute_next_step_reconstruction), in micro-batches
+        # if a memory budget is set.
+        return compute_reconstructed_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, info or {},
+                                            comp_psnr, precision)
+    return compute_batch_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr, precision)
+
+
+def compute_batch_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=True, precision='fp32'):
     # Unnormalise reconstructions
     unnorm_recons = recons * gt_std + gt_mean
     # Reshape targets if necessary (for parallel computation of multiple acquisitions)
     gt_exp = unnorm_gt.expand(-1, recons.shape[1], -1, -1)
     # SSIM scores = batch x k (channels)
-    ssim_scores = compute_ssim(unnorm_recons, gt_exp, size_average=False, data_range=data_range).mean(-1).mean(-1)
+    ssim_scores = compute_ssim(unnorm_recons, gt_exp, size_average=False, data_range=data_range,
+                               precision=precision).mean(-1).mean(-1)
     # Also compute PSNR
     if comp_psnr:
         psnr_scores = compute_psnr(args, unnorm_recons, gt_exp, data_range)
@@ -144,6 +270,103 @@ def compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_ps
     return ssim_scores
 
 
+def compute_reconstructed_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, info, comp_psnr=True,
+                                 precision='fp32'):
+    # Scores only unique trajectories (if deduplicated), reusing cached scores where available (if using a cache), and
+    # scatters the scores back to shape batch x trajectories.
+    batch_size, num_traj, res = recons.size(0), recons.size(1), recons.size(-1)
+    flat_recons = recons.reshape(batch_size * num_traj, 1, res, res)
+    if 'unique_idx' in info:
+        idx = info['unique_idx']
+    else:
+        idx = torch.arange(batch_size * num_traj, device=recons.device)
+
+    def score_fn(positions):
+        flat_idx = idx[positions.to(idx.device)]
+        sl = flat_idx // num_traj
+        return compute_batch_scores(args, flat_recons[flat_idx], gt_mean[sl], gt_std[sl], unnorm_gt[sl],
+                                    data_range[sl], comp_psnr=comp_psnr, precision=precision)
+
+    def chunked_score_fn(positions):
+        # Positions on the device of the reconstructions, so that the memory footprint is measured on that device
+        return run_in_chunks(score_fn, [positions.to(recons.device)], args.chunk_memory_mb,
+                             f'scores_res{res}_psnr{comp_psnr}')
+
+    if 'cache' in info:
+        scores = info['cache'].score(info['keys'], chunked_score_fn, comp_psnr=comp_psnr, precision=precision)
+    else:
+        scores = chunked_score_fn(torch.arange(idx.numel()))
+    if not comp_psnr:
+        scores = (scores,)
+    if 'inverse' in info:
+        scores = tuple(score.view(-1)[info['inverse'].to(score.device)] for score in scores)
+    scores = tuple(score.reshape(batch_size, num_traj) for score in scores)
+    if comp_psnr:
+        return scores
+    return scores[0]
+
+
+def ssim_reward(args, unnorm_recons, gt_exp, data_range):
+    return compute_ssim(unnorm_recons, gt_exp, size_average=False, data_range=data_range,
+                        precision=get_precision(args)).mean(-1).mean(-1)
+
+
+def strided_ssim_reward(args, unnorm_recons, gt_exp, data_range):
+    # SSIM map evaluated on a coarse grid of every reward_stride-th pixel
+    return compute_ssim(unnorm_recons, gt_exp, size_average=False, data_range=data_range,
+                        stride=args.reward_stride, precision=get_precision(args)).mean(-1).mean(-1)
+
+
+def roi_ssim_reward(args, unnorm_recons, gt_exp, data_range, window_size=11):
+    # SSIM on the bounding box of the foreground (pixels above reward_roi_threshold times the data range) of all
+    # ground truths in the batch, padded by half a window
+    foreground = (gt_exp[:, :1] > args.reward_roi_threshold * data_range).squeeze(1).any(dim=0)
+    rows = torch.nonzero(foreground.any(dim=1), as_tuple=False)
+    cols = torch.nonzero(foreground.any(dim=0), as_tuple=False)
+    if rows.numel() == 0:
+        return ssim_reward(args, unnorm_recons, gt_exp, data_range)
+    pad = window_size // 2
+    top, bottom = max(rows.min().item() - pad, 0), rows.max().item() + pad + 1
+    left, right = max(cols.min().item() - pad, 0), cols.max().item() + pad + 1
+    return compute_ssim(unnorm_recons[..., top:bottom, left:right], gt_exp[..., top:bottom, left:right],
+                        size_average=False, data_range=data_range, precision=get_precision(args)).mean(-1).mean(-1)
+
+
+def mse_reward(args, unnorm_recons, gt_exp, data_range):
+    # Negative MSE relative to the data range, so that higher is better
+    return -(((unnorm_recons - gt_exp) / data_range) ** 2).mean(-1).mean(-1)
+
+
+def psnr_reward(args, unnorm_recons, gt_exp, data_range):
+    return compute_psnr(args, unnorm_recons, gt_exp, data_range)
+
+
+# Scores used as training rewards: the reward of an action is the improvement of the score it gives
+REWARD_FUNCS = dict(
+    ssim=ssim_reward,
+    ssim_strided=strided_ssim_reward,
+    ssim_roi=roi_ssim_reward,
+    mse=mse_reward,
+    psnr=psnr_reward,
+)
+
+
+def compute_reward_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, info=None, reward=None):
+    """
+    Scores (batch x trajectories) of reconstructions from which training rewards are computed, using the score in
+    REWARD_FUNCS selected by args.reward (or reward, if given). Exact SSIM goes through compute_scores, so that it can
+    use deduplication, caching and chunking. Evaluation always uses compute_scores.
+    """
+    # Policies trained before reward engines were added always used SSIM
+    reward = reward or getattr(args, 'reward', 'ssim')
+    if reward == 'ssim':
+        return compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False, info=info,
+                              precision=get_precision(args))
+    unnorm_recons = recons * gt_std + gt_mean
+    gt_exp = unnorm_gt.expand(-1, recons.shape[1], -1, -1)
+    return REWARD_FUNCS[reward](args, unnorm_recons, gt_exp, data_range)
+
+
 def create_data_range_dict(args, loader):
     # Locate ground truths of a volume
     gt_vol_dict = {}
@@ -159,15 +382,38 @@ def create_data_range_dict(args, loader):
         # Shape 1 x 1 x 1 x 1
         data_range_dict[vol] = torch.stack(gts).max().unsqueeze(-1).unsqueeze(-1).unsqueeze(-1).to(args.device)
     del gt_vol_dict
+    if is_distributed() and isinstance(loader.sampler, DistributedSampler):
+        # Every process only saw some slices of every volume: take the max over all processes
+        vols = sorted(set(fname.name for fname, _ in loader.dataset.examples))
+        maxes = torch.stack([data_range_dict.get(vol, torch.zeros(1, 1, 1, device=args.device)) for vol in vols])
+        all_reduce(maxes, op='max')
+        data_range_dict = {vol: maxes[i] for i, vol in enumerate(vols)}
     return data_range_dict
 
 
 def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, recons, gt_mean, gt_std,
-                                data_range, model, recon_model, step, action_list, logprob_list, reward_list):
-    # Base score from which to calculate acquisition rewards
-    base_score = compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False)
+                                data_range, model, recon_model, step, action_list, logprob_list, reward_list,
+                                dedup_list=None, cache=None, slice_ids=None, score_list=None, state_list=None,
+                                scaler=None, features=None):
+    # Base score (see compute_reward_scores) from which to calculate acquisition rewards. The current reconstructions
+    # were already scored in the previous step: if score_list is given, those scores are stored in it and reused. Only
+    # the initial reconstruction (step 0) is scored here.
+    # features are the reconstruction features of recons for policies on them (see get_policy_input), and are returned
+    # for the next step along with its reconstructions.
+    if score_list:
+        base_score = score_list[-1]
+    else:
+        base_score = compute_reward_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range)
     # Get policy and probabilities.
-    policy, probs = get_policy_probs(model, recons, mask)
+    policy_input = get_policy_input(recons, features)
+    if args.model_type == 'nongreedy' and args.transition_replay:
+        # Only store the state: log-probabilities are recomputed with gradients at the end of the trajectory, so that
+        # no computational graph is kept alive over steps.
+        with torch.no_grad():
+            policy, probs = get_policy_probs(model, policy_input, mask, get_precision(args))
+        state_list.append((policy_input, mask.clone()))  # acquire_rows_in_batch_parallel may fill mask in place
+    else:
+        policy, probs = get_policy_probs(model, policy_input, mask, get_precision(args))
     # Sample actions from the policy. For greedy (or at step = 0) we sample num_trajectories actions from the
     # current policy. For non-greedy with step > 0, we sample a single action for every of the num_trajectories
     # policies.
@@ -188,11 +434,17 @@ def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, re
         actions = actions.squeeze(1)
 
     # Obtain rewards in parallel by taking actions in parallel
-    mask, masked_kspace, zf, recons = compute_next_step_reconstruction(recon_model, kspace,
-                                                                       masked_kspace, mask, actions)
-    ssim_scores = compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False)
+    # With dedup_actions, sampled actions that coincide (common once the policy gets sharp) are only reconstructed and
+    # scored once per unique (slice, state, row). Rewards are scattered back to all trajectories, so gradients are
+    # unchanged.
+    mask, masked_kspace, zf, recons, features, info = compute_next_step_reconstruction(
+        recon_model, kspace, masked_kspace, mask, actions, dedup=args.dedup_actions, cache=cache, slice_ids=slice_ids,
+        return_info=True, memory_mb=args.chunk_memory_mb, return_features=True)
+    if args.dedup_actions and dedup_list is not None:
+        dedup_list.append((info['unique_idx'].numel(), info['inverse'].numel()))
+    step_scores = compute_reward_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, info=info)
     # batch x num_trajectories
-    action_rewards = ssim_scores - base_score
+    action_rewards = step_scores - base_score
     # batch x 1
     avg_reward = torch.mean(action_rewards, dim=-1, keepdim=True)
     # Store for non-greedy model (we need the full return before we can do a backprop step)
@@ -213,7 +465,7 @@ def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, re
         # Average over batch
         # Divide by batches_step to mimic taking mean over larger batch
         loss = loss.mean() / args.batches_step  # For consistency: we generally set batches_step to 1 for greedy
-        loss.backward()
+        backward(loss, scaler)
 
         # For greedy: initialise next step by randomly picking one of the measurements for every slice
         # For non-greedy we will continue with the parallel sampled rows stored in masked_kspace, and
@@ -222,9 +474,14 @@ def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, re
         mask = mask[:, idx:idx + 1, :, :, :]
         masked_kspace = masked_kspace[:, idx:idx + 1, :, :, :]
         recons = recons[:, idx:idx + 1, :, :]
+        if features is not None:
+            features = features[:, idx:idx + 1]
+        step_scores = step_scores[:, idx:idx + 1]
 
     elif step != args.acquisition_steps - 1:  # Non-greedy but don't have full return yet.
         loss = torch.zeros(1)  # For logging
+    elif args.transition_replay:  # Final step, compute non-greedy return from stored transitions
+        loss = replay_transitions(args, model, state_list, action_list, reward_list, scaler)
     else:  # Final step, can compute non-greedy return
         reward_tensor = torch.stack(reward_list)
         for step, logprobs in enumerate(logprob_list):
@@ -237,9 +494,7 @@ def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, re
             num_traj = logprobs.size(-1)
             # REINFORCE with self-baselines
             # batch x k
-            # TODO: can also store transitions (s, a, r, s') pairs and recompute log probs when
-            #  doing gradients? Takes less memory, but more compute: can this be efficiently
-            #  batched?
+            # See replay_transitions() for a version that stores transitions and recomputes log probs
             loss = -1 * (logprobs * torch.sum(
                 gamma_ten * (reward_tensor[step:, :, :] - avg_rewards_tensor[step:, :, :]),
                 dim=0)) / (num_traj - 1)
@@ -248,6 +503,62 @@ def compute_backprop_trajectory(args, kspace, masked_kspace, mask, unnorm_gt, re
             # Average over batch
             # Divide by batches_step to mimic taking mean over larger batch
             loss = loss.mean() / args.batches_step
-            loss.backward()  # Store gradients
+            backward(loss, scaler)  # Store gradients
+
+    if score_list is not None:
+        # Scores of the reconstructions passed on to the next step
+        score_list.append(step_scores)
+    return loss, mask, masked_kspace, recons, features
 
-    return loss, mask, masked_kspace, recons
+
+def compute_discounted_returns(args, reward_tensor):
+    # Discounted sums of future self-baselined rewards for every step: steps x batch x num_traj
+    num_steps = reward_tensor.size(0)
+    advantages = reward_tensor - torch.mean(reward_tensor, dim=2, keepdim=True)
+    # discount[s, t] = gamma ** (t - s) for t >= s and 0 otherwise, so that a single matrix product computes the
+    # discounted reverse cumulative sums for all steps
+    t = torch.arange(num_steps, device=reward_tensor.device, dtype=reward_tensor.dtype)
+    discount = torch.triu(args.gamma ** (t.unsqueeze(0) - t.unsqueeze(1)).clamp(min=0))
+    return (discount @ advantages.view(num_steps, -1)).view_as(advantages)
+
+
+def replay_transitions(args, model, state_list, action_list, reward_list, scaler=None):
+    """
+    Non-greedy REINFORCE update from the stored (state, action, reward) transitions of a trajectory. Log-probabilities
+    of all actions are recomputed in batched policy forward passes of at most args.replay_chunk_size states (all
+    states at once if 0), each followed by its backward pass. Gives the same gradients as computing the loss during
+    the rollout (apart from dropout), but peak memory does not grow with the number of acquisition steps.
+
+    Returns:
+        torch.Tensor: Total loss, for logging.
+    """
+    returns = compute_discounted_returns(args, torch.stack(reward_list))
+    num_steps, batch_size, num_traj = returns.shape
+    # Flatten all states: batch states at step 0, batch . num_traj states at later steps. States are reconstructions or
+    # reconstruction features, see get_policy_input.
+    recons = torch.cat([r.reshape(r.size(0) * r.size(1), -1, r.size(-2), r.size(-1)) for r, _ in state_list])
+    masks = torch.cat([m.reshape(-1, 1, *m.shape[2:]) for _, m in state_list])
+    # Every transition refers to its state: the num_traj actions of step 0 share a state, later steps have one action
+    # per state
+    state_idx = [torch.arange(batch_size, device=recons.device).repeat_interleave(num_traj)]
+    offset = batch_size
+    for _ in range(1, num_steps):
+        state_idx.append(offset + torch.arange(batch_size * num_traj, device=recons.device))
+        offset += batch_size * num_traj
+    state_idx = torch.cat(state_idx)
+    actions = torch.cat([actions.reshape(-1) for actions in action_list])
+    returns = returns.reshape(-1)
+
+    chunk_size = args.replay_chunk_size if args.replay_chunk_size > 0 else recons.size(0)
+    total_loss = 0.
+    for start in range(0, recons.size(0), chunk_size):
+        end = start + chunk_size
+        _, probs = get_policy_probs(model, recons[start:end], masks[start:end], get_precision(args))
+        sel = (state_idx >= start) & (state_idx < end)
+        logprobs = torch.log(probs.squeeze(1)[state_idx[sel] - start, actions[sel]])
+        # Same normalisation as the per step losses: average over trajectories (with self-baseline) and batch
+        # Divide by batches_step to mimic taking mean over larger batch
+        loss = -1 * (logprobs * returns[sel]).sum() / ((num_traj - 1) * batch_size * args.batches_step)
+        backward(loss, scaler)  # Store gradients
+        total_loss += loss.item()
+    return torch.tensor(total_loss)
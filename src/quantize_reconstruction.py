@@ -0,0 +1,197 @@
+import io
+import copy
+import random
+import logging
+import pathlib
+import argparse
+
+import numpy as np
+import torch
+
+from src.helpers.torch_metrics import compute_ssim
+from src.helpers.utils import add_mask_params, save_json, str2none, time_function
+from src.helpers.data_loading import create_data_loader
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, prepare_quantization
+from src.policy_model.policy_model_utils import get_new_zf, acquire_rows_in_batch_parallel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def random_trajectory(args, data):
+    """
+    Zero-filled images along a random acquisition trajectory of a batch: the initial image, and the image after every
+    acquisition step. These are the inputs that the reconstruction model sees during policy training and evaluation.
+
+    Returns:
+        (tuple): list of acquisition_steps + 1 zero-filled images (batch x 1 x res x res), and the ground truth,
+            mean and std of the batch.
+    """
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, _, _ = data
+    # shape after unsqueeze = batch x channel x columns x rows x complex
+    kspace = kspace.unsqueeze(1)
+    masked_kspace = masked_kspace.unsqueeze(1)
+    mask = mask.unsqueeze(1)
+    gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3)
+    gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3)
+
+    # Random order of the unacquired rows of every slice
+    scores = torch.rand((mask.size(0), mask.size(-2))).masked_fill(mask.view(mask.size(0), -1) != 0, -1.)
+    rows = torch.topk(scores, args.acquisition_steps, dim=1)[1]
+    zfs = [zf.unsqueeze(1)]
+    for step in range(args.acquisition_steps):
+        mask, masked_kspace = acquire_rows_in_batch_parallel(kspace, masked_kspace, mask, rows[:, step:step + 1])
+        zfs.append(get_new_zf(masked_kspace)[0])
+    return zfs, gt.unsqueeze(1), gt_mean, gt_std
+
+
+def calibrate(args, model, loader):
+    # Runs model on the zero-filled images of random trajectories, so that observers record activation ranges
+    num_slices = 0
+    with torch.no_grad():
+        for data in loader:
+            zfs, _, _, _ = random_trajectory(args, data)
+            for zf in zfs:
+                model(zf)
+            num_slices += zfs[0].size(0)
+            if num_slices >= args.calibration_slices:
+                break
+    logger.info(f'Calibrated on {num_slices} slices, {args.acquisition_steps + 1} acquisition steps each.')
+
+
+def compare_ssim(args, model, quantized_model, loader):
+    # Mean SSIM of both models after every acquisition step of the same random trajectories
+    ssims = np.zeros((2, args.acquisition_steps + 1))
+    num_slices = 0
+    with torch.no_grad():
+        for data in loader:
+            zfs, gt, gt_mean, gt_std = random_trajectory(args, data)
+            unnorm_gt = gt * gt_std + gt_mean
+            data_range = unnorm_gt.flatten(1).max(dim=1)[0].view(-1, 1, 1, 1)
+            for step, zf in enumerate(zfs):
+                for i, recon_model in enumerate([model, quantized_model]):
+                    unnorm_recons = recon_model(zf) * gt_std + gt_mean
+                    ssim = compute_ssim(unnorm_recons, unnorm_gt, size_average=False, data_range=data_range)
+                    ssims[i, step] += ssim.mean(-1).mean(-1).sum().item()
+            num_slices += gt.size(0)
+            if num_slices >= args.eval_slices:
+                break
+    return ssims / num_slices
+
+
+def measure_latency(args, model, zf):
+    # Average wall time per call in seconds, after a warmup call
+    with torch.no_grad():
+        return time_function(lambda: model(zf), args.repeats, warmup=1)[1]
+
+
+def serialized_size(obj):
+    # Size in MB of obj (a state dict) saved with torch.save
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def main(args):
+    logger.info(args)
+    if args.seed != 0:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+    torch.backends.quantized.engine = args.backend
+
+    recon_args, model = load_recon_model(args)
+    model = model.module if isinstance(model, torch.nn.DataParallel) else model
+    model = model.cpu().eval()
+    quantized_model = prepare_quantization(recon_args, model, args.backend)
+
+    # Data settings of the reconstruction model, with the acquisition settings of policy training
+    data_args = copy.deepcopy(recon_args)
+    data_args.data_path = args.data_path
+    data_args.accelerations = args.accelerations
+    data_args.reciprocals_in_center = args.reciprocals_in_center
+    data_args.sample_rate = args.sample_rate
+    data_args.batch_size = data_args.val_batch_size = args.batch_size
+    data_args.num_workers = args.num_workers
+    data_args = add_mask_params(data_args)
+
+    calibrate(args, quantized_model, create_data_loader(data_args, 'train', shuffle=True))
+    torch.quantization.convert(quantized_model, inplace=True)
+
+    out_path = args.out_path or args.recon_model_checkpoint.parent / 'model_int8.pt'
+    quantized_args = copy.deepcopy(recon_args)
+    quantized_args.quantized = True
+    quantized_args.data_parallel = False
+    quantized_args.device = 'cpu'
+    quantized_args.quantization_backend = args.backend
+    torch.save({'epoch': 0, 'args': quantized_args, 'model': quantized_model, 'exp_dir': out_path.parent},
+               f=out_path)
+    logger.info(f'Saved quantized reconstruction model to {out_path}')
+
+    ssims = compare_ssim(args, model, quantized_model, create_data_loader(data_args, 'val'))
+    zf = torch.randn(args.batch_size, 1, recon_args.resolution, recon_args.resolution)
+    fp32_latency = measure_latency(args, model, zf)
+    int8_latency = measure_latency(args, quantized_model, zf)
+    # State dicts of both models, so that pickled module structure does not count towards either size
+    fp32_size, int8_size = serialized_size(model.state_dict()), serialized_size(quantized_model.state_dict())
+
+    logger.info('SSIM per acquisition step (fp32 / int8 / difference):')
+    for step in range(args.acquisition_steps + 1):
+        logger.info(f'  {step:3d}: {ssims[0, step]:.5f} / {ssims[1, step]:.5f} / '
+                    f'{ssims[1, step] - ssims[0, step]:+.5f}')
+    logger.info(f'Max abs SSIM difference: {np.abs(ssims[1] - ssims[0]).max():.5f}')
+    logger.info(f'CPU latency (batch {args.batch_size}): fp32 {fp32_latency * 1000:.2f}ms, '
+                f'int8 {int8_latency * 1000:.2f}ms, speedup {fp32_latency / int8_latency:.2f}x')
+    logger.info(f'Model size: fp32 {fp32_size:.2f}MB, int8 {int8_size:.2f}MB, '
+                f'savings {1 - int8_size / fp32_size:.1%}')
+    if args.report_path is not None:
+        report = {'fp32_ssim': ssims[0].tolist(), 'int8_ssim': ssims[1].tolist(),
+                  'fp32_latency_ms': fp32_latency * 1000, 'int8_latency_ms': int8_latency * 1000,
+                  'fp32_size_mb': fp32_size, 'int8_size_mb': int8_size}
+        save_json(args.report_path, dict(args={key: str(value) for key, value in vars(args).items()}, results=report))
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Creates an int8 version of a trained reconstruction model with '
+                                                 'post-training static quantization, for CPU reward computation in '
+                                                 'train_policy.py and run_baseline_models.py. Reports the SSIM '
+                                                 'difference with the fp32 model, and the CPU speedup and memory '
+                                                 'savings.')
+    parser.add_argument('--recon_model_checkpoint', type=pathlib.Path, required=True,
+                        help='Path to a pretrained (fp32) reconstruction model.')
+    parser.add_argument('--data_path', type=pathlib.Path, required=True,
+                        help='Path to the dataset. Training slices are used for calibration, validation slices for '
+                             'the SSIM comparison.')
+    parser.add_argument('--out_path', type=pathlib.Path, default=None,
+                        help='Path of the quantized checkpoint. Defaults to model_int8.pt next to the fp32 checkpoint.')
+    parser.add_argument('--report_path', type=str2none, default=None,
+                        help='Optional path of a json file for the report.')
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help="Quantized engine: 'fbgemm' for x86, 'qnnpack' for ARM.")
+    parser.add_argument('--calibration_slices', type=int, default=256,
+                        help='Number of training slices to calibrate activation ranges on.')
+    parser.add_argument('--eval_slices', type=int, default=256,
+                        help='Number of validation slices to compare SSIM on.')
+    parser.add_argument('--acquisition_steps', default=16, type=int,
+                        help='Acquisition steps of the random trajectories used for calibration and evaluation.')
+    parser.add_argument('--accelerations', nargs='+', default=[8], type=int,
+                        help='Ratio of k-space columns to be sampled at the start of a trajectory, as in '
+                             'train_policy.py.')
+    parser.add_argument('--reciprocals_in_center', nargs='+', default=[1], type=float,
+                        help='Inverse fraction of rows (after subsampling) that should be in the center, as in '
+                             'train_policy.py.')
+    parser.add_argument('--sample_rate', type=float, default=1.,
+                        help='Fraction of total volumes to include')
+    parser.add_argument('--batch_size', default=16, type=int, help='Mini batch size')
+    parser.add_argument('--repeats', default=10, type=int, help='Number of timed calls for the latency comparison.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers to use for data loading')
+    parser.add_argument('--seed', default=42, type=int, help='Seed for random number generators. '
+                                                             'Set to 0 to use random seed.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    # Quantized operators run on CPU
+    args.device = 'cpu'
+    main(args)
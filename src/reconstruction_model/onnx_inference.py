@@ -0,0 +1,50 @@
+import io
+
+import torch
+from torch import nn
+
+
+def export_onnx(model, resolution, opset_version=11):
+    """
+    Exports a reconstruction model to an ONNX graph with a dynamic batch dimension, taking zero-filled images
+    (batch x 1 x resolution x resolution) as input 'zf' and returning reconstructions as output 'recon'.
+
+    Returns:
+        (bytes): The serialised ONNX model.
+    """
+    model = model.eval()
+    example = torch.randn(2, 1, resolution, resolution, device=next(model.parameters()).device)
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(model, example, buffer, input_names=['zf'], output_names=['recon'],
+                          dynamic_axes={'zf': {0: 'batch'}, 'recon': {0: 'batch'}}, opset_version=opset_version)
+    return buffer.getvalue()
+
+
+class OnnxReconstructionModel(nn.Module):
+    """
+    Frozen reconstruction model run by an ONNX Runtime session, with all graph optimisations enabled. Called on
+    zero-filled images like UnetModel: inputs are copied to the host, and outputs back to the device of the inputs.
+    Uses the CUDA execution provider for device 'cuda' if it is available.
+    """
+
+    def __init__(self, onnx_model, device='cpu', num_threads=0):
+        import onnxruntime
+
+        super().__init__()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime use all cores
+        options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        if device == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(onnx_model, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, zf):
+        output = self.session.run(None, {self.input_name: zf.detach().float().contiguous().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(zf.device)
+
+    def __repr__(self):
+        return f'OnnxReconstructionModel(providers={self.session.get_providers()})'
@@ -108,6 +108,19 @@ class UnetModel(nn.Module):
         Returns:
             (torch.Tensor): Output tensor of shape [batch_size, self.out_chans, height, width]
         """
+        return self.forward_with_features(input)[0]
+
+    def forward_with_features(self, input):
+        """
+        Args:
+            input (torch.Tensor): Input tensor of shape [batch_size, self.in_chans, height, width]
+
+        Returns:
+            (torch.Tensor): Output tensor of shape [batch_size, self.out_chans, height, width]
+            (torch.Tensor): Bottleneck features (output of self.conv) of shape
+                [batch_size, self.chans * 2 ** (self.num_pool_layers - 1), height / 2 ** self.num_pool_layers,
+                width / 2 ** self.num_pool_layers]
+        """
         stack = []
         output = input
         # Apply down-sampling layers
@@ -117,13 +130,70 @@ class UnetModel(nn.Module):
             output = F.max_pool2d(output, kernel_size=2)
 
         output = self.conv(output)
+        features = output
 
         # Apply up-sampling layers
         for layer in self.up_sample_layers:
-            output = F.interpolate(output, scale_factor=2, mode='bilinear', align_corners=False)
+            output = F.interpolate(output, scale_factor=2., mode='bilinear', align_corners=False)  # float: scriptable
             output = torch.cat([output, stack.pop()], dim=1)
             output = layer(output)
-        return self.conv2(output)
+        return self.conv2(output), features
+
+
+class QuantizableUnetModel(UnetModel):
+    """
+    UnetModel for post-training static quantization (see quantize_reconstruction.py). Inputs are quantized and outputs
+    dequantized at the model boundary, skip connections are concatenated with quantization-aware FloatFunctionals, and
+    dropout (a no-op for the frozen model) is disabled. Loads the state dict of a UnetModel.
+    """
+
+    def __init__(self, in_chans, out_chans, chans, num_pool_layers, drop_prob):
+        super().__init__(in_chans, out_chans, chans, num_pool_layers, drop_prob)
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+        self.skip_cats = nn.ModuleList([nn.quantized.FloatFunctional() for _ in self.up_sample_layers])
+        # Replaced rather than removed, to keep the parameter names of UnetModel
+        for block in list(self.down_sample_layers) + [self.conv] + list(self.up_sample_layers):
+            for i, layer in enumerate(block.layers):
+                if isinstance(layer, nn.Dropout2d):
+                    block.layers[i] = nn.Identity()
+
+    def forward(self, input):
+        stack = []
+        output = self.quant(input)
+        # Apply down-sampling layers
+        for layer in self.down_sample_layers:
+            output = layer(output)
+            stack.append(output)
+            output = F.max_pool2d(output, kernel_size=2)
+
+        output = self.conv(output)
+
+        # Apply up-sampling layers
+        for layer, skip_cat in zip(self.up_sample_layers, self.skip_cats):
+            output = F.interpolate(output, scale_factor=2., mode='bilinear', align_corners=False)
+            output = skip_cat.cat([output, stack.pop()], dim=1)
+            output = layer(output)
+        return self.dequant(self.conv2(output))
+
+
+class ReconstructionWithFeatures(nn.Module):
+    """
+    Frozen UnetModel that returns its bottleneck features along with its reconstructions, from a single forward pass.
+    Used as reconstruction model for policies that take these features as input (see FeaturePolicyModel).
+    """
+
+    def __init__(self, recon_model):
+        super().__init__()
+        self.recon_model = recon_model
+
+    def forward(self, input):
+        return self.recon_model.forward_with_features(input)
+
+
+def feature_shape(recon_args):
+    # Number of channels and resolution of the bottleneck features of a UnetModel, see forward_with_features
+    return recon_args.num_chans * 2 ** (recon_args.num_pools - 1), recon_args.resolution // 2 ** recon_args.num_pools
 
 
 def build_reconstruction_model(args):
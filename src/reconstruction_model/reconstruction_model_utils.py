@@ -1,18 +1,36 @@
 import torch
 import h5py
+import pathlib
 import numpy as np
+from collections import OrderedDict
 
 from runstats import Statistics
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 
-from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
+from src.reconstruction_model.reconstruction_model_def import (build_reconstruction_model, UnetModel,
+                                                               QuantizableUnetModel, ReconstructionWithFeatures)
+from src.reconstruction_model.onnx_inference import OnnxReconstructionModel
 from src.helpers.utils import build_optim
+from src.helpers.distributed import load_state_dict, is_distributed
 from src.helpers import transforms
 
 
 def load_recon_model(args, optim=False):
     checkpoint = torch.load(args.recon_model_checkpoint)
     recon_args = checkpoint['args']
+    if getattr(recon_args, 'quantized', False):
+        # Int8 model created by quantize_reconstruction.py, stored as a module. Quantized operators only run on CPU.
+        assert not optim, 'Quantized reconstruction models cannot be trained.'
+        assert getattr(args, 'device', 'cpu') == 'cpu', "Quantized reconstruction models require device 'cpu'."
+        recon_model = checkpoint['model']
+        del checkpoint
+        return recon_args, recon_model
+    if getattr(recon_args, 'onnx', False):
+        # ONNX graph created by export_reconstruction_onnx.py, run by ONNX Runtime behind the same call interface
+        assert not optim, 'ONNX reconstruction models cannot be trained.'
+        recon_model = OnnxReconstructionModel(checkpoint['model'], getattr(args, 'device', 'cpu'))
+        del checkpoint
+        return recon_args, recon_model
     recon_model = build_reconstruction_model(recon_args)
 
     if not optim:
@@ -20,9 +38,10 @@ def load_recon_model(args, optim=False):
         for param in recon_model.parameters():
             param.requires_grad = False
 
-    if recon_args.data_parallel:  # if model was saved with data_parallel
+    # Loads checkpoints saved with or without a (Distributed)DataParallel wrapper
+    load_state_dict(recon_model, checkpoint['model'])
+    if recon_args.data_parallel and not is_distributed():
         recon_model = torch.nn.DataParallel(recon_model)
-    recon_model.load_state_dict(checkpoint['model'])
 
     start_epoch = checkpoint['epoch']
 
@@ -36,6 +55,31 @@ def load_recon_model(args, optim=False):
     return recon_args, recon_model
 
 
+def with_features(recon_model):
+    """
+    Wraps a reconstruction model from load_recon_model such that it returns its bottleneck features along with its
+    reconstructions (see ReconstructionWithFeatures). Only float UnetModels, optionally in DataParallel, expose them.
+    """
+    data_parallel = isinstance(recon_model, torch.nn.DataParallel)
+    module = recon_model.module if data_parallel else recon_model
+    assert isinstance(module, UnetModel) and not isinstance(module, QuantizableUnetModel), \
+        f'Reconstruction features are only available for float UnetModels, not {type(module).__name__}.'
+    recon_model = ReconstructionWithFeatures(module)
+    return torch.nn.DataParallel(recon_model) if data_parallel else recon_model
+
+
+def prepare_quantization(recon_args, model, backend):
+    # QuantizableUnetModel with the weights of the (fp32) UnetModel model, with observers for calibration on backend.
+    # Used by quantize_reconstruction.py.
+    quantized_model = QuantizableUnetModel(in_chans=1, out_chans=1, chans=recon_args.num_chans,
+                                           num_pool_layers=recon_args.num_pools, drop_prob=recon_args.drop_prob)
+    load_state_dict(quantized_model, model.state_dict())
+    quantized_model.eval()
+    quantized_model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantized_model, inplace=True)
+    return quantized_model
+
+
 def save_reconstructions(reconstructions, out_dir):
     """
     Saves the reconstructions from a model into h5 files that is appropriate for submission
@@ -97,6 +141,11 @@ class Metrics:
         for metric, func in METRIC_FUNCS.items():
             self.metrics[metric].push(func(target, recons))
 
+    def push_values(self, values):
+        # Push precomputed metric values, e.g. computed in a different process
+        for metric, value in values.items():
+            self.metrics[metric].push(value)
+
     def means(self):
         return {
             metric: stat.mean() for metric, stat in self.metrics.items()
@@ -137,4 +186,151 @@ def change_target_resolution(args, target):
     # Target is used as ground truth as before.
     target = transforms.to_tensor(target)
     target = transforms.center_crop(target, (args.resolution, args.resolution))
-    return target.numpy()
\ No newline at end of file
+    return target.numpy()
+
+
+class ReconstructionCache:
+    """
+    Bounded LRU cache of reconstructions and their SSIM / PSNR scores.
+
+    Only valid for a frozen reconstruction model: the reconstruction is then a deterministic function of the slice and
+    the set of acquired rows, which together make up the cache key. All entries are dropped whenever the
+    reconstruction model checkpoint changes on disk.
+    """
+
+    def __init__(self, max_mb, checkpoint=None):
+        """
+        Args:
+            max_mb (float): Maximum memory used by stored reconstructions, in MB.
+            checkpoint (pathlib.Path): Path to the reconstruction model checkpoint the cache is valid for.
+        """
+        self.max_bytes = max_mb * 1024 ** 2
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.checkpoint_id = None
+        self.hits = self.misses = 0
+        self.score_hits = self.score_misses = 0
+        if checkpoint is not None:
+            self.check_checkpoint(checkpoint)
+
+    def check_checkpoint(self, checkpoint):
+        checkpoint = pathlib.Path(checkpoint)
+        stat = checkpoint.stat()
+        checkpoint_id = (str(checkpoint.resolve()), stat.st_mtime, stat.st_size)
+        if checkpoint_id != self.checkpoint_id:
+            self.clear()
+            self.checkpoint_id = checkpoint_id
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    @staticmethod
+    def make_keys(slice_ids, mask):
+        """
+        Args:
+            slice_ids (list): (file name, slice index) for every slice in the batch.
+            mask (torch.Tensor): Mask tensor of shape [batch_size, num_trajectories, 1, resolution, 1]
+
+        Returns:
+            (list): Key for every entry of the flattened (batch . num_trajectories) dimension.
+        """
+        num_traj = mask.size(1)
+        rows = mask.reshape(mask.size(0) * num_traj, -1).to('cpu').numpy() > 0
+        # Packed bitset of acquired rows: 16 bytes at resolution 128
+        bitsets = np.packbits(rows, axis=1)
+        return [(slice_ids[i // num_traj], bitset.tobytes()) for i, bitset in enumerate(bitsets)]
+
+    @staticmethod
+    def _entry_bytes(entry):
+        return entry['recon'].numel() * entry['recon'].element_size()
+
+    def _store(self, key, entry):
+        if key in self.entries:  # Replaced entries no longer count towards the cache size
+            self.num_bytes -= self._entry_bytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.num_bytes += self._entry_bytes(entry)
+        while self.num_bytes > self.max_bytes and self.entries:
+            _, old = self.entries.popitem(last=False)
+            self.num_bytes -= self._entry_bytes(old)
+
+    def reconstruct(self, recon_model, zf, keys):
+        """
+        Reconstructs zero-filled images zf (N x 1 x H x W), only running recon_model for keys that are not cached.
+        """
+        entries = [self.entries.get(key) for key in keys]
+        for key, entry in zip(keys, entries):
+            if entry is not None:
+                self.entries.move_to_end(key)
+        miss = [i for i, entry in enumerate(entries) if entry is None]
+        self.hits += len(keys) - len(miss)
+        self.misses += len(miss)
+
+        recon = torch.empty_like(zf)
+        if len(miss) < len(keys):
+            hit = [i for i, entry in enumerate(entries) if entry is not None]
+            recon[hit] = torch.stack([entries[i]['recon'] for i in hit])
+        if miss:
+            # Keys that occur more than once (trajectories that share a state) are reconstructed and stored once
+            positions, unique_miss = {}, []
+            for i in miss:
+                if keys[i] not in positions:
+                    positions[keys[i]] = len(unique_miss)
+                    unique_miss.append(i)
+            new_recon = recon_model(zf[unique_miss])
+            recon[miss] = new_recon[[positions[keys[i]] for i in miss]]
+            for i, r in zip(unique_miss, new_recon):
+                # SSIMs are stored per precision of their convolutions, see score
+                self._store(keys[i], {'recon': r.detach().clone(), 'ssim': {}, 'psnr': None})
+        return recon
+
+    def score(self, keys, score_fn, comp_psnr=True, precision='fp32'):
+        """
+        Returns SSIM (and PSNR) scores for keys, only calling score_fn for keys without cached scores. SSIMs computed in
+        reduced precision (for rewards) are cached separately, so that they are never reused as evaluation scores.
+
+        Args:
+            keys (list): Cache keys to score.
+            score_fn (callable): Takes a LongTensor of positions into keys and returns their SSIM (and PSNR) scores,
+                as in compute_scores.
+            comp_psnr (bool): Whether to also return PSNR scores.
+            precision (str): Precision in which score_fn computes SSIM, see compute_scores.
+        """
+        entries = [self.entries.get(key) for key in keys]
+        miss = [i for i, entry in enumerate(entries) if entry is None or precision not in entry['ssim'] or
+                (comp_psnr and entry['psnr'] is None)]
+        self.score_hits += len(keys) - len(miss)
+        self.score_misses += len(miss)
+
+        miss_set = set(miss)
+        ssims = [None if i in miss_set else entry['ssim'][precision] for i, entry in enumerate(entries)]
+        psnrs = [None if i in miss_set else entry['psnr'] for i, entry in enumerate(entries)]
+        if miss:
+            new_scores = score_fn(torch.tensor(miss))
+            new_ssims, new_psnrs = new_scores if comp_psnr else (new_scores, None)
+            for j, i in enumerate(miss):
+                ssims[i] = new_ssims.view(-1)[j]
+                if comp_psnr:
+                    psnrs[i] = new_psnrs.view(-1)[j]
+                # Only store scores of cached reconstructions (they may have been evicted)
+                if entries[i] is not None:
+                    entries[i]['ssim'][precision] = ssims[i]
+                    if comp_psnr:
+                        entries[i]['psnr'] = psnrs[i]
+        if comp_psnr:
+            return torch.stack(ssims), torch.stack(psnrs)
+        return torch.stack(ssims)
+
+    def __repr__(self):
+        hit_rate = self.hits / max(self.hits + self.misses, 1)
+        score_hit_rate = self.score_hits / max(self.score_hits + self.score_misses, 1)
+        return (f'ReconstructionCache(entries={len(self.entries)}, '
+                f'size={self.num_bytes / 1024 ** 2:.1f}/{self.max_bytes / 1024 ** 2:.1f}MB, '
+                f'recon_hit_rate={hit_rate:.3f}, score_hit_rate={score_hit_rate:.3f})')
+
+
+def build_recon_cache(args):
+    # Reconstruction cache is opt-in: disabled if no memory is allotted to it
+    if args.recon_cache_mb <= 0:
+        return None
+    return ReconstructionCache(args.recon_cache_mb, checkpoint=args.recon_model_checkpoint)
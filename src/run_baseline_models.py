@@ -3,6 +3,7 @@ import time
 import datetime
 import random
 import argparse
+import copy
 import pathlib
 import wandb
 from random import choice
@@ -14,37 +15,133 @@ from torch.utils.data import DataLoader
 
 from tensorboardX import SummaryWriter
 
-from src.helpers.torch_metrics import compute_ssim, compute_psnr
-from src.helpers.utils import add_mask_params, save_json, str2bool, str2none
+from src.helpers.torch_metrics import compute_ssim, compute_psnr, StepMetrics
+from src.helpers.utils import add_mask_params, save_json, load_json, str2bool, str2none
 from src.helpers.data_loading import create_data_loader, SliceData, DataTransform
-from src.reconstruction_model.reconstruction_model_utils import load_recon_model
-from src.policy_model.policy_model_utils import create_data_range_dict, compute_next_step_reconstruction, compute_scores
+from src.helpers.chunked_execution import run_in_chunks
+from src.helpers.cpu_profile import add_cpu_profile_args, apply_cpu_profile, to_channels_last
+from src.helpers.precision import check_precision, apply_precision, get_precision, PRECISIONS
+from src.helpers import transforms
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, build_recon_cache
+from src.policy_model.policy_model_utils import (create_data_range_dict, compute_next_step_reconstruction,
+                                                 compute_initial_reconstruction, compute_scores,
+                                                 acquire_rows_in_batch_parallel, get_new_zf,
+                                                 reconstruct_masked_kspace)
+from src.policy_model.compiled_inference import compile_recon_model, COMPILE_MODES
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Baselines that do not adapt to the measurements: their rows are known before the rollout starts
+NON_ADAPTIVE_BASELINES = ['random', 'equispace_onesided', 'equispace_twosided', 'schedule']
 
-def compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model, data_range):
-    output = torch.zeros((kspace.shape[0], kspace.shape[-2]))
-    # Set all unacquired rows as rows to acquire
-    to_acquire = [[] for _ in range(kspace.shape[0])]
-    unacquired_inds = (mask.squeeze(1).squeeze(1).squeeze(-1) == 0).nonzero(as_tuple=False)
-    for sl, ind in unacquired_inds:
-        to_acquire[sl].append(ind)
-    to_acquire = torch.tensor(to_acquire)
-    _, _, _, recon = compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask, to_acquire)
-    ssim_scores = compute_scores(args, recon, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False)
-    old_slice, idx = -1, -1
-    for sl, ind in unacquired_inds:
-        if sl == old_slice:
-            idx += 1
-        else:
-            idx = 0
-            old_slice = sl
-        output[sl, ind] = ssim_scores[sl, idx]
+
+def get_unacquired_rows(mask):
+    """
+    Returns all unacquired rows of every slice as a (padded) batch x max_candidates tensor. Slices with fewer
+    unacquired rows are padded with their first unacquired row, see compute_all_scores.
+    """
+    unacquired = mask.view(mask.size(0), -1) == 0
+    res = unacquired.size(1)
+    num_candidates = unacquired.sum(dim=1, keepdim=True)
+    # Sort unacquired rows to the front, in increasing order
+    order = torch.argsort((~unacquired).long() * res + torch.arange(res, device=mask.device), dim=1)
+    to_acquire = order[:, :num_candidates.max()]
+    padding = torch.arange(to_acquire.size(1), device=mask.device).unsqueeze(0) >= num_candidates
+    return torch.where(padding, to_acquire[:, :1].expand_as(to_acquire), to_acquire)
+
+
+def compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model, data_range,
+                       cache=None, slice_ids=None, to_acquire=None):
+    # SSIM score of acquiring every candidate row (default: all unacquired rows) of every slice. Rows that are not
+    # evaluated get a score of 0.
+    if to_acquire is None:
+        to_acquire = get_unacquired_rows(mask)
+    output = torch.zeros((kspace.shape[0], kspace.shape[-2]), device=kspace.device)
+    if to_acquire.numel() == 0:
+        return output
+    _, _, _, recon, info = compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask, to_acquire,
+                                                            cache=cache, slice_ids=slice_ids, return_info=True,
+                                                            memory_mb=args.chunk_memory_mb)
+    ssim_scores = compute_scores(args, recon, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False, info=info,
+                                 precision=get_precision(args))
+    # Slices with fewer candidates are padded with their first candidate (see get_unacquired_rows): scatter the scores
+    # of padded columns to an extra column that is dropped
+    res = output.size(1)
+    padding = (to_acquire == to_acquire[:, :1]) & (torch.arange(to_acquire.size(1), device=kspace.device) > 0)
+    output = torch.cat([output, output[:, :1]], dim=1)
+    output.scatter_(1, to_acquire.masked_fill(padding, res), ssim_scores)
+    return output[:, :res]
+
+
+def compute_proxy_scores(args, kspace, masked_kspace, mask):
+    # Cheap proxy for the oracle score of acquiring every row: higher is better. Acquired rows get -inf.
+    if args.oracle_proxy == 'energy':
+        # k-space energy of every row
+        proxy = (kspace ** 2).sum(dim=-1).sum(dim=-2).view(kspace.size(0), -1)
+    elif args.oracle_proxy == 'lowres':
+        # Negative error of the zero-filled image after acquiring every row, computed at half resolution
+        to_acquire = get_unacquired_rows(mask)
+        res = kspace.size(-2) // 2
+
+        def lowres_error(k, mk, m, rows):
+            _, mk_exp = acquire_rows_in_batch_parallel(k, mk, m.clone(), rows)
+            zf = transforms.complex_abs(transforms.ifft2(transforms.complex_center_crop(mk_exp, (res, res))))
+            gt = transforms.complex_abs(transforms.ifft2(transforms.complex_center_crop(k, (res, res))))
+            return -((zf - gt) ** 2).mean(dim=(-2, -1))
+
+        errors = run_in_chunks(lowres_error, [kspace, masked_kspace, mask, to_acquire], args.chunk_memory_mb,
+                               'lowres_proxy')
+        proxy = torch.full((kspace.size(0), kspace.size(-2)), -float('inf'), device=kspace.device)
+        proxy.scatter_(1, to_acquire, errors)
+    else:
+        raise ValueError(f"'oracle_proxy' should be in ['energy', 'lowres'], not: {args.oracle_proxy}")
+    return proxy.masked_fill(mask.view(mask.size(0), -1) != 0, -float('inf'))
+
+
+def compute_oracle_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model, data_range,
+                          cache=None, slice_ids=None, agreement=None):
+    """
+    Oracle scores of acquiring every row. If args.oracle_top_k is set, only the top k candidates according to a cheap
+    proxy (args.oracle_proxy) are evaluated exactly. In that case, every args.oracle_check_interval calls the exhaustive
+    oracle is also computed, and agreement of the selected rows is tracked in the agreement dictionary.
+    """
+    if args.oracle_top_k <= 0:
+        return compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model,
+                                  data_range, cache, slice_ids)
+
+    proxy = compute_proxy_scores(args, kspace, masked_kspace, mask)
+    num_candidates = min(args.oracle_top_k, proxy.size(1))
+    proxy_vals, to_acquire = torch.topk(proxy, num_candidates, dim=1)
+    # If a slice has fewer unacquired rows than oracle_top_k, pad with its best candidate (see compute_all_scores)
+    to_acquire = torch.where(torch.isinf(proxy_vals), to_acquire[:, :1].expand_as(to_acquire), to_acquire)
+    output = compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model,
+                                data_range, cache, slice_ids, to_acquire=to_acquire)
+
+    if agreement is not None:
+        agreement['calls'] = agreement.get('calls', 0) + 1
+        if args.oracle_check_interval > 0 and agreement['calls'] % args.oracle_check_interval == 0:
+            full_output = compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std,
+                                             recon_model, data_range, cache, slice_ids)
+            best, best_rows = full_output.max(dim=1)
+            pruned_rows = output.max(dim=1)[1]
+            agreement['checked'] = agreement.get('checked', 0) + mask.size(0)
+            agreement['disagree'] = agreement.get('disagree', 0) + (best_rows != pruned_rows).sum().item()
+            # SSIM lost by choosing the pruned oracle's row instead of the exhaustive oracle's row
+            regret = best - full_output.gather(1, pruned_rows.unsqueeze(1)).squeeze(1)
+            agreement['regret'] = agreement.get('regret', 0.) + regret.sum().item()
     return output
 
 
+def log_oracle_agreement(agreement):
+    if not agreement.get('checked'):
+        return
+    logging.info(f"Pruned oracle (top {agreement.get('top_k')}): disagrees with exhaustive oracle on "
+                 f"{agreement['disagree']}/{agreement['checked']} checked slices "
+                 f"({agreement['disagree'] / agreement['checked']:.1%}), "
+                 f"mean SSIM regret {agreement['regret'] / agreement['checked']:.5f}")
+
+
 class StepMaskFunc:
     # Mask function for average_oracle
     def __init__(self, step, rows, accelerations):
@@ -101,157 +198,336 @@ def create_avg_oracle_loader(args, step, rows):
         dataset=dataset,
         batch_size=args.batch_size,
         num_workers=args.num_workers,
-        pin_memory=True,
+        pin_memory=getattr(args, 'pin_memory', True),
     )
     return loader
 
 
-def run_average_oracle(args, recon_model):
+def load_resident_partition(args):
+    """
+    Loads the partition once with the average_oracle starting masks, and keeps all slices in (CPU) memory. Rows chosen
+    by the average oracle are added to the stored masks in place, so the data does not have to be reloaded every step.
+    """
+    loader = create_avg_oracle_loader(args, 0, [])
+    batches = [data for data in loader]
+    data_range_dict = create_data_range_dict(args, batches)
+    # Zero-filled images and masked k-space are recomputed from the current masks every step
+    batches = [[kspace, mask, gt, gt_mean, gt_std, fname, sl_idx]
+               for kspace, _, mask, _, gt, gt_mean, gt_std, fname, sl_idx in batches]
+    return batches, data_range_dict
+
+
+def average_oracle_settings(args):
+    # Settings that have to match for an average_oracle run to be resumed
+    return {'dataset': args.dataset, 'partition': args.partition, 'resolution': args.resolution,
+            'accelerations': args.accelerations, 'acquisition_steps': args.acquisition_steps,
+            'sample_rate': args.sample_rate, 'acquisition': args.acquisition, 'center_volume': args.center_volume,
+            'recon_model_checkpoint': str(args.recon_model_checkpoint), 'oracle_top_k': args.oracle_top_k}
+
+
+def run_average_oracle(args, recon_model, cache=None):
     start = time.perf_counter()
-    rows = []
-    ssims = np.array([0. for _ in range(args.acquisition_steps + 1)])
-    psnrs = np.array([0. for _ in range(args.acquisition_steps + 1)])
+    agreement = {'top_k': args.oracle_top_k}  # Agreement of pruned and exhaustive oracle
+    batches, data_range_dict = load_resident_partition(args)
+
+    if args.resume_state is not None:
+        state = load_json(args.resume_state)
+        assert state['settings'] == average_oracle_settings(args), (
+            f"Settings of {args.resume_state} do not match this run: {state['settings']}")
+        logging.info(f"Resuming average_oracle at step {state['step']} with rows {state['rows']}")
+        # Add previously chosen rows to the starting masks
+        for batch in batches:
+            batch[1][:, :, state['rows'], :] = 1.
+    else:
+        state = {'settings': average_oracle_settings(args), 'step': 0, 'rows': [], 'tbs': 0,
+                 'ssims': [0. for _ in range(args.acquisition_steps + 1)],
+                 'psnrs': [0. for _ in range(args.acquisition_steps + 1)]}
+    rows = state['rows']
+    ssims = np.array(state['ssims'])
+    psnrs = np.array(state['psnrs'])
+    tbs = state['tbs']
+
     with torch.no_grad():
-        for step in range(args.acquisition_steps + 1):
-            # Loader for this step: includes starting rows and best rows from previous steps in mask
-            loader = create_avg_oracle_loader(args, step, rows)
-            data_range_dict = create_data_range_dict(args, loader)
+        for step in range(state['step'], args.acquisition_steps + 1):
+            # Stored masks include starting rows and best rows from previous steps
             sum_impros = 0.
-            tbs = 0.
+            # Sums of SSIM and PSNR over slices for this step, kept on the device until the end of the pass
+            step_metrics = StepMetrics(['ssim', 'psnr'], 1, args.device)
             # Find average best improvement over dataset for this step
-            for it, data in enumerate(loader):
-                kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, _ = data
+            for kspace, mask, gt, gt_mean, gt_std, fname, sl_idx in batches:
                 # shape after unsqueeze = batch x channel x columns x rows x complex
                 kspace = kspace.unsqueeze(1).to(args.device)
-                masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
-                mask = mask.unsqueeze(1).to(args.device)
+                # Copy: the stored masks must not be changed by acquiring candidate rows (done in place if there is a
+                # single candidate, see acquire_rows_in_batch_parallel), and are a view on CPU
+                mask = mask.unsqueeze(1).to(args.device).clone()
+                masked_kspace = kspace * mask
                 # shape after unsqueeze = batch x channel x columns x rows
-                zf = zf.unsqueeze(1).to(args.device)
+                zf, _, _ = get_new_zf(masked_kspace)
                 gt = gt.unsqueeze(1).to(args.device)
                 gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
                 gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
                 unnorm_gt = gt * gt_std + gt_mean
                 data_range = torch.stack([data_range_dict[vol] for vol in fname])
+                slice_ids = list(zip(fname, sl_idx.tolist()))
 
                 # Base reconstruction model forward pass
-                recon = recon_model(zf)
+                recon = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids)
                 unnorm_recon = recon * gt_std + gt_mean
                 ssim_val = compute_ssim(unnorm_recon, unnorm_gt, size_average=False,
-                                        data_range=data_range).mean(dim=(-1, -2)).sum()
-                psnr_val = compute_psnr(args, unnorm_recon, unnorm_gt, data_range).sum()
-                ssims[step] += ssim_val.item()
-                psnrs[step] += psnr_val.item()
+                                        data_range=data_range).mean(dim=(-1, -2))
+                psnr_val = compute_psnr(args, unnorm_recon, unnorm_gt, data_range)
+                step_metrics.push('ssim', ssim_val.squeeze(1))
+                step_metrics.push('psnr', psnr_val.squeeze(1))
 
-                tbs += mask.size(0)
                 if step != args.acquisition_steps:  # 'output' is required for acquisition
-                    output = compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std,
-                                                recon_model, data_range)
-                    output = output.to('cpu').numpy()
-                    sum_impros += output.sum(axis=0)  # sum of ssim_scores over slices for each measurement
-
+                    output = compute_oracle_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std,
+                                                   recon_model, data_range, cache, slice_ids, agreement)
+                    sum_impros += output.sum(dim=0)  # sum of ssim_scores over slices for each measurement
+
+            # Single sync per pass over the partition
+            totals = step_metrics.totals()
+            ssims[step] += totals['ssim'][0]
+            psnrs[step] += totals['psnr'][0]
+            tbs = int(step_metrics.counts[0, 0])
             if step != args.acquisition_steps:  # still acquire, otherwise just need final value, no acquisition
-                rows.append(np.argmax(sum_impros / tbs))
+                row = int(torch.argmax(sum_impros).item())
+                rows.append(row)
+                # Acquire chosen row for all slices
+                for batch in batches:
+                    batch[1][:, :, row, :] = 1.
+
+            # Store state after every step, so that the run can be resumed with resume_state
+            state.update({'step': step + 1, 'rows': rows, 'tbs': tbs, 'ssims': ssims.tolist(),
+                          'psnrs': psnrs.tolist()})
+            save_json(args.run_dir / 'average_oracle_state.json', state)
+            logging.info(f'Step {step}/{args.acquisition_steps}: SSIM = {ssims[step] / tbs:.4f}, rows = {rows}, '
+                         f'Time = {time.perf_counter() - start:.2f}s')
 
     ssims /= tbs
     psnrs /= tbs
 
+    if cache is not None:
+        logging.info(f'Cache = {cache}')
+    log_oracle_agreement(agreement)
     return ssims, psnrs, time.perf_counter() - start
 
 
-def run_baseline(args, recon_model, loader, data_range_dict):
+def load_schedule(path):
     """
-    Evaluates using SSIM of reconstruction over trajectory. Doesn't require computing targets!
+    Loads a fixed acquisition schedule: a JSON list of rows, or a JSON dictionary with a 'rows' entry (such as the
+    'average_oracle_state.json' file stored by an 'average_oracle' run).
     """
+    schedule = load_json(path)
+    if isinstance(schedule, dict):
+        schedule = schedule['rows']
+    return [int(row) for row in schedule]
 
-    ssims = 0
-    psnrs = 0
-    start = time.perf_counter()
-    tbs = 0
-    with torch.no_grad():
-        for it, data in enumerate(loader):
-            # logging.info('Batch {}/{}'.format(it + 1, len(loader)))
-            kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, _ = data
-            # shape after unsqueeze = batch x channel x columns x rows x complex
-            kspace = kspace.unsqueeze(1).to(args.device)
-            masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
-            mask = mask.unsqueeze(1).to(args.device)
-            # shape after unsqueeze = batch x channel x columns x rows
-            zf = zf.unsqueeze(1).to(args.device)
-            gt = gt.unsqueeze(1).to(args.device)
-            gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
-            gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
-            unnorm_gt = gt * gt_std + gt_mean
-            data_range = torch.stack([data_range_dict[vol] for vol in fname])
-            tbs += mask.size(0)
-
-            # Base reconstruction model forward pass
-            recon = recon_model(zf)
-            unnorm_recon = recon * gt_std + gt_mean
-            init_ssim_val = compute_ssim(unnorm_recon, unnorm_gt, size_average=False,
-                                         data_range=data_range).mean(dim=(-1, -2)).sum()
-            init_psnr_val = compute_psnr(args, unnorm_recon, unnorm_gt, data_range).sum()
-            batch_ssims = [init_ssim_val.item()]
-            batch_psnrs = [init_psnr_val.item()]
-
-            for step in range(args.acquisition_steps):
-                if args.model_type == 'oracle':
-                    output = compute_all_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std,
-                                                recon_model, data_range)
-                elif args.model_type == 'random':  # Generate random scores (set acquired to 0. to perform filtering)
-                    acquired = mask.squeeze().nonzero(as_tuple=False)
-                    output = torch.randn((mask.size(0), mask.size(-2)))
-                    output[acquired[:, 0], acquired[:, 1]] = 0.
-                    output = output.to(args.device)
-                elif args.model_type == 'equispace_twosided':
-                    interval = int(args.resolution * (1 - 1 / args.accelerations[0]))
-                    output = torch.zeros((mask.size(0), mask.size(-2)))
-                    equi = interval / args.acquisition_steps
-                    # Something like this: only tested for even acceleration and acquisition_steps
-                    if step < args.acquisition_steps // 2:
-                        select = int((step + 1) * equi - 1)
-                    else:
-                        select = int(args.resolution - (step + 1 - args.acquisition_steps // 2) * equi)
-                    output[:, select] = 1.
-                    output = output.to(args.device)
-                elif args.model_type == 'equispace_onesided':
-                    interval = int(args.resolution * (1 - 1 / args.accelerations[0]) / 2)
-                    output = torch.zeros((mask.size(0), mask.size(-2)))
-                    equi = interval / args.acquisition_steps
-                    # Something like this: only tested for even acceleration and acquisition_steps
-                    select = int((step + 1) * equi - 1)
-                    output[:, select] = 1.
-                    output = output.to(args.device)
-
-                # Greedy policy on computed targets (size = batch)
-                actions = torch.max(output, dim=1, keepdim=True)[1]
-                # Acquire this measurement
-                mask, masked_kspace, zf, recons = compute_next_step_reconstruction(recon_model, kspace,
-                                                                                   masked_kspace, mask, actions)
-                unnorm_recon = recons * gt_std + gt_mean
-                ssim_val = compute_ssim(unnorm_recon, unnorm_gt, size_average=False,
-                                        data_range=data_range).mean(dim=(-1, -2)).sum()
-                psnr_val = compute_psnr(args, unnorm_recon, unnorm_gt, data_range).sum()
-                # eventually shape = al_steps
-                batch_ssims.append(ssim_val.item())
-                batch_psnrs.append(psnr_val.item())
 
-            ssims += np.array(batch_ssims)
-            psnrs += np.array(batch_psnrs)
+def get_schedule(args, model_type, mask):
+    """
+    Returns the rows acquired by a non-adaptive baseline as a batch x acquisition_steps tensor: entry (i, t) is the
+    row acquired for slice i at step t.
+    """
+    batch_size, res = mask.size(0), mask.size(-2)
+    if model_type == 'random':
+        # Pre-drawn random permutation of the unacquired rows of every slice
+        scores = torch.rand((batch_size, res), device=mask.device)
+        scores = scores.masked_fill(mask.view(batch_size, -1) != 0, -1.)
+        return torch.topk(scores, args.acquisition_steps, dim=1)[1]
+
+    if model_type == 'equispace_twosided':
+        interval = int(args.resolution * (1 - 1 / args.accelerations[0]))
+        equi = interval / args.acquisition_steps
+        # Something like this: only tested for even acceleration and acquisition_steps
+        rows = [int((step + 1) * equi - 1) if step < args.acquisition_steps // 2 else
+                int(args.resolution - (step + 1 - args.acquisition_steps // 2) * equi)
+                for step in range(args.acquisition_steps)]
+    elif model_type == 'equispace_onesided':
+        interval = int(args.resolution * (1 - 1 / args.accelerations[0]) / 2)
+        equi = interval / args.acquisition_steps
+        # Something like this: only tested for even acceleration and acquisition_steps
+        rows = [int((step + 1) * equi - 1) for step in range(args.acquisition_steps)]
+    elif model_type == 'schedule':
+        assert len(args.schedule_rows) >= args.acquisition_steps, (
+            f'Schedule contains {len(args.schedule_rows)} rows, but {args.acquisition_steps} acquisition steps '
+            f'are required.')
+        rows = args.schedule_rows[:args.acquisition_steps]
+    else:
+        raise ValueError(f"'model_type' should be in {NON_ADAPTIVE_BASELINES}, not: {model_type}")
+    return torch.tensor(rows, dtype=torch.long, device=mask.device).unsqueeze(0).expand(batch_size, -1)
 
-    ssims /= tbs
-    psnrs /= tbs
 
-    return ssims, psnrs, time.perf_counter() - start
+def get_schedule_masks(mask, schedule):
+    """
+    Returns the masks after every step of a schedule (batch x acquisition_steps) as a
+    batch x acquisition_steps x 1 x res x 1 tensor.
+    """
+    batch_size, num_steps = schedule.shape
+    res = mask.size(-2)
+    # batch x steps x res: one-hot encoding of the row acquired at every step, accumulated over steps
+    acquired = torch.zeros((batch_size, num_steps, res), device=mask.device)
+    acquired.scatter_(2, schedule.unsqueeze(-1), 1.)
+    acquired = acquired.cumsum(dim=1)
+    return (mask + acquired.view(batch_size, num_steps, 1, res, 1)).clamp(max=1.)
+
+
+def prepare_batch(args, data, data_range_dict):
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = data
+    # shape after unsqueeze = batch x channel x columns x rows x complex
+    kspace = kspace.unsqueeze(1).to(args.device)
+    masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
+    mask = mask.unsqueeze(1).to(args.device)
+    # shape after unsqueeze = batch x channel x columns x rows
+    zf = zf.unsqueeze(1).to(args.device)
+    gt = gt.unsqueeze(1).to(args.device)
+    gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    unnorm_gt = gt * gt_std + gt_mean
+    data_range = torch.stack([data_range_dict[vol] for vol in fname])
+    slice_ids = list(zip(fname, sl_idx.tolist()))
+    return kspace, masked_kspace, mask, zf, unnorm_gt, gt_mean, gt_std, data_range, slice_ids
+
+
+def reconstruct_schedule_masks(args, recon_model, kspace, step_masks, cache=None, keys=None):
+    # Reconstructions (N x 1 x res x res) of kspace (batch x 1 x res x res x 2) under every mask in step_masks
+    # (batch x num_masks x 1 x res x 1), flattened to N = batch . num_masks. Chunks only receive the indices of their
+    # masks, so that k-space is masked per micro-batch rather than for all masks at once.
+    num_masks, res = step_masks.size(1), kspace.size(-2)
+    flat_masks = step_masks.view(-1, 1, 1, res, 1)
+    idx = torch.arange(flat_masks.size(0), device=kspace.device)
+
+    def masked_kspace(i):
+        return kspace[i // num_masks] * flat_masks[i]
+
+    if cache is not None:
+        zf = run_in_chunks(lambda i: get_new_zf(masked_kspace(i))[0], [idx], args.chunk_memory_mb,
+                           f'schedule_zero_filled_res{res}')
+        return cache.reconstruct(lambda z: run_in_chunks(recon_model, [z], args.chunk_memory_mb, 'reconstruction'),
+                                 zf, keys)
+    return run_in_chunks(lambda i: reconstruct_masked_kspace(recon_model, masked_kspace(i))[1], [idx],
+                         args.chunk_memory_mb, f'schedule_reconstruction_res{res}')
+
+
+def rollout_schedules(args, recon_model, kspace, mask, schedules, unnorm_gt, gt_mean, gt_std, data_range, cache=None,
+                      slice_ids=None):
+    """
+    SSIM and PSNR of every slice after every step of one or more schedules (batch x acquisition_steps each). The masks
+    of all steps of all schedules are treated as parallel trajectories and reconstructed as one batch (in
+    micro-batches if args.chunk_memory_mb is set).
 
+    Returns:
+        tuple: SSIM and PSNR scores, each a list of batch x acquisition_steps tensors (one per schedule).
+    """
+    # batch x (num_schedules . steps) x 1 x res x 1
+    step_masks = torch.cat([get_schedule_masks(mask, schedule) for schedule in schedules], dim=1)
+    num_masks, res = step_masks.size(1), kspace.size(-2)
+    info = {}
+    keys = None
+    if cache is not None:
+        keys = cache.make_keys(slice_ids, step_masks)
+        info['cache'], info['keys'] = cache, keys
+    recons = reconstruct_schedule_masks(args, recon_model, kspace, step_masks, cache, keys)
+    recons = recons.view(mask.size(0), num_masks, res, res)
+    ssim_scores, psnr_scores = compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=True,
+                                              info=info)
+    return ssim_scores.chunk(len(schedules), dim=1), psnr_scores.chunk(len(schedules), dim=1)
+
+
+def rollout_oracle(args, recon_model, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, data_range, cache=None,
+                   slice_ids=None, agreement=None):
+    """
+    SSIM and PSNR of every slice after every step of the greedy oracle, each of shape batch x acquisition_steps.
+    """
+    ssims, psnrs = [], []
+    for step in range(args.acquisition_steps):
+        output = compute_oracle_scores(args, kspace, masked_kspace, mask, unnorm_gt, gt_mean, gt_std, recon_model,
+                                       data_range, cache, slice_ids, agreement)
+        # Greedy policy on computed targets (size = batch)
+        actions = torch.max(output, dim=1, keepdim=True)[1]
+        # Acquire this measurement
+        mask, masked_kspace, zf, recons = compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask,
+                                                                           actions, cache=cache, slice_ids=slice_ids,
+                                                                           memory_mb=args.chunk_memory_mb)
+        ssim_scores, psnr_scores = compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range,
+                                                  comp_psnr=True)
+        ssims.append(ssim_scores)
+        psnrs.append(psnr_scores)
+    return torch.cat(ssims, dim=1), torch.cat(psnrs, dim=1)
+
+
+def run_baselines(args, model_types, recon_model, loader, data_range_dict, cache=None, run_dirs=None):
+    """
+    Evaluates baselines using SSIM of reconstruction over trajectory. Doesn't require computing targets!
 
-def main(args):
-    # For consistency
-    args.val_batch_size = args.batch_size
-    # Reconstruction model
-    recon_args, recon_model = load_recon_model(args)
-    # Add mask parameters for training
-    args = add_mask_params(args)
+    All baselines in model_types are run in a single pass over the data, sharing data loading, the initial
+    reconstruction and its scores. Non-adaptive baselines acquire rows from a schedule that is known in advance, so
+    the reconstructions for all steps of all their schedules are computed together. The oracle rollout is advanced
+    step by step on the same batch. If run_dirs (a run directory per baseline) is given, the sufficient statistics of
+    every baseline are stored there, so that results of shards can be combined with merge_eval_shards.py.
 
+    Returns:
+        dict: (ssims, psnrs, time) for every baseline in model_types. Time includes the time of the shared work.
+    """
+    scheduled = [model_type for model_type in model_types if model_type in NON_ADAPTIVE_BASELINES]
+    # Per step sums of SSIM and PSNR over slices, kept on the device until the end of the partition
+    metrics = {model_type: StepMetrics(['ssim', 'psnr'], args.acquisition_steps + 1, args.device, squares=True)
+               for model_type in model_types}
+    times = {model_type: 0. for model_type in model_types}
+    specific_time = 0.  # Time spent on work that is not shared by all baselines
+    start = time.perf_counter()
+    agreement = {'top_k': args.oracle_top_k}  # Agreement of pruned and exhaustive oracle
+    with torch.no_grad():
+        for it, data in enumerate(loader):
+            kspace, masked_kspace, mask, zf, unnorm_gt, gt_mean, gt_std, data_range, slice_ids = prepare_batch(
+                args, data, data_range_dict)
+
+            # Base reconstruction model forward pass, shared by all baselines
+            recon = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids)
+            init_ssim, init_psnr = compute_scores(args, recon, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=True)
+            for model_type in model_types:
+                metrics[model_type].push('ssim', init_ssim, step=0)
+                metrics[model_type].push('psnr', init_psnr, step=0)
+
+            if scheduled:
+                section_start = time.perf_counter()
+                schedules = [get_schedule(args, model_type, mask) for model_type in scheduled]
+                ssim_scores, psnr_scores = rollout_schedules(args, recon_model, kspace, mask, schedules, unnorm_gt,
+                                                             gt_mean, gt_std, data_range, cache, slice_ids)
+                for i, model_type in enumerate(scheduled):
+                    metrics[model_type].push('ssim', ssim_scores[i], step=1)
+                    metrics[model_type].push('psnr', psnr_scores[i], step=1)
+                section_time = time.perf_counter() - section_start
+                specific_time += section_time
+                for model_type in scheduled:
+                    times[model_type] += section_time
+
+            if 'oracle' in model_types:
+                section_start = time.perf_counter()
+                ssim_scores, psnr_scores = rollout_oracle(args, recon_model, kspace, masked_kspace, mask, unnorm_gt,
+                                                          gt_mean, gt_std, data_range, cache, slice_ids, agreement)
+                metrics['oracle'].push('ssim', ssim_scores, step=1)
+                metrics['oracle'].push('psnr', psnr_scores, step=1)
+                section_time = time.perf_counter() - section_start
+                specific_time += section_time
+                times['oracle'] += section_time
+
+    shared_time = time.perf_counter() - start - specific_time
+    if cache is not None:
+        logging.info(f'Cache = {cache}')
+    log_oracle_agreement(agreement)
+    results = {}
+    for model_type in model_types:
+        if run_dirs is not None:
+            metrics[model_type].save(
+                run_dirs[model_type] / f'{args.partition}_stats_shard{args.shard_index}of{args.num_shards}.json',
+                name=model_type, partition=args.partition, num_shards=args.num_shards, shard_index=args.shard_index)
+        # eventually shape = al_steps + 1
+        means = metrics[model_type].means()
+        results[model_type] = (means['ssim'], means['psnr'], shared_time + times[model_type])
+    return results
+
+
+def create_run_dir(args):
     # Create directory to store results in
     savestr = '{}_res{}_al{}_accel{}_{}_{}_{}'.format(args.dataset, args.resolution, args.acquisition_steps,
                                                       args.accelerations, args.model_type,
@@ -260,46 +536,84 @@ def main(args):
     args.run_dir = args.exp_dir / savestr
     args.run_dir.mkdir(parents=True, exist_ok=False)
 
-    if args.wandb:
-        wandb.config.update(args)
-
-    # Logging
-    logging.info(args)
-    logging.info(recon_model)
-    logging.info('Model type: {}'.format(args.model_type))
-
     # Save arguments for bookkeeping
     args_dict = {key: str(value) for key, value in args.__dict__.items()
                  if not key.startswith('__') and not callable(key)}
     save_json(args.run_dir / 'args.json', args_dict)
 
-    # Initialise summary writer
-    writer = SummaryWriter(log_dir=args.run_dir / 'summary')
-
-    if args.model_type == 'average_oracle':
-        baseline_ssims, baseline_psnrs, baseline_time = run_average_oracle(args, recon_model)
-    else:
-        # Create data loader
-        loader = create_data_loader(args, args.partition)
-        data_range_dict = create_data_range_dict(args, loader)
-        baseline_ssims, baseline_psnrs, baseline_time = run_baseline(args, recon_model, loader, data_range_dict)
 
+def log_baseline(args, baseline_ssims, baseline_psnrs, baseline_time):
     # Logging
+    logging.info('Model type: {}'.format(args.model_type))
     ssims_str = ", ".join(["{}: {:.4f}".format(i, l) for i, l in enumerate(baseline_ssims)])
     psnrs_str = ", ".join(["{}: {:.4f}".format(i, l) for i, l in enumerate(baseline_psnrs)])
     logging.info(f'  SSIM = [{ssims_str}]')
     logging.info(f'  PSNR = [{psnrs_str}]')
     logging.info(f'  Time = {baseline_time:.2f}s')
 
-    # For storing in wandb
+    # Initialise summary writer
+    writer = SummaryWriter(log_dir=args.run_dir / 'summary')
+
+    # For storing in wandb, as a separate run for every baseline
+    if args.wandb:
+        run = wandb.init(project=args.project, config=args, reinit=True)
     for epoch in range(args.num_epochs + 1):
         if args.wandb:
             wandb.log({f'{args.partition}_ssims': {str(key): val for key, val in enumerate(baseline_ssims)}}, step=epoch)
             wandb.log({f'{args.partition}_psnrs': {str(key): val for key, val in enumerate(baseline_psnrs)}}, step=epoch)
+    if args.wandb:
+        run.finish()
 
     writer.close()
 
 
+def main(args):
+    # For consistency
+    args.val_batch_size = args.batch_size
+    # Reconstruction model
+    check_precision(args)
+    recon_args, recon_model = load_recon_model(args)
+    recon_model = to_channels_last(args, recon_model)
+    recon_model = apply_precision(args, compile_recon_model(args, recon_model))
+    # Optional cache of reconstructions for the frozen reconstruction model
+    cache = build_recon_cache(args)
+    # Add mask parameters for training
+    args = add_mask_params(args)
+    # Remove duplicate baselines, keeping their order
+    model_types = list(dict.fromkeys(args.model_type))
+    if 'schedule' in model_types:
+        assert args.schedule_path is not None, "'schedule_path' is required for the 'schedule' baseline."
+        args.schedule_rows = load_schedule(args.schedule_path)
+
+    # Every baseline gets its own arguments and run directory, as if it was run separately
+    baseline_args = {}
+    for model_type in model_types:
+        baseline_args[model_type] = copy.copy(args)
+        baseline_args[model_type].model_type = model_type
+        create_run_dir(baseline_args[model_type])
+
+    # Logging
+    logging.info(args)
+    logging.info(recon_model)
+    logging.info('Model types: {}'.format(model_types))
+
+    results = {}
+    if 'average_oracle' in model_types:
+        # Requires a pass over the full partition for every step, so is not part of the shared pass
+        assert args.num_shards == 1, "'average_oracle' chooses rows based on all volumes, so cannot be sharded."
+        results['average_oracle'] = run_average_oracle(baseline_args['average_oracle'], recon_model, cache)
+    shared_types = [model_type for model_type in model_types if model_type != 'average_oracle']
+    if shared_types:
+        # Create data loader
+        loader = create_data_loader(args, args.partition)
+        data_range_dict = create_data_range_dict(args, loader)
+        run_dirs = {model_type: baseline_args[model_type].run_dir for model_type in shared_types}
+        results.update(run_baselines(args, shared_types, recon_model, loader, data_range_dict, cache, run_dirs))
+
+    for model_type in model_types:
+        log_baseline(baseline_args[model_type], *results[model_type])
+
+
 def create_arg_parser():
     parser = argparse.ArgumentParser()
 
@@ -311,8 +625,13 @@ def create_arg_parser():
     parser.add_argument('--wandb', type=str2bool, default=False,
                         help='Whether to use wandb logging for this run.')
     parser.add_argument('--model_type', choices=['random', 'oracle', 'average_oracle', 'equispace_onesided',
-                                                 'equispace_twosided'], required=True,
-                        help='Type of baseline to run.')
+                                                 'equispace_twosided', 'schedule'], nargs='+', required=True,
+                        help='Type(s) of baseline to run. If multiple types are given, they are run in a single pass '
+                             'over the data, sharing data loading and initial reconstructions, and results are stored '
+                             'in a separate run directory per baseline.')
+    parser.add_argument('--schedule_path', type=pathlib.Path, default=None,
+                        help="Path to a fixed acquisition schedule for the 'schedule' baseline: a JSON list of rows, "
+                             "or an 'average_oracle_state.json' file of an 'average_oracle' run.")
 
     parser.add_argument('--data_path', type=pathlib.Path, default=None,
                         help='Path to the dataset. Required for fastMRI training.')
@@ -350,6 +669,46 @@ def create_arg_parser():
                         help='Which data split to use.')
     parser.add_argument('--project', type=str2none, default=None,
                         help='Wandb project name to use.')
+    parser.add_argument('--chunk_memory_mb', type=float, default=0,
+                        help='Memory budget (in MB) for reconstructing and scoring all candidate rows of a batch. If '
+                             'set, these are processed in micro-batches with a size based on the measured memory use '
+                             'per sample, so the batch size does not need to be reduced for the oracle baselines. '
+                             'Set to 0 to process everything at once.')
+    parser.add_argument('--compiled_inference', type=str, default='eager', choices=COMPILE_MODES,
+                        help="Compiled execution of the frozen reconstruction model: TorchScript 'script' or "
+                             "'trace', or 'compile' for torch.compile where available. Compiled modules are checked "
+                             "against eager execution, which is used instead if they deviate by more than "
+                             "'compile_tolerance'.")
+    parser.add_argument('--compile_tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between compiled and eager outputs.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help="Precision of the reconstruction model forwards and of the SSIM convolutions used to "
+                             "score oracle candidates, using autocast: 'bf16' (CPU with oneDNN, or recent GPUs) or "
+                             "'fp16' (GPU). FFTs and evaluation metrics stay in float32.")
+    parser.add_argument('--oracle_top_k', type=int, default=0,
+                        help="If set, the 'oracle' and 'average_oracle' baselines only evaluate the top k candidate "
+                             "rows according to a cheap proxy score (see 'oracle_proxy'), instead of all unacquired "
+                             "rows. Set to 0 to use the exhaustive oracle.")
+    parser.add_argument('--oracle_proxy', type=str, choices=['energy', 'lowres'], default='energy',
+                        help="Proxy used to rank candidate rows for the pruned oracle: 'energy' uses the k-space "
+                             "energy of a row, 'lowres' the error of the zero-filled image at half resolution.")
+    parser.add_argument('--oracle_check_interval', type=int, default=10,
+                        help='When using a pruned oracle, also compute the exhaustive oracle every this many calls and '
+                             'report how often the chosen rows disagree. Set to 0 to disable.')
+    parser.add_argument('--resume_state', type=pathlib.Path, default=None,
+                        help="Path to an 'average_oracle_state.json' file of a previous 'average_oracle' run to resume "
+                             "from. The state of the new run is stored in its own run directory.")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards to split the volumes of the partition into. Every shard stores its '
+                             'sufficient statistics in its run directory, which can be combined with '
+                             'merge_eval_shards.py.')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help="Index of the shard of volumes to evaluate, in [0, 'num_shards').")
+    parser.add_argument('--recon_cache_mb', type=float, default=0,
+                        help='Memory (in MB) for an LRU cache of reconstructions and their scores, keyed by slice and '
+                             'acquired rows. Reconstructions are stored on the device they are computed on. Set to 0 '
+                             'to disable.')
+    add_cpu_profile_args(parser)
 
     return parser
 
@@ -361,6 +720,7 @@ if __name__ == '__main__':
     torch.multiprocessing.set_start_method('spawn')
 
     args = create_arg_parser().parse_args()
+    apply_cpu_profile(args)
     if args.seed != 0:
         random.seed(args.seed)
         np.random.seed(args.seed)
@@ -368,9 +728,6 @@ if __name__ == '__main__':
         if args.device == 'cuda':
             torch.cuda.manual_seed(args.seed)
 
-    if args.wandb:
-        wandb.init(project=args.project, config=args)
-
     # To get reproducible behaviour, additionally set args.num_workers = 0 and disable cudnn
     # torch.backends.cudnn.enabled = False
     main(args)
@@ -13,30 +13,55 @@ import torch
 import numpy as np
 from tensorboardX import SummaryWriter
 
-from src.helpers.torch_metrics import compute_ssim, compute_psnr
+from src.helpers.torch_metrics import compute_ssim, compute_psnr, rank_correlation, StepMetrics
 from src.helpers.utils import (add_mask_params, save_json, build_optim, count_parameters,
-                               count_trainable_parameters, count_untrainable_parameters, str2bool, str2none)
+                               count_trainable_parameters, count_untrainable_parameters, str2bool, str2none,
+                               time_function)
 from src.helpers.data_loading import create_data_loader
-from src.reconstruction_model.reconstruction_model_utils import load_recon_model
+from src.helpers.distributed import (init_distributed, is_distributed, is_main_process, wrap_model, unwrap_model,
+                                     all_reduce, NullWriter)
+from src.helpers.cpu_profile import add_cpu_profile_args, apply_cpu_profile, to_channels_last
+from src.helpers.precision import (check_precision, apply_precision, build_grad_scaler, get_precision, optimiser_step,
+                                   PRECISIONS)
+from src.reconstruction_model.reconstruction_model_def import feature_shape
+from src.reconstruction_model.reconstruction_model_utils import load_recon_model, build_recon_cache, with_features
 from src.policy_model.policy_model_utils import (build_policy_model, load_policy_model, save_policy_model,
                                                  compute_scores, create_data_range_dict, compute_backprop_trajectory,
-                                                 compute_next_step_reconstruction, get_policy_probs)
+                                                 compute_next_step_reconstruction, compute_initial_reconstruction,
+                                                 get_policy_probs, get_policy_input, compute_reward_scores,
+                                                 REWARD_FUNCS)
+from src.policy_model.policy_model_def import POLICY_HEADS
+from src.policy_model.actor_learner import start_actors, stop_actors, train_epoch_actor_learner
+from src.policy_model.compiled_inference import compile_recon_model, compile_policy_model, COMPILE_MODES
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Arguments that only affect how rollouts are computed, not the policy or its results. These are always taken from the
+# command line, also when resuming training or testing a stored policy model.
+RUNTIME_ARGS = ['dedup_actions', 'recon_cache_mb', 'chunk_memory_mb', 'transition_replay', 'replay_chunk_size',
+                'world_size', 'rank', 'local_rank', 'compiled_inference', 'compile_tolerance', 'precision',
+                'cpu_profile', 'channels_last', 'pin_memory', 'worker_core_list', 'final_recon_model_checkpoint']
 
-def train_epoch(args, epoch, recon_model, model, loader, optimiser, writer, data_range_dict):
+
+def train_epoch(args, epoch, recon_model, model, loader, optimiser, writer, data_range_dict, cache=None,
+                scaler=None):
     model.train()
     epoch_loss = [0. for _ in range(args.acquisition_steps)]
     report_loss = [0. for _ in range(args.acquisition_steps)]
+    # Number of unique and total reconstructions per step, for logging duplicate actions
+    epoch_dedup = np.zeros((args.acquisition_steps, 2))
     start_epoch = start_iter = time.perf_counter()
     global_step = epoch * len(loader)
+    if cache is not None:
+        cache.check_checkpoint(args.recon_model_checkpoint)
+    if hasattr(loader.sampler, 'set_epoch'):  # Different shuffle of the distributed training data every epoch
+        loader.sampler.set_epoch(epoch)
 
     cbatch = 0  # Counter for spreading single backprop batch over multiple data loader batches
     for it, data in enumerate(loader):  # Loop over data points
         cbatch += 1
-        kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, _ = data
+        kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = data
         # shape after unsqueeze = batch x channel x columns x rows x complex
         kspace = kspace.unsqueeze(1).to(args.device)
         masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
@@ -48,9 +73,10 @@ def train_epoch(args, epoch, recon_model, model, loader, optimiser, writer, data
         gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
         unnorm_gt = gt * gt_std + gt_mean  # Unnormalise ground truth image for SSIM calculations
         data_range = torch.stack([data_range_dict[vol] for vol in fname])  # For SSIM calculations
+        slice_ids = list(zip(fname, sl_idx.tolist()))  # For reconstruction cache lookups
 
         # Base reconstruction model forward pass: input to policy model
-        recons = recon_model(zf)
+        recons, features = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids, return_features=True)
 
         if cbatch == 1:  # Only after backprop is performed
             optimiser.zero_grad()
@@ -58,20 +84,27 @@ def train_epoch(args, epoch, recon_model, model, loader, optimiser, writer, data
         action_list = []
         logprob_list = []
         reward_list = []
+        dedup_list = []
+        score_list = []  # Reward scores of the reconstructions of every step, reused as base score for the next step
+        state_list = []  # States of the trajectory, for non-greedy training with transition_replay
         for step in range(args.acquisition_steps):  # Loop over acquisition steps
             # TODO: check that this works!
-            loss, mask, masked_kspace, recons = compute_backprop_trajectory(args, kspace, masked_kspace, mask,
-                                                                            unnorm_gt, recons, gt_mean, gt_std,
-                                                                            data_range, model, recon_model, step,
-                                                                            action_list, logprob_list, reward_list)
+            loss, mask, masked_kspace, recons, features = compute_backprop_trajectory(
+                args, kspace, masked_kspace, mask, unnorm_gt, recons, gt_mean, gt_std, data_range, model, recon_model,
+                step, action_list, logprob_list, reward_list, dedup_list, cache, slice_ids, score_list, state_list,
+                scaler, features)
             # Loss logging
             epoch_loss[step] += loss.item() / len(loader) * gt.size(0) / args.batch_size
             report_loss[step] += loss.item() / args.report_interval * gt.size(0) / args.batch_size
             writer.add_scalar('TrainLoss_step{}'.format(step), loss.item(), global_step + it)
+            if args.dedup_actions:
+                num_unique, num_total = dedup_list[step]
+                epoch_dedup[step] += (num_unique, num_total)
+                writer.add_scalar('TrainDupRate_step{}'.format(step), 1 - num_unique / num_total, global_step + it)
 
         # Backprop if we've reached the prerequisite number of dataloader batches
         if cbatch == args.batches_step:
-            optimiser.step()
+            optimiser_step(optimiser, scaler)
             cbatch = 0
 
         # Logging: note that loss values mean little, as the Policy Gradient loss is not a true loss.
@@ -91,23 +124,47 @@ def train_epoch(args, epoch, recon_model, model, loader, optimiser, writer, data
 
         start_iter = time.perf_counter()
 
+    if args.dedup_actions:
+        log_dedup_stats(epoch, writer, 'Train', epoch_dedup)
+    if cache is not None:
+        logging.info(f'TrainCache = {cache}')
+
     if args.wandb:
         wandb.log({'train_loss_step': {str(key + 1): val for key, val in enumerate(epoch_loss)}}, step=epoch + 1)
 
     return np.mean(epoch_loss), time.perf_counter() - start_epoch
 
 
-def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_range_dict):
+def log_dedup_stats(epoch, writer, partition, dedup_counts):
+    # dedup_counts: steps x 2 array of (unique, total) reconstructions per acquisition step
+    dup_rates = 1 - dedup_counts[:, 0] / dedup_counts[:, 1]
+    saved = dedup_counts[:, 1] - dedup_counts[:, 0]
+    for step, (rate, num_saved) in enumerate(zip(dup_rates, saved)):
+        writer.add_scalar(f'{partition}EpochDupRate_step{step}', rate, epoch)
+        writer.add_scalar(f'{partition}ReconsSaved_step{step}', num_saved, epoch)
+    rates_str = ", ".join(["{}: {:.3f}".format(i + 1, r) for i, r in enumerate(dup_rates)])
+    logging.info(f'{partition}DupRate = [{rates_str}]')
+    logging.info(f'{partition}ReconsSaved = {int(saved.sum())} of {int(dedup_counts[:, 1].sum())} '
+                 f'({saved.sum() / dedup_counts[:, 1].sum():.1%})')
+
+
+def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_range_dict, cache=None):
     """
     Evaluates using SSIM of reconstruction over trajectory. Doesn't require computing targets!
     """
     model.eval()
-    ssims, psnrs = 0, 0
-    tbs = 0  # data set size counter
+    if is_distributed():
+        # Processes evaluate different numbers of slices: do not synchronise forward passes
+        model = unwrap_model(model)
+    # Per step sums of SSIM and PSNR over slices, kept on the device until the end of the partition
+    metrics = StepMetrics(['ssim', 'psnr'], args.acquisition_steps + 1, args.device, squares=True)
+    dedup_counts = np.zeros((args.acquisition_steps, 2))
     start = time.perf_counter()
+    if cache is not None:
+        cache.check_checkpoint(args.recon_model_checkpoint)
     with torch.no_grad():
         for it, data in enumerate(loader):
-            kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, _ = data
+            kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = data
             # shape after unsqueeze = batch x channel x columns x rows x complex
             kspace = kspace.unsqueeze(1).to(args.device)
             masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
@@ -119,20 +176,21 @@ def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_ra
             gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
             unnorm_gt = gt * gt_std + gt_mean
             data_range = torch.stack([data_range_dict[vol] for vol in fname])
-            tbs += mask.size(0)
+            slice_ids = list(zip(fname, sl_idx.tolist()))
 
             # Base reconstruction model forward pass
-            recons = recon_model(zf)
+            recons, features = compute_initial_reconstruction(recon_model, zf, mask, cache, slice_ids,
+                                                              return_features=True)
             unnorm_recons = recons[:, :, :, :] * gt_std + gt_mean
             init_ssim_val = compute_ssim(unnorm_recons, unnorm_gt, size_average=False,
-                                         data_range=data_range).mean(dim=(-1, -2)).sum()
-            init_psnr_val = compute_psnr(args, unnorm_recons, unnorm_gt, data_range).sum()
-
-            batch_ssims = [init_ssim_val.item()]
-            batch_psnrs = [init_psnr_val.item()]
+                                         data_range=data_range).mean(dim=(-1, -2))
+            init_psnr_val = compute_psnr(args, unnorm_recons, unnorm_gt, data_range)
+            metrics.push('ssim', init_ssim_val.squeeze(1), step=0)
+            metrics.push('psnr', init_psnr_val.squeeze(1), step=0)
 
             for step in range(args.acquisition_steps):
-                policy, probs = get_policy_probs(model, recons, mask)
+                policy, probs = get_policy_probs(model, get_policy_input(recons, features), mask,
+                                                 get_precision(args))
                 if step == 0:
                     actions = torch.multinomial(probs.squeeze(1), args.num_test_trajectories, replacement=True)
                 else:
@@ -141,26 +199,36 @@ def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_ra
                 # For evaluation we can treat greedy and non-greedy the same: in both cases we just simulate
                 # num_test_trajectories acquisition trajectories in parallel for each slice in the batch, and store
                 # the average SSIM score every time step.
-                mask, masked_kspace, zf, recons = compute_next_step_reconstruction(recon_model, kspace,
-                                                                                   masked_kspace, mask, actions)
+                mask, masked_kspace, zf, recons, features, info = compute_next_step_reconstruction(
+                    recon_model, kspace, masked_kspace, mask, actions, dedup=args.dedup_actions, cache=cache,
+                    slice_ids=slice_ids, return_info=True, memory_mb=args.chunk_memory_mb, return_features=True)
+                if args.dedup_actions:
+                    dedup_counts[step] += (info['unique_idx'].numel(), info['inverse'].numel())
                 ssim_scores, psnr_scores = compute_scores(args, recons, gt_mean, gt_std, unnorm_gt, data_range,
-                                                          comp_psnr=True)
+                                                          comp_psnr=True, info=info)
                 assert len(ssim_scores.shape) == 2
-                ssim_scores = ssim_scores.mean(-1).sum()
-                psnr_scores = psnr_scores.mean(-1).sum()
-                # eventually shape = al_steps
-                batch_ssims.append(ssim_scores.item())
-                batch_psnrs.append(psnr_scores.item())
-
-            # shape of al_steps
-            ssims += np.array(batch_ssims)
-            psnrs += np.array(batch_psnrs)
-
-    ssims /= tbs
-    psnrs /= tbs
+                # Average over trajectories of every slice
+                metrics.push('ssim', ssim_scores.mean(-1), step=step + 1)
+                metrics.push('psnr', psnr_scores.mean(-1), step=step + 1)
+
+    # Sum the scores of the volumes evaluated by all processes
+    metrics.all_reduce()
+    if args.dedup_actions:
+        dedup_counts = all_reduce(torch.from_numpy(dedup_counts).to(args.device)).cpu().numpy()
+    # Single sync of all accumulated scores, shape of al_steps + 1
+    means = metrics.means()
+    ssims, psnrs = means['ssim'], means['psnr']
+    ssim_cis = metrics.confidence_intervals()['ssim']
+    logging.info(f'{partition}SSIM 95% CI half width: step 0 = {ssim_cis[0]:.4f}, '
+                 f'step {args.acquisition_steps} = {ssim_cis[-1]:.4f}')
+
+    if args.dedup_actions:
+        log_dedup_stats(epoch, writer, partition, dedup_counts)
+    if cache is not None:
+        logging.info(f'{partition}Cache = {cache}')
 
     # Logging
-    if partition in ['Val', 'Train']:
+    if partition in ['Val', 'Train', 'ValFinal']:  # ValFinal: validation with final_recon_model_checkpoint
         for step, val in enumerate(ssims):
             writer.add_scalar(f'{partition}SSIM_step{step}', val, epoch)
             writer.add_scalar(f'{partition}PSNR_step{step}', psnrs[step], epoch)
@@ -170,6 +238,11 @@ def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_ra
             wandb.log({f'{partition.lower()}_psnrs': {str(key): val for key, val in enumerate(psnrs)}}, step=epoch + 1)
 
     elif partition == 'Test':
+        # Sufficient statistics of this (shard of the) test set, see merge_eval_shards.py
+        if is_main_process():
+            metrics.save(args.run_dir / f'test_stats_shard{args.shard_index}of{args.num_shards}.json',
+                         name=str(args.policy_model_checkpoint), partition=partition.lower(),
+                         num_shards=args.num_shards, shard_index=args.shard_index)
         # Only computed once, so loop over all epochs for wandb logging
         if args.wandb:
             for epoch in range(args.num_epochs):
@@ -179,13 +252,13 @@ def evaluate(args, epoch, recon_model, model, loader, writer, partition, data_ra
                           step=epoch + 1)
 
     else:
-        raise ValueError(f"'partition' should be in ['Train', 'Val', 'Test'], not: {partition}")
+        raise ValueError(f"'partition' should be in ['Train', 'Val', 'ValFinal', 'Test'], not: {partition}")
 
     return ssims, psnrs, time.perf_counter() - start
 
 
 # TODO: Separate eval on test data script?
-def train_and_eval(args, recon_args, recon_model):
+def train_and_eval(args, recon_args, recon_model, cache=None):
     if args.resume:
         # Check that this works
         resumed = True
@@ -194,6 +267,7 @@ def train_and_eval(args, recon_args, recon_model):
         # In case models have been moved to a different machine, make sure the path to the recon model is the
         # path provided.
         recon_model_checkpoint = args.recon_model_checkpoint
+        runtime_args = {key: getattr(args, key) for key in RUNTIME_ARGS}
 
         model, args, start_epoch, optimiser = load_policy_model(pathlib.Path(args.policy_model_checkpoint), optim=True)
 
@@ -204,15 +278,19 @@ def train_and_eval(args, recon_args, recon_model):
         args.recon_model_checkpoint = recon_model_checkpoint
         args.run_dir = new_run_dir
         args.data_path = data_path
+        for key, value in runtime_args.items():
+            setattr(args, key, value)
         args.resume = True
+        model = to_channels_last(args, model)
+        if is_distributed():
+            model = wrap_model(args, model)
     else:
         resumed = False
         # Improvement model to train
-        model = build_policy_model(args)
+        model = to_channels_last(args, build_policy_model(args))
         # Add mask parameters for training
         args = add_mask_params(args)
-        if args.data_parallel:
-            model = torch.nn.DataParallel(model)
+        model = wrap_model(args, model)
         optimiser = build_optim(args, model.parameters())
         start_epoch = 0
         # Create directory to store results in
@@ -221,7 +299,8 @@ def train_and_eval(args, recon_args, recon_model):
                                                            datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
                                                            ''.join(choice(ascii_uppercase) for _ in range(5)))
         args.run_dir = args.exp_dir / savestr
-        args.run_dir.mkdir(parents=True, exist_ok=False)
+        if is_main_process():  # Only the main process stores results
+            args.run_dir.mkdir(parents=True, exist_ok=False)
 
     args.resumed = resumed
 
@@ -236,10 +315,11 @@ def train_and_eval(args, recon_args, recon_model):
     # Save arguments for bookkeeping
     args_dict = {key: str(value) for key, value in args.__dict__.items()
                  if not key.startswith('__') and not callable(key)}
-    save_json(args.run_dir / 'args.json', args_dict)
+    if is_main_process():
+        save_json(args.run_dir / 'args.json', args_dict)
 
     # Initialise summary writer
-    writer = SummaryWriter(log_dir=args.run_dir / 'summary')
+    writer = SummaryWriter(log_dir=args.run_dir / 'summary') if is_main_process() else NullWriter()
 
     # Parameter counting
     logging.info('Reconstruction model parameters: total {}, of which {} trainable and {} untrainable'.format(
@@ -266,27 +346,54 @@ def train_and_eval(args, recon_args, recon_model):
 
     if not args.resume:
         if args.do_train_ssim:
-            do_and_log_evaluation(args, -1, recon_model, model, train_loader, writer, 'Train', train_data_range_dict)
-        do_and_log_evaluation(args, -1, recon_model, model, dev_loader, writer, 'Val', dev_data_range_dict)
+            do_and_log_evaluation(args, -1, recon_model, model, train_loader, writer, 'Train', train_data_range_dict,
+                                  cache)
+        do_and_log_evaluation(args, -1, recon_model, model, dev_loader, writer, 'Val', dev_data_range_dict, cache)
+
+    # Older stored models do not have the actor-learner arguments
+    actor_learner = getattr(args, 'actor_learner', False)
+    if actor_learner:
+        # Actor processes roll out the policy on their own shard of the training data, while this process learns
+        publisher, queue, actors = start_actors(args, model, start_epoch)
+        num_updates = 0
+    # Loss scaling for fp16 training (None otherwise)
+    scaler = build_grad_scaler(args)
 
     for epoch in range(start_epoch, args.num_epochs):
-        train_loss, train_time = train_epoch(args, epoch, recon_model, model, train_loader, optimiser, writer,
-                                             train_data_range_dict)
+        if actor_learner:
+            train_loss, train_time, num_updates, num_slices = train_epoch_actor_learner(
+                args, epoch, model, optimiser, writer, publisher, queue, num_updates, scaler)
+        else:
+            train_loss, train_time = train_epoch(args, epoch, recon_model, model, train_loader, optimiser, writer,
+                                                 train_data_range_dict, cache, scaler)
+            num_slices = len(train_loader.dataset)
         logging.info(
             f'Epoch = [{epoch+1:3d}/{args.num_epochs:3d}] TrainLoss = {train_loss:.3g} TrainTime = {train_time:.2f}s '
+            f'TrainThroughput = {num_slices / train_time:.2f} slices/s'
         )
 
         if args.do_train_ssim:
-            do_and_log_evaluation(args, epoch, recon_model, model, train_loader, writer, 'Train', train_data_range_dict)
-        do_and_log_evaluation(args, epoch, recon_model, model, dev_loader, writer, 'Val', dev_data_range_dict)
+            do_and_log_evaluation(args, epoch, recon_model, model, train_loader, writer, 'Train', train_data_range_dict,
+                                  cache)
+        do_and_log_evaluation(args, epoch, recon_model, model, dev_loader, writer, 'Val', dev_data_range_dict, cache)
 
         scheduler.step()
-        save_policy_model(args, args.run_dir, epoch, model, optimiser)
+        if is_main_process():
+            save_policy_model(args, args.run_dir, epoch, model, optimiser)
+    if actor_learner:
+        stop_actors(actors)
+    if args.final_recon_model_checkpoint is not None:
+        # E.g. the teacher of the distilled reconstruction model the policy was trained with
+        _, final_recon_model = load_frozen_recon_model(args, args.final_recon_model_checkpoint,
+                                                       getattr(args, 'policy_input', 'recon') == 'recon_features')
+        do_and_log_evaluation(args, args.num_epochs, final_recon_model, model, dev_loader, writer, 'ValFinal',
+                              dev_data_range_dict)
     writer.close()
 
 
-def do_and_log_evaluation(args, epoch, recon_model, model, loader, writer, partition, data_range_dict):
-    ssims, psnrs, score_time = evaluate(args, epoch, recon_model, model, loader, writer, partition, data_range_dict)
+def do_and_log_evaluation(args, epoch, recon_model, model, loader, writer, partition, data_range_dict, cache=None):
+    ssims, psnrs, score_time = evaluate(args, epoch, recon_model, model, loader, writer, partition, data_range_dict,
+                                        cache)
     ssims_str = ", ".join(["{}: {:.4f}".format(i, l) for i, l in enumerate(ssims)])
     psnrs_str = ", ".join(["{}: {:.3f}".format(i, l) for i, l in enumerate(psnrs)])
     logging.info(f'{partition}SSIM = [{ssims_str}]')
@@ -294,13 +401,22 @@ def do_and_log_evaluation(args, epoch, recon_model, model, loader, writer, parti
     logging.info(f'{partition}ScoreTime = {score_time:.2f}s')
 
 
-def test(args, recon_model):
+def test(args, recon_model, cache=None):
     model, policy_args = load_policy_model(pathlib.Path(args.policy_model_checkpoint))
 
     # Overwrite number of trajectories to test on
     policy_args.num_test_trajectories = args.num_test_trajectories
+    policy_args.recon_model_checkpoint = args.recon_model_checkpoint
+    for key in RUNTIME_ARGS:
+        setattr(policy_args, key, getattr(args, key))
+    # Only evaluate this shard of the test volumes
+    policy_args.num_shards = args.num_shards
+    policy_args.shard_index = args.shard_index
+    policy_args.policy_model_checkpoint = args.policy_model_checkpoint
     if args.data_path is not None:  # Overwrite data path if provided
         policy_args.data_path = args.data_path
+    # The policy model is only evaluated
+    model = compile_policy_model(policy_args, to_channels_last(policy_args, model))
 
     # Logging of policy model
     logging.info(args)
@@ -310,7 +426,7 @@ def test(args, recon_model):
         wandb.config.update(args)
         wandb.watch(model, log='all')
     # Initialise summary writer
-    writer = SummaryWriter(log_dir=policy_args.run_dir / 'summary')
+    writer = SummaryWriter(log_dir=policy_args.run_dir / 'summary') if is_main_process() else NullWriter()
 
     # Parameter counting
     logging.info('Reconstruction model parameters: total {}, of which {} trainable and {} untrainable'.format(
@@ -323,21 +439,117 @@ def test(args, recon_model):
     test_loader = create_data_loader(policy_args, 'test', shuffle=False)
     test_data_range_dict = create_data_range_dict(policy_args, test_loader)
 
-    do_and_log_evaluation(policy_args, -1, recon_model, model, test_loader, writer, 'Test', test_data_range_dict)
+    do_and_log_evaluation(policy_args, -1, recon_model, model, test_loader, writer, 'Test', test_data_range_dict,
+                          cache)
 
     writer.close()
 
 
+def load_frozen_recon_model(args, checkpoint, features=False):
+    # Reconstruction model in checkpoint, prepared for rollouts with the settings in args. Returns features along with
+    # reconstructions if features is set (see with_features).
+    recon_args, recon_model = load_recon_model(argparse.Namespace(recon_model_checkpoint=checkpoint,
+                                                                  device=args.device))
+    if features:
+        recon_model = with_features(recon_model)
+    recon_model = to_channels_last(args, recon_model)
+    return recon_args, apply_precision(args, compile_recon_model(args, recon_model))
+
+
+def uses_recon_features(args):
+    # Whether the policy to train or evaluate takes reconstruction features as input, rather than reconstructions.
+    # Resumed and tested policies store this in their checkpoint.
+    if args.policy_model_checkpoint is not None:
+        policy_args = torch.load(args.policy_model_checkpoint, map_location='cpu')['args']
+        return getattr(policy_args, 'policy_input', 'recon') == 'recon_features'
+    return args.policy_input == 'recon_features'
+
+
+def diagnose_rewards(args, recon_model):
+    """
+    Compares every reward score in REWARD_FUNCS with exact SSIM on a single validation batch. For every slice,
+    reward_diagnostic_candidates rows are sampled from the policy, and the Spearman rank correlation of every score
+    with SSIM over these candidates is averaged over slices. Also reports the time of every score relative to SSIM.
+    """
+    if args.policy_model_checkpoint is not None:
+        model, _ = load_policy_model(pathlib.Path(args.policy_model_checkpoint))
+    else:  # Untrained policy: candidates are (close to) uniformly sampled
+        model = build_policy_model(args)
+    args = add_mask_params(args)
+    model.eval()
+    loader = create_data_loader(args, 'val', shuffle=False)
+    data_range_dict = create_data_range_dict(args, loader)
+
+    kspace, masked_kspace, mask, zf, gt, gt_mean, gt_std, fname, sl_idx = next(iter(loader))
+    # shape after unsqueeze = batch x channel x columns x rows x complex
+    kspace = kspace.unsqueeze(1).to(args.device)
+    masked_kspace = masked_kspace.unsqueeze(1).to(args.device)
+    mask = mask.unsqueeze(1).to(args.device)
+    # shape after unsqueeze = batch x channel x columns x rows
+    zf = zf.unsqueeze(1).to(args.device)
+    gt = gt.unsqueeze(1).to(args.device)
+    gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+    unnorm_gt = gt * gt_std + gt_mean
+    data_range = torch.stack([data_range_dict[vol] for vol in fname])
+
+    with torch.no_grad():
+        recons, features = compute_initial_reconstruction(recon_model, zf, mask, return_features=True)
+        _, probs = get_policy_probs(model, get_policy_input(recons, features), mask, get_precision(args))
+        probs = probs.squeeze(1)
+        # Sample distinct candidate rows, at most the number of unacquired rows
+        num_candidates = min(args.reward_diagnostic_candidates, int((probs > 0).sum(dim=1).min().item()))
+        actions = torch.multinomial(probs, num_candidates, replacement=False)
+        _, _, _, recons = compute_next_step_reconstruction(recon_model, kspace, masked_kspace, mask, actions,
+                                                           memory_mb=args.chunk_memory_mb)
+
+        ssim_scores, ssim_time = time_function(lambda: compute_reward_scores(
+            args, recons, gt_mean, gt_std, unnorm_gt, data_range, reward='ssim'), repeats=10, warmup=1,
+            device=args.device)
+        logging.info(f'Reward diagnostic on {recons.size(0)} slices with {num_candidates} candidate rows each; '
+                     f'SSIM time = {ssim_time * 1000:.2f}ms')
+        for reward in REWARD_FUNCS:
+            scores, reward_time = time_function(lambda: compute_reward_scores(
+                args, recons, gt_mean, gt_std, unnorm_gt, data_range, reward=reward), repeats=10, warmup=1,
+                device=args.device)
+            logging.info(f'  {reward}: rank correlation with SSIM = {rank_correlation(scores, ssim_scores):.3f}, '
+                         f'time = {reward_time * 1000:.2f}ms, speedup = {ssim_time / reward_time:.2f}x')
+
+
 def main(args):
     logging.info(args)
     # Reconstruction model
-    recon_args, recon_model = load_recon_model(args)
+    check_precision(args)
+    features = uses_recon_features(args)
+    if features:
+        assert args.compiled_inference == 'eager' and args.recon_cache_mb == 0 and not args.actor_learner, \
+            'Policies on reconstruction features do not support compiled_inference, recon_cache_mb or actor_learner.'
+    recon_args, recon_model = load_frozen_recon_model(args, args.recon_model_checkpoint, features)
+    if features:
+        # Stored with the policy arguments, to build the policy from its checkpoint
+        args.feature_chans, args.feature_resolution = feature_shape(recon_args)
+        if args.final_recon_model_checkpoint is not None:
+            final_recon_args = torch.load(args.final_recon_model_checkpoint, map_location='cpu')['args']
+            assert feature_shape(final_recon_args) == feature_shape(recon_args), \
+                'Reconstruction models of recon_model_checkpoint and final_recon_model_checkpoint give features of ' \
+                f'different shapes: {feature_shape(recon_args)} and {feature_shape(final_recon_args)}.'
+    # Optional cache of reconstructions for the frozen reconstruction model
+    cache = build_recon_cache(args)
 
     # Policy model to train
-    if args.do_train:
-        train_and_eval(args, recon_args, recon_model)
+    if args.reward_diagnostic:
+        diagnose_rewards(args, recon_model)
+    elif args.do_train:
+        assert not args.actor_learner or (args.model_type == 'greedy' and not is_distributed()), \
+            'The actor-learner mode supports single process greedy training only.'
+        assert args.policy_sync_interval <= args.max_policy_lag, \
+            'Policies are synced less often than max_policy_lag: all rollouts would be dropped.'
+        assert not (is_distributed() and args.model_type == 'nongreedy' and not args.transition_replay), \
+            'Distributed non-greedy training requires transition_replay, which pairs every forward with a backward.'
+        assert args.num_shards == 1, 'Sharding is only supported for testing (do_train False).'
+        train_and_eval(args, recon_args, recon_model, cache)
     else:
-        test(args, recon_model)
+        test(args, recon_model, cache)
 
 
 def create_arg_parser():
@@ -387,7 +599,10 @@ def create_arg_parser():
                         help='If set, only the center slices of a volume will be included in the dataset. This '
                              'removes the most noisy images from the data.')
     parser.add_argument('--data_parallel', type=str2bool, default=True,
-                        help='If set, use multiple GPUs using data parallelism')
+                        help='If set, use multiple GPUs using data parallelism. Ignored when launched with torchrun, '
+                             'which uses one DistributedDataParallel process per GPU (or per CPU worker).')
+    parser.add_argument('--dist_backend', type=str2none, default=None,
+                        help="Backend of torchrun processes. Defaults to 'nccl' if device is 'cuda', else 'gloo'.")
     parser.add_argument('--do_train_ssim', type=str2bool, default=False,
                         help='Whether to compute SSIM values on training data.')
     parser.add_argument('--num_epochs', type=int, default=50, help='Number of training epochs')
@@ -395,6 +610,18 @@ def create_arg_parser():
                                                             'Set to 0 to use random seed.')
     parser.add_argument('--num_chans', type=int, default=16, help='Number of ConvNet channels in first layer.')
     parser.add_argument('--fc_size', default=256, type=int, help='Size (width) of fully connected layer(s).')
+    parser.add_argument('--policy_head', choices=POLICY_HEADS, default='flatten',
+                        help="How the ConvNet output is reduced before the fully connected layers. 'flatten' uses all "
+                             "features, such that the first fully connected layer grows quadratically with the "
+                             "resolution. 'adaptive' average pools to a head_grid x head_grid grid first, and "
+                             "'global' average pools over the whole image.")
+    parser.add_argument('--head_grid', default=4, type=int,
+                        help="Size of the spatial grid the ConvNet output is pooled to for policy_head 'adaptive'.")
+    parser.add_argument('--policy_input', choices=['recon', 'recon_features'], default='recon',
+                        help="Input of the policy model. 'recon_features' uses the bottleneck features of the "
+                             "reconstruction U-Net, computed in the same forward pass as the reconstruction, with a "
+                             "single convolutional block (num_chans * 2 ** num_layers channels) and the fully "
+                             "connected layers on top. This removes most of the convolutions of the policy.")
     parser.add_argument('--lr', type=float, default=5e-5, help='Learning rate')
     parser.add_argument('--lr_gamma', type=float, default=0.1,
                         help='Multiplicative factor of learning rate decay')
@@ -418,6 +645,11 @@ def create_arg_parser():
 
     parser.add_argument('--do_train', type=str2bool, default=True,
                         help='Whether to do training or testing.')
+    parser.add_argument('--final_recon_model_checkpoint', type=pathlib.Path, default=None,
+                        help='If set, the trained policy is evaluated once more on the validation data after the last '
+                             'epoch, with this reconstruction model. Use with a distilled reconstruction model (see '
+                             'teacher_checkpoint in train_reconstruction.py) as recon_model_checkpoint and its teacher '
+                             'here.')
     parser.add_argument('--policy_model_checkpoint', type=pathlib.Path, default=None,
                         help='Path to a pretrained policy model if do_train is False (testing).')
 
@@ -433,21 +665,103 @@ def create_arg_parser():
 
     parser.add_argument('--num_test_trajectories', type=int, default=1,
                         help='Number of trajectories to use when testing sampling policy.')
+    parser.add_argument('--dedup_actions', type=str2bool, default=False,
+                        help='Whether to only reconstruct and score unique (slice, state, row) combinations when '
+                             'multiple sampled trajectories acquire the same rows. Does not change rewards or '
+                             'gradients; duplication rates are logged per step.')
+    parser.add_argument('--recon_cache_mb', type=float, default=0,
+                        help='Memory (in MB) for an LRU cache of reconstructions and their scores, keyed by slice and '
+                             'acquired rows. Reconstructions are stored on the device they are computed on. Set to 0 '
+                             'to disable.')
+    parser.add_argument('--chunk_memory_mb', type=float, default=0,
+                        help='Memory budget (in MB) for reconstructing and scoring all sampled trajectories of a '
+                             'batch. If set, these are processed in micro-batches with a size based on the measured '
+                             'memory use per sample. Set to 0 to process everything at once.')
+    parser.add_argument('--compiled_inference', type=str, default='eager', choices=COMPILE_MODES,
+                        help="Compiled execution of the frozen reconstruction model (and of the policy model when "
+                             "testing): TorchScript 'script' or 'trace', or 'compile' for torch.compile where "
+                             "available. Compiled modules are checked against eager execution, which is used instead "
+                             "if they deviate by more than 'compile_tolerance'.")
+    parser.add_argument('--compile_tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between compiled and eager outputs.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help="Precision of the policy and reconstruction model forwards and of the SSIM convolutions "
+                             "of training rewards, using autocast: 'bf16' (CPU with oneDNN, or recent GPUs) or 'fp16' "
+                             "(GPU, with loss scaling). FFTs, rewards and evaluation metrics stay in float32.")
+    parser.add_argument('--transition_replay', type=str2bool, default=False,
+                        help='Non-greedy training only. If set, only (state, action, reward) transitions are stored '
+                             'during the trajectory, and log-probabilities are recomputed with gradients in a batched '
+                             'pass at the end, so memory does not grow with the number of acquisition steps.')
+    parser.add_argument('--replay_chunk_size', type=int, default=0,
+                        help="Maximum number of states per policy forward and backward pass with 'transition_replay'. "
+                             "Set to 0 to process all states of a trajectory at once.")
+    parser.add_argument('--reward', type=str, default='ssim',
+                        choices=['ssim', 'ssim_strided', 'ssim_roi', 'mse', 'psnr'],
+                        help="Score of which the improvement is used as reward during training: 'ssim' (exact), "
+                             "'ssim_strided' (SSIM map on a grid of every 'reward_stride'-th pixel), 'ssim_roi' (SSIM "
+                             "on the foreground bounding box), 'mse' (negative MSE) or 'psnr'. Evaluation always uses "
+                             "exact SSIM and PSNR.")
+    parser.add_argument('--reward_stride', type=int, default=2,
+                        help="Stride of the grid on which SSIM is computed for the 'ssim_strided' reward.")
+    parser.add_argument('--reward_roi_threshold', type=float, default=0.05,
+                        help="Fraction of the data range above which ground truth pixels are foreground for the "
+                             "'ssim_roi' reward.")
+    parser.add_argument('--reward_diagnostic', type=str2bool, default=False,
+                        help='If set, only report the rank correlation with exact SSIM and speedup of every reward on '
+                             "a validation batch, using the policy in 'policy_model_checkpoint' if given, and exit.")
+    parser.add_argument('--reward_diagnostic_candidates', type=int, default=32,
+                        help='Number of candidate rows per slice to rank in the reward diagnostic.')
+    parser.add_argument('--actor_learner', type=str2bool, default=False,
+                        help='Greedy models only. If set, num_actors processes roll out (a periodically synced copy '
+                             'of) the policy on their own shard of the training volumes, while the main process '
+                             'takes gradient steps on the resulting transitions.')
+    parser.add_argument('--num_actors', type=int, default=2, help='Number of actor processes with actor_learner.')
+    parser.add_argument('--actor_device', type=str2none, default=None,
+                        help="Device of the actor processes. Defaults to 'device'.")
+    parser.add_argument('--actor_queue_size', type=int, default=8,
+                        help='Maximum number of batches of transitions waiting for the learner. Actors wait when the '
+                             'queue is full.')
+    parser.add_argument('--policy_sync_interval', type=int, default=1,
+                        help='Number of learner updates between publishing the policy weights to the actors.')
+    parser.add_argument('--max_policy_lag', type=int, default=4,
+                        help='Transitions generated by a policy that is more than this number of learner updates old '
+                             'are dropped.')
+    parser.add_argument('--importance_weighting', type=str, default='truncated', choices=['none', 'full', 'truncated'],
+                        help="Correction of the policy gradient for transitions generated by an older policy: 'none', "
+                             "importance ratios of learner and actor policy ('full'), or ratios truncated at "
+                             "'importance_clip' ('truncated').")
+    parser.add_argument('--importance_clip', type=float, default=1.,
+                        help="Maximum importance ratio with importance_weighting 'truncated'.")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards to split the test volumes into when testing. Every shard stores its '
+                             'sufficient statistics in the policy run directory, which can be combined with '
+                             'merge_eval_shards.py.')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help="Index of the test shard to evaluate, in [0, 'num_shards').")
     parser.add_argument('--test_multi',  type=str2bool, default=False,
                         help='Test multiple models in one script')
     parser.add_argument('--policy_model_list', nargs='+', type=str, default=[None],
                         help='List of policy model paths for multi-testing.')
 
+    add_cpu_profile_args(parser)
     return parser
 
 
 def wrap_main(args):
+    # CPU only execution (before init_distributed, which picks the backend based on the device)
+    apply_cpu_profile(args)
+    # Sets up one process per torchrun worker, if launched with torchrun
+    init_distributed(args)
+    if not is_main_process():  # Only the main process logs
+        args.wandb = False
+
     if args.seed != 0:
-        random.seed(args.seed)
-        np.random.seed(args.seed)
-        torch.manual_seed(args.seed)
+        # Different seed per process, such that processes sample different trajectories
+        random.seed(args.seed + args.rank)
+        np.random.seed(args.seed + args.rank)
+        torch.manual_seed(args.seed + args.rank)
         if args.device == 'cuda':
-            torch.cuda.manual_seed(args.seed)
+            torch.cuda.manual_seed(args.seed + args.rank)
 
     args.use_recon_mask_params = False
 
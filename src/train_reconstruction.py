@@ -6,13 +6,16 @@ LICENSE file in the root directory of this source tree.
 """
 
 import argparse
+import functools
 import logging
+import os
 import pathlib
 import random
 import shutil
 import time
 import h5py
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
@@ -23,29 +26,42 @@ from torch.nn import functional as F
 from src.reconstruction_model.reconstruction_model_def import build_reconstruction_model
 from src.reconstruction_model.reconstruction_model_utils import (load_recon_model, save_reconstructions, Metrics,
                                                                  METRIC_FUNCS, change_target_resolution)
-from src.helpers.utils import build_optim, save_json, str2bool, str2none
+from src.helpers.utils import build_optim, save_json, str2bool, str2none, time_function
 from src.helpers.data_loading import create_data_loader
+from src.helpers.torch_metrics import compute_volume_ssim, rank_correlation
+from src.helpers.distributed import (init_distributed, is_distributed, is_main_process, wrap_model, all_reduce,
+                                     barrier, NullWriter)
+from src.helpers.cpu_profile import add_cpu_profile_args, apply_cpu_profile, to_channels_last
+from src.helpers.precision import (autocast, check_precision, build_grad_scaler, backward, optimiser_step,
+                                   get_precision, PRECISIONS)
+from src.policy_model.policy_model_utils import (load_policy_model, get_new_zf, get_policy_probs,
+                                                 compute_next_step_reconstruction, compute_batch_scores,
+                                                 create_data_range_dict)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def train_epoch(args, epoch, model, data_loader, optimizer, writer):
+def train_epoch(args, epoch, model, data_loader, optimizer, writer, scaler=None):
     model.train()
     avg_loss = 0.
     true_avg_loss = 0.
     start_epoch = start_iter = time.perf_counter()
     global_step = epoch * len(data_loader)
+    if hasattr(data_loader.sampler, 'set_epoch'):  # Different shuffle of the distributed training data every epoch
+        data_loader.sampler.set_epoch(epoch)
     for iter, data in enumerate(data_loader):
         _, _, _, input, target, _, _, _, _ = data
         input = input.unsqueeze(1).to(args.device)
         target = target.to(args.device)
 
         optimizer.zero_grad()
-        recon = model(input).squeeze(1)
-        loss = F.l1_loss(recon, target)
-        loss.backward()
-        optimizer.step()
+        with autocast(get_precision(args), input.device.type):
+            recon = model(input).squeeze(1)
+        # Loss in float32
+        loss = F.l1_loss(recon.float(), target)
+        backward(loss, scaler)
+        optimiser_step(optimizer, scaler)
 
         avg_loss = 0.99 * avg_loss + 0.01 * loss.item() if iter > 0 else loss.item()
         true_avg_loss = (true_avg_loss * iter + loss.mean()) / (iter + 1)
@@ -74,11 +90,19 @@ def evaluate_loss(args, epoch, model, data_loader, writer):
             input = input.unsqueeze(1).to(args.device)
             target = target.to(args.device)
 
-            recon = model(input).squeeze(1)
+            with autocast(get_precision(args), input.device.type):
+                recon = model(input).squeeze(1)
+            recon = recon.float()
             loss = F.mse_loss(recon, target, reduction='mean')
             l1_loss = (recon - target).abs()
             true_avg_loss = (true_avg_loss * iter + l1_loss.mean()) / (iter + 1)
             losses.append(loss.item())
+        if is_distributed():
+            # Average over the batches of the volumes evaluated by all processes
+            totals = torch.tensor([np.sum(losses), float(true_avg_loss) * len(losses), len(losses)],
+                                  dtype=torch.float64, device=args.device)
+            loss_sum, l1_sum, num_batches = all_reduce(totals).tolist()
+            losses, true_avg_loss = [loss_sum / num_batches], l1_sum / num_batches
         writer.add_scalar('Dev_Loss', np.mean(losses), epoch)
         writer.add_scalar('TrueDevLossL1', true_avg_loss, epoch)
     return np.mean(losses), true_avg_loss, time.perf_counter() - start
@@ -121,15 +145,16 @@ def save_model(args, exp_dir, epoch, model, optimizer, best_dev_loss, is_new_bes
 
 
 def train_unet(args):
-    args.exp_dir.mkdir(parents=True, exist_ok=True)
-    writer = SummaryWriter(log_dir=args.exp_dir / 'summary')
+    # Only the main process stores results
+    if is_main_process():
+        args.exp_dir.mkdir(parents=True, exist_ok=True)
+    writer = SummaryWriter(log_dir=args.exp_dir / 'summary') if is_main_process() else NullWriter()
 
     if args.resume:
         recon_model, args, start_epoch, optimizer = load_recon_model(args.recon_model_checkpoint, optim=True)
     else:
-        model = build_reconstruction_model(args)
-        if args.data_parallel:
-            model = torch.nn.DataParallel(model)
+        model = to_channels_last(args, build_reconstruction_model(args))
+        model = wrap_model(args, model)
         optimizer = build_optim(args, model.parameters())
         best_dev_loss = 1e9
         start_epoch = 0
@@ -139,22 +164,27 @@ def train_unet(args):
     # Save arguments for bookkeeping
     args_dict = {key: str(value) for key, value in args.__dict__.items()
                  if not key.startswith('__') and not callable(key)}
-    save_json(args.exp_dir / 'args.json', args_dict)
+    if is_main_process():
+        save_json(args.exp_dir / 'args.json', args_dict)
 
     train_loader = create_data_loader(args, 'train', shuffle=True)
     dev_loader = create_data_loader(args, 'val')
     display_loader = create_data_loader(args, 'val', display=True)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.lr_step_size, args.lr_gamma)
+    # Loss scaling for fp16 training (None otherwise)
+    scaler = build_grad_scaler(args)
 
     for epoch in range(start_epoch, args.num_epochs):
-        train_loss, train_time = train_epoch(args, epoch, model, train_loader, optimizer, writer)
+        train_loss, train_time = train_epoch(args, epoch, model, train_loader, optimizer, writer, scaler)
         dev_loss, dev_l1loss, dev_time = evaluate_loss(args, epoch, model, dev_loader, writer)
-        visualize(args, epoch, model, display_loader, writer)
+        if is_main_process():
+            visualize(args, epoch, model, display_loader, writer)
         scheduler.step()
 
         is_new_best = dev_loss < best_dev_loss
         best_dev_loss = min(best_dev_loss, dev_loss)
-        save_model(args, args.exp_dir, epoch, model, optimizer, best_dev_loss, is_new_best)
+        if is_main_process():
+            save_model(args, args.exp_dir, epoch, model, optimizer, best_dev_loss, is_new_best)
         logging.info(
             f'Epoch = [{epoch:4d}/{args.num_epochs:4d}] TrainL1Loss = {train_loss:.4g} DevL1Loss = {dev_l1loss:.4g} '
             f'DevLoss = {dev_loss:.4g} TrainTime = {train_time:.4f}s DevTime = {dev_time:.4f}s',
@@ -162,10 +192,198 @@ def train_unet(args):
     writer.close()
 
 
+def sample_trajectory_input(args, teacher, policy, kspace, mask):
+    """
+    Zero-filled input for a policy-like acquisition trajectory of every slice: a random number (at most
+    args.acquisition_steps, the same for the whole batch) of rows is added to the initial mask. Rows are sampled
+    without replacement from the policy on the teacher reconstruction of the initial mask if a policy is given, and
+    uniformly from the unacquired rows otherwise.
+
+    Returns:
+        (torch.Tensor): Zero-filled images of shape batch x 1 x res x res
+        (torch.Tensor): Masks of shape batch x 1 x 1 x res x 1
+    """
+    with torch.no_grad():
+        num_rows = random.randint(0, args.acquisition_steps)
+        if num_rows > 0:
+            if policy is not None:
+                zf, _, _ = get_new_zf(kspace * mask)
+                _, probs = get_policy_probs(policy, teacher(zf), mask)
+                probs = probs.squeeze(1)
+            else:
+                probs = (mask == 0).squeeze(-1).squeeze(-2).squeeze(1).float()
+            rows = torch.multinomial(probs, num_rows, replacement=False)
+            mask = mask.clone()
+            mask.scatter_(3, rows.view(rows.size(0), 1, 1, num_rows, 1), 1.)
+        zf, _, _ = get_new_zf(kspace * mask)
+    return zf, mask
+
+
+def distill_epoch(args, epoch, student, teacher, policy, data_loader, optimizer, writer, scaler=None):
+    # As train_epoch, with the L1 distance to the teacher reconstruction for trajectory masks as loss
+    student.train()
+    avg_loss = 0.
+    start_epoch = start_iter = time.perf_counter()
+    global_step = epoch * len(data_loader)
+    if hasattr(data_loader.sampler, 'set_epoch'):
+        data_loader.sampler.set_epoch(epoch)
+    for iter, data in enumerate(data_loader):
+        kspace, _, mask, _, _, _, _, _, _ = data
+        kspace = kspace.unsqueeze(1).to(args.device)
+        mask = mask.unsqueeze(1).to(args.device)
+        input, _ = sample_trajectory_input(args, teacher, policy, kspace, mask)
+        with torch.no_grad():
+            target = teacher(input)
+
+        optimizer.zero_grad()
+        with autocast(get_precision(args), input.device.type):
+            recon = student(input)
+        # Loss in float32
+        loss = F.l1_loss(recon.float(), target)
+        backward(loss, scaler)
+        optimiser_step(optimizer, scaler)
+
+        avg_loss = 0.99 * avg_loss + 0.01 * loss.item() if iter > 0 else loss.item()
+        writer.add_scalar('DistillLoss', loss.item(), global_step + iter)
+        if iter % args.report_interval == 0:
+            logging.info(
+                f'Epoch = [{epoch:3d}/{args.num_epochs:3d}] '
+                f'Iter = [{iter:4d}/{len(data_loader):4d}] '
+                f'Loss = {loss.item():.4g} AvgLoss = {avg_loss:.4g} '
+                f'Time = {time.perf_counter() - start_iter:.4f}s',
+            )
+        start_iter = time.perf_counter()
+    return avg_loss, time.perf_counter() - start_epoch
+
+
+def evaluate_distillation(args, epoch, student, teacher, policy, data_loader, data_range_dict, writer):
+    """
+    Compares the student with the teacher for trajectory masks (see sample_trajectory_input) of the validation slices:
+    - l1: L1 distance between their (normalised) reconstructions.
+    - ssim_agreement: SSIM of the student reconstruction with the teacher reconstruction as reference.
+    - ssim_gap: SSIM of the teacher minus SSIM of the student, both with respect to the ground truth.
+    - ranking: Spearman rank correlation of the SSIM rewards of args.distill_candidates candidate rows per slice, as
+      computed with the student and with the teacher, averaged over slices.
+    - top1: fraction of slices for which both models give the highest reward to the same candidate.
+    - speedup: teacher over student forward time.
+    """
+    student.eval()
+    # Sums over slices of the scores in the order of the report, and forward times of both models
+    totals = torch.zeros(8, dtype=torch.float64, device=args.device)
+    with torch.no_grad():
+        for data in data_loader:
+            kspace, _, mask, _, gt, gt_mean, gt_std, fname, _ = data
+            kspace = kspace.unsqueeze(1).to(args.device)
+            mask = mask.unsqueeze(1).to(args.device)
+            gt = gt.unsqueeze(1).to(args.device)
+            gt_mean = gt_mean.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+            gt_std = gt_std.unsqueeze(1).unsqueeze(2).unsqueeze(3).to(args.device)
+            unnorm_gt = gt * gt_std + gt_mean
+            data_range = torch.stack([data_range_dict[vol] for vol in fname])
+
+            input, mask = sample_trajectory_input(args, teacher, policy, kspace, mask)
+            teacher_recon, teacher_time = time_function(lambda: teacher(input), device=args.device)
+            with autocast(get_precision(args), input.device.type):
+                student_recon, student_time = time_function(lambda: student(input), device=args.device)
+            student_recon = student_recon.float()
+            l1 = (student_recon - teacher_recon).abs().mean(dim=(1, 2, 3))
+            # Evaluation scores in float32
+            unnorm_teacher = teacher_recon * gt_std + gt_mean
+            agreement = compute_batch_scores(args, student_recon, gt_mean, gt_std, unnorm_teacher, data_range,
+                                             comp_psnr=False).squeeze(1)
+            gap = (compute_batch_scores(args, teacher_recon, gt_mean, gt_std, unnorm_gt, data_range, comp_psnr=False) -
+                   compute_batch_scores(args, student_recon, gt_mean, gt_std, unnorm_gt, data_range,
+                                        comp_psnr=False)).squeeze(1)
+
+            # Rewards of candidate rows, as the policy would get them with either model
+            probs = (mask == 0).squeeze(-1).squeeze(-2).squeeze(1).float()
+            candidates = torch.multinomial(probs, args.distill_candidates, replacement=False)
+            masked_kspace = kspace * mask
+            rewards = []
+            for model in [student, teacher]:
+                _, _, _, recons = compute_next_step_reconstruction(model, kspace, masked_kspace, mask, candidates)
+                rewards.append(compute_batch_scores(args, recons.float(), gt_mean, gt_std, unnorm_gt, data_range,
+                                                    comp_psnr=False))
+            num_slices = gt.size(0)
+            top1 = (rewards[0].argmax(dim=1) == rewards[1].argmax(dim=1)).double().sum()
+            totals += torch.tensor([num_slices, l1.sum(), agreement.sum(), gap.sum(),
+                                    rank_correlation(rewards[0], rewards[1]) * num_slices, top1, student_time,
+                                    teacher_time], dtype=torch.float64, device=args.device)
+    if is_distributed():
+        totals = all_reduce(totals)
+    num_slices, l1, agreement, gap, ranking, top1, student_time, teacher_time = totals.tolist()
+    report = {'l1': l1 / num_slices, 'ssim_agreement': agreement / num_slices, 'ssim_gap': gap / num_slices,
+              'ranking': ranking / num_slices, 'top1': top1 / num_slices, 'speedup': teacher_time / student_time}
+    for key, value in report.items():
+        writer.add_scalar(f'Distill_{key}', value, epoch)
+    return report
+
+
+def distill_unet(args):
+    """
+    Trains a (smaller) UnetModel with the settings in args to reproduce the reconstructions of the model in
+    args.teacher_checkpoint, for the masks that occur in policy trajectories. The student is stored like a trained
+    reconstruction model, together with a report of its agreement with the teacher (see evaluate_distillation).
+    """
+    assert not args.resume, 'Resuming is not supported for distillation.'
+    if is_main_process():
+        args.exp_dir.mkdir(parents=True, exist_ok=True)
+    writer = SummaryWriter(log_dir=args.exp_dir / 'summary') if is_main_process() else NullWriter()
+
+    teacher_args, teacher = load_recon_model(argparse.Namespace(recon_model_checkpoint=args.teacher_checkpoint,
+                                                                device=args.device))
+    assert teacher_args.resolution == args.resolution, 'Student and teacher should have the same resolution.'
+    teacher = to_channels_last(args, teacher.to(args.device)).eval()
+    policy = None
+    if args.distill_policy_checkpoint is not None:
+        policy, policy_args = load_policy_model(args.distill_policy_checkpoint)
+        assert getattr(policy_args, 'policy_input', 'recon') == 'recon', 'The policy should take reconstructions.'
+        policy = policy.to(args.device).eval()
+
+    model = to_channels_last(args, build_reconstruction_model(args))
+    model = wrap_model(args, model)
+    optimizer = build_optim(args, model.parameters())
+    logging.info(args)
+    logging.info(model)
+    args_dict = {key: str(value) for key, value in args.__dict__.items()
+                 if not key.startswith('__') and not callable(key)}
+    if is_main_process():
+        save_json(args.exp_dir / 'args.json', args_dict)
+
+    train_loader = create_data_loader(args, 'train', shuffle=True)
+    dev_loader = create_data_loader(args, 'val')
+    dev_data_range_dict = create_data_range_dict(args, dev_loader)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, args.lr_step_size, args.lr_gamma)
+    scaler = build_grad_scaler(args)
+
+    best_dev_loss = 1e9
+    for epoch in range(args.num_epochs):
+        train_loss, train_time = distill_epoch(args, epoch, model, teacher, policy, train_loader, optimizer, writer,
+                                               scaler)
+        report = evaluate_distillation(args, epoch, model, teacher, policy, dev_loader, dev_data_range_dict, writer)
+        scheduler.step()
+
+        is_new_best = report['l1'] < best_dev_loss
+        best_dev_loss = min(best_dev_loss, report['l1'])
+        if is_main_process():
+            save_model(args, args.exp_dir, epoch, model, optimizer, best_dev_loss, is_new_best)
+            save_json(args.exp_dir / 'distillation_report.json', dict(epoch=epoch, **report))
+        logging.info(
+            f'Epoch = [{epoch:4d}/{args.num_epochs:4d}] DistillLoss = {train_loss:.4g} DevL1 = {report["l1"]:.4g} '
+            f'SSIMAgreement = {report["ssim_agreement"]:.4f} SSIMGap = {report["ssim_gap"]:.4f} '
+            f'RewardRankCorr = {report["ranking"]:.3f} Top1Agreement = {report["top1"]:.3f} '
+            f'Speedup = {report["speedup"]:.2f}x TrainTime = {train_time:.4f}s',
+        )
+    writer.close()
+
+
 def run_unet(args):
     # Evaluate reconstruction model using the settings that it was trained on
     recon_args, model = load_recon_model(args)
+    model = to_channels_last(args, model)
     recon_args.data_path = args.data_path  # in case model was trained on different machine
+    for key in ['cpu_profile', 'pin_memory', 'worker_core_list']:  # Data loading settings of this machine
+        setattr(recon_args, key, getattr(args, key))
     data_loader = create_data_loader(recon_args, args.partition)
 
     model.eval()
@@ -173,7 +391,9 @@ def run_unet(args):
     with torch.no_grad():
         for _, _, _, input, _, gt_mean, gt_std, fnames, slices in data_loader:
             input = input.unsqueeze(1).to(args.device)
-            recons = model(input).squeeze(1).to('cpu')
+            with autocast(get_precision(args), input.device.type):
+                recons = model(input).squeeze(1)
+            recons = recons.float().to('cpu')
             for i in range(recons.shape[0]):
                 recons[i] = recons[i] * gt_std[i] + gt_mean[i]
                 reconstructions[fnames[i]].append((slices[i].numpy(), recons[i].numpy()))
@@ -184,30 +404,67 @@ def run_unet(args):
     }
 
     args.predictions_path = args.recon_model_checkpoint.parent / 'reconstructions'
+    # Every process stores the volumes it reconstructed
     save_reconstructions(reconstructions, args.predictions_path)
 
 
+def init_eval_worker():
+    # Every worker evaluates a single volume at a time, so avoid oversubscribing cores with torch threads
+    torch.set_num_threads(1)
+
+
+def evaluate_volume(args, recons_key, tgt_file):
+    """
+    Computes all metrics in METRIC_FUNCS for a single volume, reading only the slices that are evaluated. Returns None
+    if the volume is not evaluated.
+    """
+    recons_path = args.predictions_path / tgt_file.name
+    with h5py.File(tgt_file, 'r') as target:
+        if args.acquisition is not None and args.acquisition != target.attrs['acquisition']:
+            return None
+        target = target[recons_key]
+        if args.center_volume:
+            num_slices = target.shape[0]
+            target = target[num_slices // 4: 3 * num_slices // 4, :, :]
+        else:
+            target = target[()]
+    target = change_target_resolution(args, target)
+    with h5py.File(recons_path, 'r') as recons:
+        recons = recons['reconstruction'][()]
+
+    values = {}
+    for metric, func in METRIC_FUNCS.items():
+        if metric == 'SSIM' and args.ssim_backend == 'torch':
+            values[metric] = compute_volume_ssim(target, recons)
+        else:
+            values[metric] = func(target, recons)
+    return values
+
+
 def evaluate(args):
     # Use esc for Knee data, rss for Brain data (since it's technically multicoil)
     recons_key = 'reconstruction_esc' if args.dataset == 'knee' else 'reconstruction_rss'
     metrics = Metrics(METRIC_FUNCS)
-    recons_files = [path.name for path in args.predictions_path.iterdir()]
+    recons_files = set(path.name for path in args.predictions_path.iterdir())
 
     # This path is partially hardcoded right now
     args.target_path = args.data_path / f'singlecoil_{args.partition}'
-    for tgt_file in args.target_path.iterdir():
-        if tgt_file.name not in recons_files:
-            continue
-        with h5py.File(tgt_file) as target, h5py.File(args.predictions_path / tgt_file.name) as recons:
-            if args.acquisition is not None and args.acquisition != target.attrs['acquisition']:
-                continue
-            target = target[recons_key].value
-            target = change_target_resolution(args, target)
-            if args.center_volume:
-                num_slices = target.shape[0]
-                target = target[num_slices // 4: 3 * num_slices // 4, :, :]
-            recons = recons['reconstruction'].value
-            metrics.push(target, recons)
+    # Sorted, so that results are merged in the same order regardless of the number of workers
+    tgt_files = sorted(tgt_file for tgt_file in args.target_path.iterdir() if tgt_file.name in recons_files)
+
+    start = time.perf_counter()
+    eval_fn = functools.partial(evaluate_volume, args, recons_key)
+    num_workers = args.eval_workers if args.eval_workers > 0 else os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=num_workers, initializer=init_eval_worker) if num_workers > 1 else None
+    # Both return results in the order of tgt_files
+    results = executor.map(eval_fn, tgt_files) if executor is not None else map(eval_fn, tgt_files)
+    for values in results:
+        if values is not None:
+            metrics.push_values(values)
+    if executor is not None:
+        executor.shutdown()
+    logging.info(f'Evaluated {len(tgt_files)} volumes with {num_workers} workers in '
+                 f'{time.perf_counter() - start:.2f}s')
 
     with open(args.predictions_path / "metrics.txt", "w") as text_file:
         print(f"{metrics}", file=text_file)
@@ -216,11 +473,17 @@ def evaluate(args):
 
 def main(args):
     logging.info(args)
-    if args.do_train:
+    check_precision(args)
+    if args.do_train and args.teacher_checkpoint is not None:
+        distill_unet(args)
+    elif args.do_train:
         train_unet(args)
     else:
         run_unet(args)
-        evaluate(args)
+        # Wait for the reconstructions of all processes before evaluating them once
+        barrier()
+        if is_main_process():
+            evaluate(args)
 
 
 def create_arg_parser():
@@ -254,7 +517,10 @@ def create_arg_parser():
                         help='Strength of weight decay regularization')
     parser.add_argument('--report_interval', type=int, default=100, help='Period of loss reporting')
     parser.add_argument('--data_parallel', type=str2bool, default=True,
-                        help='If set, use multiple GPUs using data parallelism')
+                        help='If set, use multiple GPUs using data parallelism. Ignored when launched with torchrun, '
+                             'which uses one DistributedDataParallel process per GPU (or per CPU worker).')
+    parser.add_argument('--dist_backend', type=str2none, default=None,
+                        help="Backend of torchrun processes. Defaults to 'nccl' if device is 'cuda', else 'gloo'.")
     parser.add_argument('--device', type=str, default='cuda',
                         help='Which device to train on. Set to "cuda" to use the GPU')
     parser.add_argument('--exp_dir', type=pathlib.Path, default=None,
@@ -275,12 +541,39 @@ def create_arg_parser():
                         help='Whether to train or evaluate / test.')
     parser.add_argument('--partition', type=str, default='val', choices=['val', 'test'],
                         help='Partition to evaluate model on (used with do_train=False).')
+    parser.add_argument('--eval_workers', type=int, default=0,
+                        help='Number of processes used to compute metrics of reconstructed volumes (used with '
+                             'do_train=False). Set to 0 to use all available cores.')
+    parser.add_argument('--ssim_backend', type=str, default='skimage', choices=['skimage', 'torch'],
+                        help="Implementation of the volume SSIM metric (used with do_train=False). 'torch' matches "
+                             "skimage's structural_similarity within 1e-6, but is faster.")
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help="Precision of the model forwards, using autocast: 'bf16' (CPU with oneDNN, or recent "
+                             "GPUs) or 'fp16' (GPU, with loss scaling). Losses are computed in float32.")
+    parser.add_argument('--teacher_checkpoint', type=pathlib.Path, default=None,
+                        help='If set, train a reconstruction model with num_chans and num_pools (typically smaller '
+                             'than those of the teacher) to reproduce the reconstructions of this trained model, for '
+                             'masks of acquisition trajectories. The student can replace the teacher as '
+                             'recon_model_checkpoint in train_policy.py.')
+    parser.add_argument('--distill_policy_checkpoint', type=pathlib.Path, default=None,
+                        help='Policy used to sample the rows added to the initial masks for distillation. Rows are '
+                             'sampled uniformly if not set.')
+    parser.add_argument('--acquisition_steps', default=16, type=int,
+                        help='Maximum number of rows added to the initial mask of a slice for distillation.')
+    parser.add_argument('--distill_candidates', default=8, type=int,
+                        help='Number of candidate rows per slice whose rewards are ranked by both student and teacher '
+                             'to evaluate distillation.')
+    add_cpu_profile_args(parser)
     return parser
 
 
 if __name__ == '__main__':
     args = create_arg_parser().parse_args()
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    # CPU only execution (before init_distributed, which picks the backend based on the device)
+    apply_cpu_profile(args)
+    # Sets up one process per torchrun worker, if launched with torchrun
+    init_distributed(args)
+    random.seed(args.seed + args.rank)
+    np.random.seed(args.seed + args.rank)
+    torch.manual_seed(args.seed + args.rank)
     main(args)